@@ -0,0 +1,132 @@
+"""
+Benchmarks the gateway payload codecs against each other.
+
+Usage:
+
+    $ python benchmarks/codec_bench.py [-n ITERATIONS] [payload.json ...]
+    $ python benchmarks/codec_bench.py [-n ITERATIONS] --recording traffic.rec
+
+With no arguments, this uses generated READY, GUILD_CREATE and MESSAGE_CREATE payloads that have
+the same shape as the real ones. Recorded payloads can be passed as JSON files instead, one
+gateway payload per file, or as a recording made with ``GatewayRecorder``. For recordings, the
+largest payload of each event type is used.
+"""
+import argparse
+import json
+import pathlib
+
+from curious.core.codecs import available_codecs, benchmark
+from curious.core.recorder import iter_payloads
+
+
+def _user(n: int) -> dict:
+    return {
+        "id": str(100000000000000000 + n),
+        "username": "user{}".format(n),
+        "discriminator": "{:04d}".format(n % 10000),
+        "avatar": "a" * 32,
+    }
+
+
+def make_ready(guilds: int = 2500) -> dict:
+    return {
+        "op": 0, "s": 1, "t": "READY",
+        "d": {
+            "v": 6,
+            "user": _user(0),
+            "session_id": "f" * 32,
+            "guilds": [{"id": str(200000000000000000 + i), "unavailable": True}
+                       for i in range(guilds)],
+            "private_channels": [],
+            "_trace": ["gateway-prd-main-abcd"],
+        }
+    }
+
+
+def make_guild_create(members: int = 1000) -> dict:
+    guild_id = "200000000000000000"
+    return {
+        "op": 0, "s": 2, "t": "GUILD_CREATE",
+        "d": {
+            "id": guild_id,
+            "name": "A large guild",
+            "owner_id": _user(1)["id"],
+            "region": "us-east",
+            "member_count": members,
+            "large": True,
+            "roles": [{"id": str(300000000000000000 + i), "name": "role{}".format(i),
+                       "color": i, "position": i, "permissions": 104324161,
+                       "hoist": False, "managed": False, "mentionable": False}
+                      for i in range(50)],
+            "channels": [{"id": str(400000000000000000 + i), "name": "channel-{}".format(i),
+                          "type": 0, "position": i, "permission_overwrites": []}
+                         for i in range(100)],
+            "members": [{"user": _user(i), "nick": None, "deaf": False, "mute": False,
+                         "roles": [str(300000000000000000 + (i % 50))],
+                         "joined_at": "2017-11-05T12:00:00.000000+00:00"}
+                        for i in range(members)],
+            "presences": [{"user": {"id": _user(i)["id"]}, "status": "online",
+                           "game": {"name": "a game", "type": 0}}
+                          for i in range(members // 4)],
+            "emojis": [],
+            "voice_states": [],
+        }
+    }
+
+
+def make_message_create() -> dict:
+    return {
+        "op": 0, "s": 3, "t": "MESSAGE_CREATE",
+        "d": {
+            "id": "500000000000000000",
+            "channel_id": "400000000000000000",
+            "author": _user(1),
+            "content": "Hello, world! " * 10,
+            "timestamp": "2017-11-05T12:00:00.000000+00:00",
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [_user(2)],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "type": 0,
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("payloads", nargs="*", type=pathlib.Path,
+                        help="Recorded gateway payloads, as JSON files.")
+    parser.add_argument("-n", "--iterations", type=int, default=100)
+    parser.add_argument("-r", "--recording", type=pathlib.Path,
+                        help="A gateway recording to take payloads from.")
+    args = parser.parse_args()
+
+    if args.recording:
+        payloads, sizes = {}, {}
+        for _, payload in iter_payloads(str(args.recording)):
+            name = payload.get("t") or "op {}".format(payload.get("op"))
+            size = len(json.dumps(payload))
+            if size > sizes.get(name, -1):
+                payloads[name], sizes[name] = payload, size
+    elif args.payloads:
+        payloads = {path.name: json.loads(path.read_text()) for path in args.payloads}
+    else:
+        payloads = {
+            "READY": make_ready(),
+            "GUILD_CREATE": make_guild_create(),
+            "MESSAGE_CREATE": make_message_create(),
+        }
+
+    results = benchmark(payloads, codecs=available_codecs(), iterations=args.iterations)
+
+    print("{:<20}".format("payload") + "".join("{:>12}".format(name) for name in results))
+    for payload_name in payloads:
+        timings = ("{:>10.1f}us".format(results[name][payload_name] * 1e6) for name in results)
+        print("{:<20}".format(payload_name) + "".join(timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,9 +24,11 @@ except DistributionNotFound:
     __version__ = "0.0.0"
 
 
+from curious.core.cache import MemberCacheMode, MemberCachePolicy
 from curious.core.client import BotType, Client
 from curious.core.event import EventContext, event
-from curious.core.gateway import Gateway
+from curious.core.gateway import DispatchFilter, Gateway
+from curious.core.sessions import FileSessionStore, SQLiteSessionStore
 from curious.core.state import GuildStore, State
 from curious.dataclasses.appinfo import AppInfo
 from curious.dataclasses.bases import Dataclass, IDObject
@@ -3,15 +3,48 @@ Converter methods.
 
 .. currentmodule:: curious.commands.converters
 """
+import typing
+
 from curious.commands.exc import ConversionFailedError
 from curious.dataclasses.channel import Channel
 from curious.dataclasses.member import Member
+from curious.exc import HTTPException
 
 
-def convert_member(ctx, arg: str) -> Member:
+async def _fetch_member(ctx, arg: str, member_id: int = None) -> Member:
+    """
+    Downloads a member that is not cached, for guilds that do not cache every member.
+    """
+    guild = ctx.guild
+    if member_id is not None:
+        try:
+            return await guild.fetch_member(member_id)
+        except HTTPException:
+            raise ConversionFailedError(ctx, arg, Member)
+
+    name, _, discriminator = arg.rpartition("#")
+    if not name:
+        name, discriminator = discriminator, None
+
+    for member in await guild.query_members(name, limit=100):
+        if member.user.username != name:
+            continue
+
+        if discriminator is None or member.user.discriminator == discriminator:
+            return member
+
+    raise ConversionFailedError(ctx, arg, Member)
+
+
+def convert_member(ctx, arg: str) -> typing.Union[Member, typing.Awaitable[Member]]:
     """
     Converts an argument into a Member.
+
+    If the member is not cached and the guild does not cache every member, this returns an
+    awaitable that downloads the member.
     """
+    lazy = ctx.bot.state.member_cache_policy.lazy
+
     if arg.startswith("<@") and arg.endswith(">"):
         # Parse the mention out
         id = arg[2:-1]
@@ -25,10 +58,16 @@ def convert_member(ctx, arg: str) -> Member:
 
         member = ctx.guild.members.get(id)
         if not member:
+            if lazy:
+                return _fetch_member(ctx, arg, id)
+
             raise ConversionFailedError(ctx, arg, Member)
     else:
         member = ctx.guild.search_for_member(full_name=arg)
         if not member:
+            if lazy:
+                return _fetch_member(ctx, arg)
+
             raise ConversionFailedError(ctx, arg, Member)
 
     return member
@@ -31,6 +31,17 @@ def get_full_name(func) -> str:
     return ' '.join(reversed(name))
 
 
+async def _run_converter(converter, ctx, arg: str):
+    """
+    Runs a converter, awaiting the result if the converter is asynchronous.
+    """
+    result = converter(ctx, arg)
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+
 async def _convert(ctx, tokens: List[str], signature: inspect.Signature):
     """
     Converts tokens passed from discord, using a signature.
@@ -67,7 +78,7 @@ async def _convert(ctx, tokens: List[str], signature: inspect.Signature):
             # Only add it to the final_args, then continue the loop.
             arg = replace_quotes(arg)
             converter = ctx._lookup_converter(param.annotation)
-            final_args.append(converter(ctx, arg))
+            final_args.append(await _run_converter(converter, ctx, arg))
             continue
 
         if param.kind in [inspect.Parameter.KEYWORD_ONLY]:
@@ -85,9 +96,9 @@ async def _convert(ctx, tokens: List[str], signature: inspect.Signature):
 
             converter = ctx._lookup_converter(param.annotation)
             if len(f) == 1:
-                final_kwargs[param.name] = converter(ctx, f[0])
+                final_kwargs[param.name] = await _run_converter(converter, ctx, f[0])
             else:
-                final_kwargs[param.name] = converter(ctx, " ".join(f))
+                final_kwargs[param.name] = await _run_converter(converter, ctx, " ".join(f))
             continue
 
         if param.kind in [inspect.Parameter.VAR_POSITIONAL]:
@@ -104,7 +115,7 @@ async def _convert(ctx, tokens: List[str], signature: inspect.Signature):
                 f.append(next_arg)
 
             converter = ctx._lookup_converter(param.annotation)
-            final_args.append(converter(ctx, " ".join(f)))
+            final_args.append(await _run_converter(converter, ctx, " ".join(f)))
 
         if param.kind in [inspect.Parameter.VAR_KEYWORD]:
             # no
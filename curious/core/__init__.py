@@ -9,10 +9,22 @@ delegating it to client code.
 .. autosummary::
     :toctree: core
     
+    cache
+    changes
+    chunker
     client
+    cluster
+    codecs
     event
     gateway
     httpclient
+    identify
+    metrics
+    reconnect
+    recorder
+    sendqueue
+    sessions
+    snapshot
     state
 """
 import asks
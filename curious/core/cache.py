@@ -0,0 +1,1122 @@
+"""
+Cache policies for the state.
+
+By default, every member of every guild is cached, which means memory grows with the total
+member count of the bot. A :class:`.MemberCachePolicy` can keep fewer members, in which case
+members that are not cached are downloaded on demand:
+
+.. code-block:: python3
+
+    client = Client("token", member_cache_policy=MemberCachePolicy(MemberCacheMode.LRU,
+                                                                     max_members=5000))
+
+To cache every member of very large guilds in less memory, ``MemberCachePolicy(compact=True)``
+keeps members in a :class:`.CompactMemberStore` instead.
+
+The statuses of the members of each guild are indexed in a :class:`.PresenceStore`, so that
+counting online members is free. ``MemberCachePolicy(separate_presences=True)`` keeps the whole
+presence there rather than on each member, so that games can be bounded with ``max_games``.
+Members are also indexed by name in a :class:`.MemberNameIndex`, built the first time a guild is
+searched.
+
+Messages are kept in a :class:`.MessageCache`, which is bounded both globally and per channel.
+
+Users are kept in a :class:`.UserCache`, which counts how many guilds and private channels refer
+to each user, so that a user is evicted as soon as nothing refers to it:
+
+.. code-block:: python3
+
+    print(client.state.user_cache_stats())
+
+.. currentmodule:: curious.core.cache
+"""
+import array
+import bisect
+import collections
+import datetime
+import enum
+import sys
+import typing
+import weakref
+
+from curious.core.changes import ChangeSet
+from curious.dataclasses.presence import Presence, Status
+
+if typing.TYPE_CHECKING:
+    # these import the client, which imports this module
+    from curious.dataclasses import guild as dt_guild, member as dt_member, \
+        message as dt_message
+
+
+class LRUDict(collections.OrderedDict):
+    """
+    A dict that evicts its least recently used keys when it grows past a maximum size.
+    """
+
+    def __init__(self, max_size: int, *, pinned: typing.Callable[[typing.Any], bool] = None):
+        """
+        :param max_size: The maximum number of keys to hold.
+        :param pinned: A callable that returns True for keys that are never evicted.
+        """
+        super().__init__()
+        self.max_size = max_size
+        self.pinned = pinned
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+
+        if len(self) > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        for key in self:
+            if self.pinned is None or not self.pinned(key):
+                del self[key]
+                return
+
+    def __repr__(self):
+        return "<LRUDict size={}/{}>".format(len(self), self.max_size)
+
+
+class UserCache(dict):
+    """
+    A mapping of user ID -> :class:`~.User`, which counts the references to each user.
+
+    Every cached member and private channel recipient holds a reference to its user. When the
+    last reference is dropped, the user is evicted, without having to search every guild for
+    other references.
+    """
+
+    def __init__(self, *, keep: typing.Callable[[int], bool] = None):
+        """
+        :param keep: A callable that returns True for user IDs that are never evicted.
+        """
+        super().__init__()
+        self.keep = keep
+
+        #: A mapping of user ID -> number of references to that user.
+        self.refs = collections.Counter()  # type: typing.Dict[int, int]
+
+        #: The number of users evicted.
+        self.evicted = 0
+
+    def __repr__(self):
+        return "<UserCache size={} referenced={}>".format(len(self), len(self.refs))
+
+    def incref(self, user_id: int) -> None:
+        """
+        Adds a reference to a user.
+
+        :param user_id: The ID of the user.
+        """
+        self.refs[user_id] += 1
+
+    def decref(self, user_id: int) -> None:
+        """
+        Drops a reference to a user, evicting the user if it was the last one.
+
+        :param user_id: The ID of the user.
+        """
+        count = self.refs.get(user_id, 0) - 1
+        if count > 0:
+            self.refs[user_id] = count
+            return
+
+        self.refs.pop(user_id, None)
+        self.evict(user_id)
+
+    def evict(self, user_id: int) -> bool:
+        """
+        Evicts a user, if nothing refers to it.
+
+        :param user_id: The ID of the user.
+        :return: True if the user was evicted.
+        """
+        if user_id not in self or user_id in self.refs:
+            return False
+
+        if self.keep is not None and self.keep(user_id):
+            return False
+
+        del self[user_id]
+        self.evicted += 1
+        return True
+
+    def stats(self) -> dict:
+        """
+        :return: A dict of statistics about this cache.
+        """
+        return {
+            "users": len(self),
+            "referenced": len(self.refs),
+            "references": sum(self.refs.values()),
+            "evicted": self.evicted,
+        }
+
+
+class MemberStore(dict):
+    """
+    The member mapping of a guild.
+
+    While the guild is in the state, the store is attached to the :class:`.UserCache`, and holds
+    a reference to the user of every member in it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._users = None  # type: UserCache
+
+    def attach(self, users: UserCache) -> None:
+        """
+        Attaches this store to a user cache, adding a reference for every member.
+
+        :param users: The :class:`.UserCache` to attach to.
+        """
+        if self._users is users:
+            return
+
+        self.detach()
+        self._users = users
+        for member_id in self:
+            users.incref(member_id)
+
+    def detach(self) -> None:
+        """
+        Detaches this store from its user cache, dropping the reference for every member. The
+        members themselves are kept.
+        """
+        users, self._users = self._users, None
+        if users is None:
+            return
+
+        for member_id in list(self):
+            users.decref(member_id)
+
+    def __setitem__(self, key, value):
+        new = key not in self
+        super().__setitem__(key, value)
+        if new and self._users is not None:
+            self._users.incref(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self._users is not None:
+            self._users.decref(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+
+            raise KeyError(key)
+
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self._users is not None:
+            self._users.decref(key)
+
+        return key, value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return dict.__getitem__(self, key)
+
+    def remove_role(self, role_id: int) -> None:
+        """
+        Removes a deleted role from every member.
+
+        :param role_id: The ID of the role.
+        """
+        for member in dict.values(self):
+            if role_id in member.role_ids:
+                ChangeSet.freeze(member)
+                member.role_ids = [id for id in member.role_ids if id != role_id]
+
+
+class LRUMemberStore(MemberStore, LRUDict):
+    """
+    A :class:`.MemberStore` that evicts its least recently used members.
+    """
+
+    def __init__(self, max_size: int, *, pinned: typing.Callable[[typing.Any], bool] = None):
+        LRUDict.__init__(self, max_size, pinned=pinned)
+        self._users = None
+
+    def __repr__(self):
+        return "<LRUMemberStore size={}/{}>".format(len(self), self.max_size)
+
+
+class CompactMemberStore(collections.MutableMapping):
+    """
+    A member mapping that packs its members into parallel arrays, instead of keeping a
+    :class:`~.Member` object for each one.
+
+    Role ID sets are shared between members with the same roles, nicknames are interned, and
+    statuses are stored as small integers. Members are unpacked into a new :class:`~.Member`
+    when they are looked up; the same object is returned while anything still holds it.
+
+    .. warning::
+
+        Changes to a looked up member are only kept once it is stored again, with
+        ``store[member.id] = member``.
+    """
+    _STATUSES = list(Status)
+    _NO_DATE = -2 ** 63
+    _EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, guild: 'dt_guild.Guild'):
+        """
+        :param guild: The :class:`~.Guild` this store is for.
+        """
+        self._bot = guild._bot
+        self._guild_id = guild.id
+        self._is_me = guild._is_me
+        self._presences = guild._presences
+        self._users = None  # type: UserCache
+
+        # member id -> row
+        self._rows = {}  # type: typing.Dict[int, int]
+        self._ids = array.array("Q")
+        self._joined_at = array.array("q")
+        self._statuses = bytearray()
+        self._role_sets = array.array("I")
+        self._nicknames = []  # type: typing.List[typing.Union[str, None]]
+
+        # every distinct role ID set, shared between rows
+        # sets no row uses any more are freed, and their slot is reused
+        self._role_set_list = []  # type: typing.List[typing.Tuple[int, ...]]
+        self._role_set_index = {}  # type: typing.Dict[typing.Tuple[int, ...], int]
+        self._role_set_refs = []  # type: typing.List[int]
+        self._free_role_sets = []  # type: typing.List[int]
+
+        # member id -> game, only for members playing something
+        self._games = {}  # type: typing.Dict[int, Game]
+
+        # the bot's own member is kept as an object, as it is updated in place
+        self._pinned = {}  # type: typing.Dict[int, dt_member.Member]
+        self._live = weakref.WeakValueDictionary()
+
+        # members stored before the store is attached, kept alive until then
+        # otherwise, dropping them would evict their users, as nothing refers to them yet
+        self._unattached = {}  # type: typing.Dict[int, dt_member.Member]
+
+    def __repr__(self):
+        return "<CompactMemberStore size={} role_sets={}>".format(len(self),
+                                                                  len(self._role_set_list))
+
+    def attach(self, users: UserCache) -> None:
+        """
+        Attaches this store to a user cache, adding a reference for every member.
+
+        :param users: The :class:`.UserCache` to attach to.
+        """
+        if self._users is users:
+            return
+
+        self.detach()
+        self._users = users
+        for member_id in self:
+            users.incref(member_id)
+
+        self._unattached.clear()
+
+    def detach(self) -> None:
+        """
+        Detaches this store from its user cache, dropping the reference for every member.
+        """
+        users, self._users = self._users, None
+        if users is None:
+            return
+
+        for member_id in list(self):
+            users.decref(member_id)
+
+    def _pack_role_set(self, role_ids: typing.Iterable[int]) -> int:
+        """
+        :return: The index of a role ID set, with a reference added for the row that uses it.
+        """
+        role_set = tuple(sorted(role_ids))
+        index = self._role_set_index.get(role_set)
+        if index is not None:
+            self._role_set_refs[index] += 1
+            return index
+
+        if self._free_role_sets:
+            index = self._free_role_sets.pop()
+            self._role_set_list[index] = role_set
+            self._role_set_refs[index] = 1
+        else:
+            index = len(self._role_set_list)
+            self._role_set_list.append(role_set)
+            self._role_set_refs.append(1)
+
+        self._role_set_index[role_set] = index
+        return index
+
+    def _release_role_set(self, index: int) -> None:
+        """
+        Drops the reference of a row to a role ID set, freeing the set if no row uses it.
+        """
+        self._role_set_refs[index] -= 1
+        if self._role_set_refs[index] == 0:
+            del self._role_set_index[self._role_set_list[index]]
+            self._role_set_list[index] = None
+            self._free_role_sets.append(index)
+
+    def _pack_date(self, date: datetime.datetime) -> int:
+        if date is None:
+            return self._NO_DATE
+
+        return (date - self._EPOCH) // datetime.timedelta(microseconds=1)
+
+    def _unpack_date(self, value: int) -> typing.Union[datetime.datetime, None]:
+        if value == self._NO_DATE:
+            return None
+
+        return self._EPOCH + datetime.timedelta(microseconds=value)
+
+    def __getitem__(self, key: int) -> 'dt_member.Member':
+        member = self._pinned.get(key) or self._live.get(key)
+        if member is not None:
+            return member
+
+        row = self._rows[key]
+        if self._presences.separate:
+            # the member reads it from the presence store
+            presence = None
+        else:
+            status = self._STATUSES[self._statuses[row]]
+            presence = Presence(status=status, game=self._games.get(key))
+
+        from curious.dataclasses.member import Member
+
+        member = Member._from_compact(
+            self._bot, key, self._guild_id,
+            role_ids=list(self._role_set_list[self._role_sets[row]]),
+            joined_at=self._unpack_date(self._joined_at[row]),
+            nickname=self._nicknames[row], presence=presence
+        )
+        self._live[key] = member
+        return member
+
+    def __setitem__(self, key: int, member: 'dt_member.Member'):
+        new = key not in self
+        if self._is_me(key):
+            self._pinned[key] = member
+            self._remove_row(key)
+        else:
+            self._pack(key, member)
+
+        if self._users is not None:
+            if new:
+                self._users.incref(key)
+        else:
+            self._unattached[key] = member
+
+    def _pack(self, key: int, member: 'dt_member.Member'):
+        nickname = member.nickname or None
+        if nickname is not None:
+            nickname = sys.intern(str(nickname))
+
+        presence = member.presence if not self._presences.separate else None
+        status = presence.status if presence is not None else Status.OFFLINE
+        game = presence.game if presence is not None else None
+        if game is not None:
+            self._games[key] = game
+        else:
+            self._games.pop(key, None)
+
+        fields = (key, self._pack_date(member.joined_at), self._STATUSES.index(status),
+                  self._pack_role_set(member.role_ids), nickname)
+
+        row = self._rows.get(key)
+        if row is None:
+            self._rows[key] = len(self._ids)
+            for column, value in zip(self._columns(), fields):
+                column.append(value)
+        else:
+            # fields holds a new reference to the role set, so release the old one
+            self._release_role_set(self._role_sets[row])
+            for column, value in zip(self._columns(), fields):
+                column[row] = value
+
+        self._live[key] = member
+
+    def _columns(self) -> tuple:
+        return self._ids, self._joined_at, self._statuses, self._role_sets, self._nicknames
+
+    def _remove_row(self, key: int) -> bool:
+        """
+        Removes the row of a member, by moving the last row into its place.
+        """
+        row = self._rows.pop(key, None)
+        if row is None:
+            return False
+
+        self._release_role_set(self._role_sets[row])
+        last = len(self._ids) - 1
+        if row != last:
+            moved_id = self._ids[last]
+            for column in self._columns():
+                column[row] = column[last]
+
+            self._rows[moved_id] = row
+
+        for column in self._columns():
+            column.pop()
+
+        self._games.pop(key, None)
+        self._live.pop(key, None)
+        return True
+
+    def __delitem__(self, key: int):
+        if self._pinned.pop(key, None) is None and not self._remove_row(key):
+            raise KeyError(key)
+
+        self._unattached.pop(key, None)
+        if self._users is not None:
+            self._users.decref(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._rows or key in self._pinned
+
+    def __iter__(self) -> typing.Iterator[int]:
+        yield from list(self._pinned)
+        yield from list(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._pinned)
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def remove_role(self, role_id: int) -> None:
+        """
+        Removes a deleted role from every member, by repacking the rows that have it.
+
+        :param role_id: The ID of the role.
+        """
+        # old role set index -> role set without the role
+        stripped = {}
+        for row, index in enumerate(self._role_sets):
+            role_set = self._role_set_list[index]
+            if role_id not in role_set:
+                continue
+
+            new_set = stripped.get(index)
+            if new_set is None:
+                new_set = stripped[index] = tuple(id for id in role_set if id != role_id)
+
+            self._role_sets[row] = self._pack_role_set(new_set)
+            self._release_role_set(index)
+
+        # members that are looked up or pinned are objects, so change them too
+        for member in list(self._live.values()) + list(self._pinned.values()):
+            if role_id in member.role_ids:
+                ChangeSet.freeze(member)
+                member.role_ids = [id for id in member.role_ids if id != role_id]
+
+
+class PresenceStore(object):
+    """
+    The presences of the members of a guild, indexed by status.
+
+    Only members that are not offline are stored. The IDs of the members with each status are
+    kept in a set, so counting or listing the members with a status never looks at any other
+    member. Presences are stored for members that are not cached too.
+    """
+
+    def __init__(self, *, separate: bool = False, max_games: int = None):
+        """
+        :param separate: If presences are kept here instead of on each :class:`~.Member`. If not, \
+            only statuses are stored, and games are left on the members.
+        :param max_games: The maximum number of games to keep, if presences are separate. 0 \
+            drops games entirely.
+        """
+        #: If presences are kept here instead of on each member.
+        self.separate = separate
+
+        # member id -> status, for members that are not offline
+        self._statuses = {}  # type: typing.Dict[int, Status]
+        # status -> ids of the members with that status
+        self._buckets = {status: set() for status in Status
+                         if status is not Status.OFFLINE}  # type: typing.Dict[Status, set]
+
+        # member id -> game, only for members playing something
+        if not separate or max_games == 0:
+            self._games = None
+        elif max_games is not None:
+            self._games = LRUDict(max_games)
+        else:
+            self._games = {}  # type: typing.Dict[int, Game]
+
+    def __repr__(self):
+        counts = " ".join("{}={}".format(status.value, len(ids))
+                          for status, ids in self._buckets.items())
+        return "<PresenceStore {}>".format(counts)
+
+    def __len__(self) -> int:
+        return len(self._statuses)
+
+    def __contains__(self, member_id: int) -> bool:
+        return member_id in self._statuses
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(list(self._statuses))
+
+    def status(self, member_id: int) -> Status:
+        """
+        :param member_id: The ID of the member.
+        :return: The :class:`~.Status` of the member.
+        """
+        return self._statuses.get(member_id, Status.OFFLINE)
+
+    def get(self, member_id: int) -> Presence:
+        """
+        :param member_id: The ID of the member.
+        :return: A new :class:`~.Presence` for the member.
+        """
+        game = self._games.get(member_id) if self._games is not None else None
+        return Presence(status=self.status(member_id), game=game)
+
+    def set(self, member_id: int, presence: Presence) -> None:
+        """
+        Stores the presence of a member.
+
+        :param member_id: The ID of the member.
+        :param presence: The new :class:`~.Presence` of the member.
+        """
+        status = presence.status if presence is not None else None
+        if status is None:
+            status = Status.OFFLINE
+
+        old = self._statuses.get(member_id)
+        if old is not status:
+            if old is not None:
+                self._buckets[old].discard(member_id)
+
+            if status is Status.OFFLINE:
+                self._statuses.pop(member_id, None)
+            else:
+                self._statuses[member_id] = status
+                self._buckets[status].add(member_id)
+
+        if self._games is not None:
+            if status is not Status.OFFLINE and presence.game is not None:
+                self._games[member_id] = presence.game
+            else:
+                self._games.pop(member_id, None)
+
+    def discard(self, member_id: int) -> None:
+        """
+        Removes the presence of a member, e.g. when they leave the guild.
+
+        :param member_id: The ID of the member.
+        """
+        status = self._statuses.pop(member_id, None)
+        if status is not None:
+            self._buckets[status].discard(member_id)
+
+        if self._games is not None:
+            self._games.pop(member_id, None)
+
+    def count(self, status: Status) -> int:
+        """
+        :param status: A :class:`~.Status` other than offline.
+        :return: The number of members with the status.
+        """
+        return len(self._buckets[status])
+
+    def member_ids(self, status: Status) -> typing.FrozenSet[int]:
+        """
+        :param status: A :class:`~.Status` other than offline.
+        :return: The IDs of the members with the status.
+        """
+        return frozenset(self._buckets[status])
+
+    def clear(self) -> None:
+        """
+        Removes every presence.
+        """
+        self._statuses.clear()
+        for ids in self._buckets.values():
+            ids.clear()
+
+        if self._games is not None:
+            self._games.clear()
+
+
+class MemberNameIndex(object):
+    """
+    An index of the members of a guild by username#discriminator, username and nickname.
+
+    Usernames and nicknames are also kept case-folded in sorted order, for prefix searches.
+    """
+
+    def __init__(self):
+        # member id -> (username, discriminator, nickname) that the member is indexed under
+        self._entries = {}  # type: typing.Dict[int, tuple]
+        # username#discriminator -> member id
+        self._full_names = {}  # type: typing.Dict[str, int]
+        # username or nickname -> member ids
+        self._names = {}  # type: typing.Dict[str, typing.Set[int]]
+        # sorted (case-folded username or nickname, member id)
+        self._folded = []  # type: typing.List[typing.Tuple[str, int]]
+
+    def __repr__(self):
+        return "<MemberNameIndex members={} names={}>".format(len(self._entries), len(self._names))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, member_id: int) -> bool:
+        return member_id in self._entries
+
+    @staticmethod
+    def _key(member: 'dt_member.Member') -> tuple:
+        user = member.user
+        return user.username, user.discriminator, str(member.nickname) or None
+
+    def matches(self, member: 'dt_member.Member') -> bool:
+        """
+        :param member: The :class:`~.Member` to check.
+        :return: If the member is indexed under its current names.
+        """
+        return self._entries.get(member.id) == self._key(member)
+
+    def add(self, member: 'dt_member.Member') -> None:
+        """
+        Indexes a member under its current names, replacing its old ones.
+
+        :param member: The :class:`~.Member` to index.
+        """
+        key = self._key(member)
+        old = self._entries.get(member.id)
+        if old == key:
+            return
+
+        if old is not None:
+            self._remove(member.id, old)
+
+        for entry in self._insert(member.id, key):
+            bisect.insort(self._folded, entry)
+
+    def add_all(self, members: 'typing.Iterable[dt_member.Member]') -> None:
+        """
+        Indexes many members at once, such as when the index is first built.
+
+        The case-folded names are sorted once at the end, rather than inserted one at a time.
+
+        :param members: The :class:`~.Member` objects to index.
+        """
+        folded = []
+        for member in {member.id: member for member in members}.values():
+            key = self._key(member)
+            old = self._entries.get(member.id)
+            if old == key:
+                continue
+
+            if old is not None:
+                self._remove(member.id, old)
+
+            folded.extend(self._insert(member.id, key))
+
+        self._folded.extend(folded)
+        self._folded.sort()
+
+    def _insert(self, member_id: int, key: tuple) -> typing.List[typing.Tuple[str, int]]:
+        """
+        Indexes a member by exact name.
+
+        :return: The case-folded entries to add to the sorted names.
+        """
+        self._entries[member_id] = key
+        username, discriminator, nickname = key
+        if username is not None:
+            self._full_names["{}#{}".format(username, discriminator)] = member_id
+
+        folded = []
+        for name in {username, nickname}:
+            if name is None:
+                continue
+
+            self._names.setdefault(name, set()).add(member_id)
+            folded.append((name.casefold(), member_id))
+
+        return folded
+
+    def discard(self, member_id: int) -> None:
+        """
+        Removes a member from the index.
+
+        :param member_id: The ID of the member.
+        """
+        key = self._entries.pop(member_id, None)
+        if key is not None:
+            self._remove(member_id, key)
+
+    def _remove(self, member_id: int, key: tuple) -> None:
+        username, discriminator, nickname = key
+        full_name = "{}#{}".format(username, discriminator)
+        if self._full_names.get(full_name) == member_id:
+            del self._full_names[full_name]
+
+        for name in {username, nickname}:
+            if name is None:
+                continue
+
+            ids = self._names.get(name)
+            if ids is not None:
+                ids.discard(member_id)
+                if not ids:
+                    del self._names[name]
+
+            entry = (name.casefold(), member_id)
+            i = bisect.bisect_left(self._folded, entry)
+            if i < len(self._folded) and self._folded[i] == entry:
+                del self._folded[i]
+
+    def find(self, name: str, discriminator: str = None) -> typing.List[int]:
+        """
+        Finds members by exact name.
+
+        :param name: The username or nickname.
+        :param discriminator: The discriminator, if known.
+        :return: The IDs of the matching members, with an exact username#discriminator first.
+        """
+        if discriminator is None:
+            return list(self._names.get(name, ()))
+
+        found = []
+        member_id = self._full_names.get("{}#{}".format(name, discriminator))
+        if member_id is not None:
+            found.append(member_id)
+
+        for member_id in self._names.get(name, ()):
+            if member_id not in found and self._entries[member_id][1] == discriminator:
+                found.append(member_id)
+
+        return found
+
+    def startswith(self, prefix: str, *, limit: int = None) -> typing.List[int]:
+        """
+        Finds members whose username or nickname starts with a prefix, ignoring case.
+
+        :param prefix: The prefix.
+        :param limit: The maximum number of members to return.
+        :return: The IDs of the matching members, in order of name.
+        """
+        prefix = prefix.casefold()
+        found = []
+        seen = set()
+
+        i = bisect.bisect_left(self._folded, (prefix,))
+        while i < len(self._folded) and (limit is None or len(found) < limit):
+            folded, member_id = self._folded[i]
+            if not folded.startswith(prefix):
+                break
+
+            if member_id not in seen:
+                seen.add(member_id)
+                found.append(member_id)
+
+            i += 1
+
+        return found
+
+    def clear(self) -> None:
+        """
+        Removes every member from the index.
+        """
+        self._entries.clear()
+        self._full_names.clear()
+        self._names.clear()
+        self._folded.clear()
+
+
+class MemberCacheMode(enum.Enum):
+    """
+    Which members a :class:`.MemberCachePolicy` keeps.
+    """
+    #: Every member is cached, and large guilds are chunked.
+    FULL = "full"
+
+    #: Only members that are not offline are cached.
+    ONLINE = "online"
+
+    #: Only members in a voice channel are cached.
+    VOICE = "voice"
+
+    #: Every member seen is cached, up to a maximum number per guild.
+    LRU = "lru"
+
+    #: Only the bot's own member is cached.
+    NONE = "none"
+
+
+class MemberCachePolicy(object):
+    """
+    Decides which guild members are cached.
+
+    With any mode except :attr:`.MemberCacheMode.FULL`, large guilds are not chunked, and
+    :meth:`.Guild.fetch_member` and :meth:`.Guild.query_members` download members that are not
+    cached.
+    """
+
+    def __init__(self, mode: MemberCacheMode = MemberCacheMode.FULL, *,
+                 max_members: int = 1000, compact: bool = False,
+                 separate_presences: bool = False, max_games: int = None):
+        """
+        :param mode: The :class:`.MemberCacheMode` to use.
+        :param max_members: The maximum number of members cached per guild, in LRU mode.
+        :param compact: If members should be kept in a :class:`.CompactMemberStore`, which uses \
+            far less memory, at the cost of unpacking members when they are looked up. This is \
+            ignored in LRU mode.
+        :param separate_presences: If presences should be kept in the :class:`.PresenceStore` of \
+            each guild, instead of on each member.
+        :param max_games: The maximum number of games kept per guild, with separate presences. \
+            0 drops games entirely.
+        """
+        self.mode = MemberCacheMode(mode)
+        self.max_members = max_members
+        self.compact = compact
+        self.separate_presences = separate_presences
+        self.max_games = max_games
+
+    def __repr__(self):
+        return "<MemberCachePolicy mode={} compact={}>".format(self.mode.value, self.compact)
+
+    @property
+    def lazy(self) -> bool:
+        """
+        :return: If members are loaded on demand, instead of all at once.
+        """
+        return self.mode is not MemberCacheMode.FULL
+
+    def new_store(self, guild: 'dt_guild.Guild') \
+            -> 'typing.MutableMapping[int, dt_member.Member]':
+        """
+        Creates the member mapping for a guild.
+
+        :param guild: The :class:`~.Guild` to create the mapping for.
+        """
+        if self.mode is MemberCacheMode.LRU:
+            return LRUMemberStore(self.max_members, pinned=guild._is_me)
+
+        if self.compact:
+            return CompactMemberStore(guild)
+
+        return MemberStore()
+
+    def new_presence_store(self) -> PresenceStore:
+        """
+        Creates the presence store for a guild.
+        """
+        return PresenceStore(separate=self.separate_presences, max_games=self.max_games)
+
+    def should_chunk(self, guild: 'dt_guild.Guild') -> bool:
+        """
+        :param guild: A large :class:`~.Guild` that has just been created.
+        :return: If every member of the guild should be requested.
+        """
+        return self.mode is MemberCacheMode.FULL
+
+    def should_cache(self, guild: 'dt_guild.Guild', member: 'dt_member.Member') -> bool:
+        """
+        :param guild: The :class:`~.Guild` the member is in.
+        :param member: The :class:`~.Member` to check.
+        :return: If the member should be kept in the guild's member cache.
+        """
+        if self.mode in (MemberCacheMode.FULL, MemberCacheMode.LRU):
+            return True
+
+        if guild._is_me(member.id):
+            return True
+
+        if self.mode is MemberCacheMode.ONLINE:
+            return member.status is not Status.OFFLINE
+
+        if self.mode is MemberCacheMode.VOICE:
+            return member.id in guild._voice_states
+
+        return False
+
+
+class MessageCache(object):
+    """
+    A bounded cache of messages, with constant time lookups by ID.
+
+    Messages are evicted oldest first, once either the total number of messages or the number of
+    messages in a single channel goes over its limit.
+    """
+
+    def __init__(self, max_messages: int = 500, *, max_per_channel: int = None):
+        """
+        :param max_messages: The maximum number of messages to cache.
+        :param max_per_channel: The maximum number of messages to cache per channel, if any.
+        """
+        self.max_messages = max_messages
+        self.max_per_channel = max_per_channel
+
+        # message id -> message, oldest first
+        self._messages = collections.OrderedDict()  # type: typing.Dict[int, dt_message.Message]
+        # channel id -> ordered set of message ids
+        self._channels = collections.defaultdict(collections.OrderedDict)
+        # guild id -> set of channel ids
+        self._guilds = collections.defaultdict(set)
+        # channel id -> guild id, for channels in a guild
+        self._channel_guilds = {}  # type: typing.Dict[int, int]
+
+    def __repr__(self):
+        return "<MessageCache size={}/{}>".format(len(self), self.max_messages)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> 'typing.Iterator[dt_message.Message]':
+        return iter(list(self._messages.values()))
+
+    def __reversed__(self) -> 'typing.Iterator[dt_message.Message]':
+        return reversed(list(self._messages.values()))
+
+    def __contains__(self, item) -> bool:
+        message_id = getattr(item, "id", item)
+        return message_id in self._messages
+
+    @property
+    def maxlen(self) -> int:
+        """
+        :return: The maximum number of messages cached.
+        """
+        return self.max_messages
+
+    def get(self, message_id: int, default=None) -> 'typing.Union[dt_message.Message, None]':
+        """
+        :param message_id: The ID of the message.
+        :return: The cached :class:`~.Message` with that ID, or the default.
+        """
+        return self._messages.get(message_id, default)
+
+    def channel_messages(self, channel_id: int) -> 'typing.List[dt_message.Message]':
+        """
+        :param channel_id: The ID of the channel.
+        :return: The cached messages in the channel, oldest first.
+        """
+        return [self._messages[message_id] for message_id in self._channels.get(channel_id, ())]
+
+    def append(self, message: 'dt_message.Message') -> None:
+        """
+        Adds a message to the cache, replacing any message with the same ID.
+
+        :param message: The :class:`~.Message` to add.
+        """
+        self.remove(message.id)
+        self._messages[message.id] = message
+
+        channel_id = message.channel_id
+        channel = self._channels[channel_id]
+        channel[message.id] = None
+        if message.guild_id is not None:
+            self._guilds[message.guild_id].add(channel_id)
+            self._channel_guilds[channel_id] = message.guild_id
+
+        if self.max_per_channel is not None and len(channel) > self.max_per_channel:
+            self.remove(next(iter(channel)))
+
+        if len(self._messages) > self.max_messages:
+            self.remove(next(iter(self._messages)))
+
+    def remove(self, message_id: int) -> 'typing.Union[dt_message.Message, None]':
+        """
+        Removes a message from the cache.
+
+        :param message_id: The ID of the message to remove.
+        :return: The :class:`~.Message` removed, or None if it was not cached.
+        """
+        message = self._messages.pop(message_id, None)
+        if message is None:
+            return None
+
+        channel = self._channels.get(message.channel_id)
+        if channel is not None:
+            channel.pop(message_id, None)
+            if not channel:
+                self._drop_channel(message.channel_id)
+
+        return message
+
+    def _drop_channel(self, channel_id: int) -> 'typing.Dict[int, None]':
+        """
+        Removes a channel from the channel and guild indexes.
+
+        :return: The ordered set of message IDs that were in the channel.
+        """
+        message_ids = self._channels.pop(channel_id, {})
+
+        guild_id = self._channel_guilds.pop(channel_id, None)
+        channels = self._guilds.get(guild_id)
+        if channels is not None:
+            channels.discard(channel_id)
+            if not channels:
+                del self._guilds[guild_id]
+
+        return message_ids
+
+    def evict_channel(self, channel_id: int) -> int:
+        """
+        Removes every message in a channel from the cache.
+
+        :param channel_id: The ID of the channel.
+        :return: The number of messages removed.
+        """
+        message_ids = self._drop_channel(channel_id)
+        for message_id in message_ids:
+            self._messages.pop(message_id, None)
+
+        return len(message_ids)
+
+    def evict_guild(self, guild_id: int) -> int:
+        """
+        Removes every message in a guild from the cache.
+
+        :param guild_id: The ID of the guild.
+        :return: The number of messages removed.
+        """
+        return sum(self.evict_channel(channel_id)
+                   for channel_id in self._guilds.pop(guild_id, ()))
+
+    def clear(self) -> None:
+        """
+        Removes every message from the cache.
+        """
+        self._messages.clear()
+        self._channels.clear()
+        self._guilds.clear()
+        self._channel_guilds.clear()
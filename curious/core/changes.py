@@ -0,0 +1,169 @@
+"""
+Change sets for update events.
+
+Update events are fired with the object from before the update and the object after it. Copying
+every object before updating it is wasteful, as most listeners never look at the old object, so
+handlers record the fields they change on a :class:`.ChangeSet` instead, and the old object is
+only created the first time a listener uses it.
+
+.. currentmodule:: curious.core.changes
+"""
+import typing
+import weakref
+
+_MISSING = object()
+
+
+class ChangeSet(object):
+    """
+    Records the fields an update changes on an object.
+
+    The old value of each field is stored the first time it is changed, and the object from before
+    the update is created from the current object and those values when :attr:`.before` is first
+    used.
+
+    Creating a change set for an object creates the old object for any earlier change set of it
+    that has not been used yet, so an update never leaks into the old object of a previous update.
+    Anything that changes an object outside of a change set must call :meth:`.freeze` first.
+    """
+
+    # id(target) -> the newest change set for that object that has not created its old object
+    # the change set holds the object, so the id cannot be reused while the entry exists
+    _pending = weakref.WeakValueDictionary()
+
+    __slots__ = "target", "_old", "_before", "__weakref__"
+
+    def __init__(self, target):
+        #: The object being updated.
+        self.target = target
+
+        # field -> the value before the update
+        self._old = {}
+        self._before = None
+
+        ChangeSet.freeze(target)
+        ChangeSet._pending[id(target)] = self
+
+    @classmethod
+    def freeze(cls, target) -> None:
+        """
+        Creates the old object for the change set of an object that has not been used yet, if
+        there is one.
+
+        :param target: The object that is about to be changed outside of a change set.
+        """
+        previous = cls._pending.get(id(target))
+        if previous is not None:
+            previous._materialise()
+
+    def __repr__(self) -> str:
+        return "<ChangeSet target={!r} fields={}>".format(self.target, list(self._old))
+
+    def record(self, name: str):
+        """
+        Records the current value of a field, before it is changed in place or by a method.
+
+        :param name: The name of the field.
+        """
+        if name not in self._old:
+            self._old[name] = getattr(self.target, name)
+
+    def set(self, name: str, value):
+        """
+        Changes a field on the object, recording its old value.
+
+        :param name: The name of the field.
+        :param value: The new value of the field.
+        """
+        self.record(name)
+        setattr(self.target, name, value)
+
+    @property
+    def changed(self) -> typing.Dict[str, typing.Tuple[typing.Any, typing.Any]]:
+        """
+        :return: A dict of field name -> (old value, new value), for fields that have changed.
+        """
+        changed = {}
+        for name, old in self._old.items():
+            new = getattr(self.target, name, _MISSING)
+            if new is not old and new != old:
+                changed[name] = (old, new)
+
+        return changed
+
+    @property
+    def before(self):
+        """
+        :return: The object as it was before the update.
+        """
+        return self._materialise()
+
+    def lazy_before(self) -> 'LazyBefore':
+        """
+        :return: A :class:`.LazyBefore` that stands in for the object from before the update.
+        """
+        return LazyBefore(self)
+
+    def _materialise(self):
+        if self._before is None:
+            before = self.target._copy()
+            for name, value in self._old.items():
+                setattr(before, name, value)
+
+            self._before = before
+            if ChangeSet._pending.get(id(self.target)) is self:
+                del ChangeSet._pending[id(self.target)]
+
+        return self._before
+
+
+class LazyBefore(object):
+    """
+    Stands in for the object from before an update.
+
+    The old object is created from its :class:`.ChangeSet` when an attribute is first accessed,
+    and every attribute access is then passed through to it. ``isinstance`` checks, comparisons,
+    hashing and ``repr`` work as they would on the old object.
+    """
+
+    __slots__ = "_changes",
+
+    def __init__(self, changes: ChangeSet):
+        object.__setattr__(self, "_changes", changes)
+
+    @property
+    def __class__(self):
+        return type(self._changes.target)
+
+    def __getattr__(self, item: str):
+        return getattr(self._changes.before, item)
+
+    def __setattr__(self, key: str, value):
+        setattr(self._changes.before, key, value)
+
+    def __repr__(self) -> str:
+        return repr(self._changes.before)
+
+    def __str__(self) -> str:
+        return str(self._changes.before)
+
+    def __hash__(self) -> int:
+        return hash(self._changes.before)
+
+    def __eq__(self, other):
+        return self._changes.before == other
+
+    def __ne__(self, other):
+        return self._changes.before != other
+
+    def __lt__(self, other):
+        return self._changes.before < other
+
+    def __le__(self, other):
+        return self._changes.before <= other
+
+    def __gt__(self, other):
+        return self._changes.before > other
+
+    def __ge__(self, other):
+        return self._changes.before >= other
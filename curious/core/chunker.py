@@ -0,0 +1,384 @@
+"""
+Member chunking for large guilds.
+
+Every :class:`~.Gateway` owns a :class:`.GuildChunker`, which requests the members of large
+guilds in batches, limits how many requests are in flight at once, and re-requests guilds whose
+chunks never arrive, so that a shard always reaches READY.
+
+.. code-block:: python3
+
+    # wait until every large guild on shard 0 has all of its members
+    await client.gateways[0].chunker.wait()
+
+.. currentmodule:: curious.core.chunker
+"""
+import collections
+import itertools
+import logging
+import time
+import typing
+
+import curio
+import multio
+
+from curious.core import gateway as _gateway
+from curious.dataclasses import guild as dt_guild
+from curious.util import coerce_agen
+
+logger = logging.getLogger("curious.chunker")
+
+
+class ChunkProgress(object):
+    """
+    The chunking progress of a single guild.
+    """
+    __slots__ = "guild", "expected", "received", "attempts", "last_activity", "batch", "nonce"
+
+    def __init__(self, guild: 'dt_guild.Guild', expected: int):
+        #: The :class:`~.Guild` being chunked.
+        self.guild = guild
+
+        #: The number of chunks expected.
+        self.expected = expected
+
+        #: The number of chunks received for the current request.
+        self.received = 0
+
+        #: The number of times this guild has been requested.
+        self.attempts = 0
+
+        #: The last time the request for this guild was sent, or a chunk for the request
+        #: arrived. This is None while the request is waiting in the send queue.
+        self.last_activity = None  # type: float
+
+        #: The set of guild IDs in the request this guild was sent in.
+        self.batch = None  # type: typing.Set[int]
+
+        #: The nonce of the request this guild was sent in.
+        self.nonce = None  # type: str
+
+    def __repr__(self):
+        return "<ChunkProgress guild={} received={}/{} attempts={}>".format(
+            self.guild.id, self.received, self.expected, self.attempts)
+
+
+class GuildChunker(object):
+    """
+    A per-gateway scheduler for member chunk requests.
+
+    Guilds added with :meth:`.add` are held until a full batch is ready, or until :meth:`.flush`
+    is called once every guild on the shard has streamed in. After that, guilds are requested as
+    soon as they are added.
+    """
+    #: The number of seconds between checks for timed out requests.
+    CHECK_INTERVAL = 5.0
+
+    #: The prefix of the nonces of chunk requests, which tells their chunks apart from the
+    #: responses to member queries.
+    NONCE_PREFIX = "chunk-"
+
+    def __init__(self, gw: '_gateway.Gateway', *, batch_size: int = 75, max_in_flight: int = 2,
+                 timeout: float = 30.0, max_retries: int = 3):
+        """
+        :param gw: The :class:`~.Gateway` to request chunks on.
+        :param batch_size: The maximum number of guilds in a single request.
+        :param max_in_flight: The maximum number of requests waiting on chunks at once.
+        :param timeout: The number of seconds without a chunk for a request, after it was sent, \
+            before its guilds are re-requested.
+        :param max_retries: The number of times a guild is re-requested before giving up on it.
+        """
+        self.gw = gw
+
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        #: The number of guilds that received all of their chunks.
+        self.completed = 0
+        #: The number of times a guild was re-requested.
+        self.retried = 0
+        #: The number of guilds that were given up on.
+        self.gave_up = 0
+
+        self._pending = collections.OrderedDict()  # type: typing.Dict[int, ChunkProgress]
+        self._in_flight = {}  # type: typing.Dict[int, ChunkProgress]
+        self._batches = []  # type: typing.List[typing.Set[int]]
+        self._nonces = itertools.count()
+        self._eager = False
+        self._idle = multio.Event()
+        self._wakeup = multio.Event()
+        self._task = None
+
+    def __repr__(self):
+        return "<GuildChunker pending={} in_flight={}>".format(len(self._pending),
+                                                               len(self._in_flight))
+
+    def progress(self, guild_id: int) -> typing.Union[ChunkProgress, None]:
+        """
+        :param guild_id: The ID of the guild.
+        :return: The :class:`.ChunkProgress` of the guild, or None if it is not being chunked.
+        """
+        return self._pending.get(guild_id) or self._in_flight.get(guild_id)
+
+    def stats(self) -> dict:
+        """
+        :return: A dict of statistics about this chunker.
+        """
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "requests_in_flight": len(self._batches),
+            "completed": self.completed,
+            "retried": self.retried,
+            "gave_up": self.gave_up,
+        }
+
+    async def add(self, guild: 'dt_guild.Guild') -> None:
+        """
+        Adds a guild to be chunked.
+
+        :param guild: The :class:`~.Guild` to chunk.
+        """
+        if self.progress(guild.id) is not None:
+            return
+
+        guild.start_chunking()
+        self._pending[guild.id] = ChunkProgress(guild, max(guild._chunks_left, 1))
+        self.gw.metrics.chunking_started(guild.id)
+
+        if self._idle.is_set():
+            self._idle.clear()
+
+        await self._ensure_running()
+        await self._wakeup.set()
+
+    async def flush(self) -> None:
+        """
+        Requests every pending guild, without waiting for full batches. Guilds added after this
+        are requested straight away.
+        """
+        self._eager = True
+        await self._ensure_running()
+        await self._wakeup.set()
+
+    async def reset(self) -> None:
+        """
+        Forgets every pending and in flight guild. This is used when a session is invalidated,
+        as the new session streams every guild in again.
+
+        Anything waiting on the chunker, or on one of the forgotten guilds, is woken up.
+        """
+        dropped = list(self._pending.values()) + list(self._in_flight.values())
+        self._pending.clear()
+        self._in_flight.clear()
+        self._batches.clear()
+        self._eager = False
+
+        for progress in dropped:
+            await progress.guild._finished_chunking.set()
+
+        await self._idle.set()
+
+    def owns_nonce(self, nonce: str) -> bool:
+        """
+        :param nonce: The nonce of a member chunk.
+        :return: If the chunk is for a request made by a chunker.
+        """
+        return nonce.startswith(self.NONCE_PREFIX)
+
+    async def request_sent(self, nonce: str) -> None:
+        """
+        Starts the timeout of the guilds in a request, once the send queue has sent it.
+
+        :param nonce: The nonce of the request.
+        """
+        now = time.monotonic()
+        for progress in self._in_flight.values():
+            if progress.nonce == nonce:
+                progress.last_activity = now
+
+    async def chunk_received(self, guild: 'dt_guild.Guild',
+                             chunk_count: int = None, nonce: str = None) -> bool:
+        """
+        Records a member chunk.
+
+        :param guild: The :class:`~.Guild` the chunk was for.
+        :param chunk_count: The total number of chunks for the request, if Discord sent it.
+        :param nonce: The nonce of the request the chunk is for, if any.
+        :return: True if the guild now has all of its members.
+        """
+        if nonce is None:
+            if self.progress(guild.id) is not None:
+                # the chunker requests this guild itself, so only its own chunks count
+                return False
+
+            # requested outside of the chunker
+            if guild._chunks_left > 0 or guild._finished_chunking.is_set():
+                return False
+
+            await guild._finished_chunking.set()
+            return True
+
+        progress = self._in_flight.get(guild.id)
+        if progress is None or progress.nonce != nonce:
+            # a late chunk of a request that timed out, or that was forgotten by a reset
+            return False
+
+        # the guilds of a request are sent one after another, so the request is still going
+        now = time.monotonic()
+        for guild_id in progress.batch:
+            self._in_flight[guild_id].last_activity = now
+
+        progress.received += 1
+        if chunk_count is not None:
+            progress.expected = chunk_count
+
+        if progress.received < progress.expected:
+            return False
+
+        self.completed += 1
+        await self._finish(progress)
+        return True
+
+    async def wait_for_guild(self, guild: 'dt_guild.Guild') -> None:
+        """
+        Waits until a guild has all of its members, or has been given up on.
+
+        :param guild: The :class:`~.Guild` to wait for.
+        """
+        await guild._finished_chunking.wait()
+
+    async def wait(self) -> None:
+        """
+        Waits until every guild added to this chunker has finished.
+        """
+        if not self._pending and not self._in_flight:
+            return
+
+        await self._idle.wait()
+
+    async def _finish(self, progress: ChunkProgress):
+        """
+        Stops tracking a guild, and wakes anything waiting on it.
+        """
+        guild_id = progress.guild.id
+        self._in_flight.pop(guild_id, None)
+        self._pending.pop(guild_id, None)
+        self._release(progress)
+
+        self.gw.metrics.chunking_finished(guild_id)
+        await progress.guild._finished_chunking.set()
+
+        if not self._pending and not self._in_flight:
+            await self._idle.set()
+
+        # a request slot may have been freed
+        await self._wakeup.set()
+
+    def _release(self, progress: ChunkProgress):
+        """
+        Removes a guild from the request it was sent in.
+        """
+        if progress.batch is None:
+            return
+
+        progress.batch.discard(progress.guild.id)
+        if not progress.batch:
+            self._batches.remove(progress.batch)
+
+        progress.batch = None
+        progress.nonce = None
+
+    async def _request_batches(self):
+        """
+        Sends as many requests as the in flight limit allows.
+        """
+        while self._pending and len(self._batches) < self.max_in_flight:
+            if len(self._pending) < self.batch_size and not self._eager:
+                return
+
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[1])
+
+            nonce = "{}{}".format(self.NONCE_PREFIX, next(self._nonces))
+            ids = set()
+            for progress in batch:
+                progress.attempts += 1
+                progress.received = 0
+                # the timeout starts once the send queue has sent the request
+                progress.last_activity = None
+                progress.batch = ids
+                progress.nonce = nonce
+                ids.add(progress.guild.id)
+                self._in_flight[progress.guild.id] = progress
+
+            self._batches.append(ids)
+            logger.info("Requesting members for {} guild(s) on shard {}"
+                        .format(len(batch), self.gw.shard_id))
+            await self.gw.request_chunks([progress.guild for progress in batch], nonce=nonce)
+
+    async def _check_timeouts(self):
+        """
+        Re-requests guilds that have stopped receiving chunks.
+        """
+        cutoff = time.monotonic() - self.timeout
+        for progress in list(self._in_flight.values()):
+            if progress.last_activity is None or progress.last_activity > cutoff:
+                continue
+
+            guild = progress.guild
+            if progress.attempts > self.max_retries:
+                logger.warning("Guild {} on shard {} only received {}/{} member chunks, "
+                               "giving up".format(guild.id, self.gw.shard_id, progress.received,
+                                                  progress.expected))
+                self.gave_up += 1
+                await self._finish(progress)
+                await self._dispatch_available(guild)
+                continue
+
+            logger.info("Member chunks for guild {} on shard {} timed out, re-requesting"
+                        .format(guild.id, self.gw.shard_id))
+            self.retried += 1
+            del self._in_flight[guild.id]
+            self._release(progress)
+            self._pending[guild.id] = progress
+            self._pending.move_to_end(guild.id, last=False)
+
+    async def _dispatch_available(self, guild: 'dt_guild.Guild'):
+        """
+        Fires the events a finished guild would have fired, for a guild that was given up on.
+        """
+        client = self.gw.state.client
+        events = [("guild_available", guild)]
+        events += await coerce_agen(self.gw.state._check_ready(self.gw, guild))
+        for event in events:
+            await client.events.fire_event(event[0], *event[1:], gateway=self.gw, client=client)
+
+    async def _ensure_running(self):
+        if self._task is None:
+            self._task = await curio.spawn(self._run(), daemon=True)
+
+    async def _run(self):
+        """
+        Sends requests and checks for timeouts forever.
+        """
+        while True:
+            self._wakeup.clear()
+
+            try:
+                await self._request_batches()
+                await self._check_timeouts()
+            except Exception:
+                logger.exception("Error in the member chunker for shard {}"
+                                 .format(self.gw.shard_id))
+
+            if not self._pending and not self._in_flight:
+                await self._wakeup.wait()
+                continue
+
+            try:
+                await multio.asynclib.timeout_after(self.CHECK_INTERVAL, self._wakeup.wait())
+            except multio.asynclib.TaskTimeout:
+                pass
@@ -18,9 +18,15 @@ import multio
 from asyncwebsockets import WebsocketClosed
 from asyncwebsockets.common import WebsocketUnusable
 
+from curious.core.cache import MemberCachePolicy
 from curious.core.event import EventContext, EventManager, event as ev_dec
-from curious.core.gateway import ChunkGuilds, Gateway, ReconnectWebsocket
+from curious.core.gateway import DispatchFilter, Gateway, ReconnectWebsocket
 from curious.core.httpclient import HTTPClient
+from curious.core.identify import IdentifyScheduler
+from curious.core.metrics import to_prometheus
+from curious.core.reconnect import CloseAction, ReconnectPolicy, ShardHealth
+from curious.core.recorder import GatewayRecorder
+from curious.core.sessions import SessionStore
 from curious.dataclasses import channel as dt_channel, guild as dt_guild, member as dt_member
 from curious.dataclasses.appinfo import AppInfo
 from curious.dataclasses.invite import Invite
@@ -91,11 +97,36 @@ class Client(object):
 
     def __init__(self, token: str, *,
                  state_klass: type = None,
-                 bot_type: int = (BotType.BOT | BotType.ONLY_USER)):
+                 bot_type: int = (BotType.BOT | BotType.ONLY_USER),
+                 compress: str = None,
+                 codec: str = None,
+                 dispatch_filter: DispatchFilter = None,
+                 session_store: SessionStore = None,
+                 recorder: GatewayRecorder = None,
+                 reconnect_policy: ReconnectPolicy = None,
+                 member_cache_policy: MemberCachePolicy = None,
+                 snapshot_path: str = None,
+                 offload_threshold: int = None):
         """
         :param token: The current token for this bot.
         :param state_klass: The class to construct the connection state from.
         :param bot_type: A union of :class:`~.BotType` that defines the type of this bot.
+        :param compress: The transport compression to use for gateways. \
+            See :class:`~.Gateway`.
+        :param codec: The name of the :class:`~.Codec` used to encode and decode gateway payloads.
+        :param dispatch_filter: A :class:`~.DispatchFilter` used to drop unwanted dispatches on \
+            every gateway.
+        :param session_store: A :class:`~.SessionStore` used to persist gateway sessions, so \
+            that shards can RESUME after the process restarts.
+        :param recorder: A :class:`~.GatewayRecorder` to record all gateway traffic to.
+        :param reconnect_policy: The :class:`~.ReconnectPolicy` that decides how shards \
+            reconnect. Defaults to a new policy.
+        :param member_cache_policy: The :class:`~.MemberCachePolicy` that decides which guild \
+            members are cached. Defaults to caching every member.
+        :param snapshot_path: The path of a state snapshot, which is loaded when the client \
+            starts and saved when it stops. See :mod:`curious.core.snapshot`.
+        :param offload_threshold: The number of members in a guild or member chunk payload at \
+            which its objects are created in a worker thread, instead of on the event loop.
         """
         #: The mapping of `shard_id -> gateway` objects.
         self._gateways = {}
@@ -112,6 +143,10 @@ class Client(object):
 
         #: The current connection state for the bot.
         self.state = state_klass(self)
+        if member_cache_policy is not None:
+            self.state.member_cache_policy = member_cache_policy
+        if offload_threshold is not None:
+            self.state.offload_threshold = offload_threshold
 
         #: The bot type for this bot.
         self.bot_type = bot_type
@@ -129,6 +164,40 @@ class Client(object):
         #: The cached gateway URL.
         self._gw_url = None  # type: str
 
+        #: The transport compression used for new gateways.
+        self._compress = compress
+
+        #: The codec name used for new gateways.
+        self._codec = codec
+
+        #: The :class:`~.DispatchFilter` shared between all gateways.
+        self.dispatch_filter = dispatch_filter
+
+        #: The :class:`~.IdentifyScheduler` that paces IDENTIFYs across all shards.
+        self.identify_scheduler = IdentifyScheduler()
+
+        #: The :class:`~.SessionStore` used to persist gateway sessions, if any.
+        self.session_store = session_store
+
+        #: The :class:`~.GatewayRecorder` that gateway traffic is recorded to, if any.
+        self.recorder = recorder
+
+        #: The :class:`~.ReconnectPolicy` that decides how shards reconnect.
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy()
+
+        #: The path of the state snapshot, if any.
+        self.snapshot_path = snapshot_path
+
+        #: The mapping of `shard_id -> health`.
+        self._shard_health = {}  # type: typing.Dict[int, ShardHealth]
+
+        #: The :class:`~.ClusterClient` connecting this client to its cluster, if it is running
+        #: as a worker of a :class:`~.ClusterLauncher`.
+        self.cluster = None
+
+        #: The ``session_start_limit`` returned by Discord, if it has been fetched.
+        self.session_start_limit = None  # type: dict
+
         #: The application info for this bot. Instance of :class:`~.AppInfo`.
         #: This will be None for user bots.
         self.application_info = None  # type: AppInfo
@@ -182,6 +251,18 @@ class Client(object):
 
         return c
 
+    def metrics_snapshot(self) -> typing.Dict[int, dict]:
+        """
+        :return: A mapping of shard ID -> :meth:`.GatewayMetrics.snapshot` for every shard.
+        """
+        return {shard_id: gw.metrics.snapshot() for shard_id, gw in self._gateways.items()}
+
+    def metrics_prometheus(self) -> str:
+        """
+        :return: The metrics of every shard, in the Prometheus text format.
+        """
+        return to_prometheus(gw.metrics for gw in self._gateways.values())
+
     @property
     def gateways(self):
         """
@@ -189,6 +270,21 @@ class Client(object):
         """
         return MappingProxyType(self._gateways)
 
+    @property
+    def shard_health(self) -> 'typing.Mapping[int, ShardHealth]':
+        """
+        :return: A read-only mapping of shard ID -> :class:`~.ShardHealth` for every shard.
+        """
+        return MappingProxyType(self._shard_health)
+
+    def _set_health(self, shard_id: int, health: ShardHealth) -> None:
+        """
+        Updates the health of a shard.
+        """
+        if self._shard_health.get(shard_id) is not health:
+            logger.debug("Shard {} is now {}".format(shard_id, health.value))
+            self._shard_health[shard_id] = health
+
     def find_channel(self, channel_id: int):
         """
         Finds a channel by channel ID.
@@ -209,10 +305,26 @@ class Client(object):
         """
         :return: The shard count recommended for this bot.
         """
-        gw, shards = await self.http.get_shard_count()
-        self._gw_url = gw
+        data = await self.http.get_gateway_bot()
+        self._gw_url = data["url"]
+        self._update_session_start_limit(data.get("session_start_limit"))
+
+        return data["shards"]
+
+    def _update_session_start_limit(self, limit: dict):
+        """
+        Updates the IDENTIFY concurrency from a ``session_start_limit``.
+
+        :param limit: The ``session_start_limit`` object from ``/gateway/bot``.
+        """
+        if not limit:
+            return
 
-        return shards
+        self.session_start_limit = limit
+        self.identify_scheduler.max_concurrency = limit.get("max_concurrency", 1)
+        logger.info("Session start limit: {}/{} remaining, max concurrency {}"
+                    .format(limit.get("remaining"), limit.get("total"),
+                            self.identify_scheduler.max_concurrency))
 
     def guilds_for(self, shard_id: int) -> 'typing.Iterable[dt_guild.Guild]':
         """
@@ -517,11 +629,14 @@ class Client(object):
             # download all of the members
             members = await self.download_guild_members(guild_id=guild_id, get_all=True)
             # update the `_members` dict
-            guild._members = {m.id: m for m in members}
+            guild._members.clear()
+            guild._members.update((m.id, m) for m in members)
+            guild._name_index = None
 
             # download all of the channels
             channels = await self.download_channels(guild_id=guild_id)
             guild._channels = {c.id: c for c in channels}
+            self.state._guilds.index_guild(guild)
 
         return guild
 
@@ -530,38 +645,36 @@ class Client(object):
         Handles dispatches for the client.
         """
         try:
-            handle_name = name.lower()
-            handler = getattr(self.state, f"handle_{handle_name}")
-        except AttributeError:
-            logger.warning(f"Got unknown dispatch {name}")
+            handler, is_agen = self.state._dispatch_table[name]
+        except KeyError:
+            logger.warning("Got unknown dispatch {}".format(name))
             return
-        else:
-            logger.debug(f"Processing event {name}")
 
-        try:
-            result = handler(ctx.gateway, dispatch)
+        if self.state._parsing and isinstance(dispatch, dict):
+            guild_id = dispatch.get("guild_id")
+            if guild_id is None and name in ("GUILD_UPDATE", "GUILD_DELETE"):
+                guild_id = dispatch.get("id")
 
-            if inspect.isawaitable(result):
-                result = await result
-            elif inspect.isasyncgen(result):
-                async with multio.finalize_agen(result) as gen:
-                    async for i in gen:
-                        await self.events.fire_event(i[0], *i[1:], gateway=ctx.gateway, client=self)
+            if guild_id is not None:
+                # the guild is being created in a worker thread, so wait for it to be stored
+                await self.state._wait_for_parse(int(guild_id))
+
+        gw = ctx.gateway
+        try:
+            if not is_agen:
+                # fast path, for handlers that fire at most one event
+                event = await handler(gw, dispatch)
+                if event is not None:
+                    await self.events.fire_event(event[0], *event[1:], gateway=gw, client=self)
 
-                # no more processing after the async gen
                 return
 
-            if not isinstance(result, tuple):
-                await self.events.fire_event(result, gateway=ctx.gateway, client=self)
-            else:
-                await self.events.fire_event(result[0], *result[1:], gateway=ctx.gateway,
-                                             client=self)
+            async with multio.finalize_agen(handler(gw, dispatch)) as gen:
+                async for event in gen:
+                    await self.events.fire_event(event[0], *event[1:], gateway=gw, client=self)
 
-        # TODO: Change this from being an exception to being an event.
-        except ChunkGuilds:
-            ctx.gateway._get_chunks()
         except Exception:
-            logger.exception(f"Error decoding event {event} with data {dispatch}!")
+            logger.exception(f"Error decoding event {name} with data {dispatch}!")
             await ctx.gateway.close(code=1006, reason="Internal client error")
             raise
 
@@ -573,100 +686,196 @@ class Client(object):
         :param shard_count: The shard count to send in the identify packet.
         """
 
-        total_tries = 0
+        session = None
+        if self.session_store is not None:
+            session = self.session_store.load(shard_id, shard_count)
+            snapshot_session = self.state._snapshot_sessions.pop(shard_id, None)
+            if session is not None and not self.state.guilds_for_shard(shard_id):
+                # a RESUME only replays missed events, so without cached guilds (e.g. from a
+                # snapshot) the guild cache would stay empty
+                logger.info("Found stored session for shard {}, but no cached guilds; "
+                            "sending IDENTIFY instead".format(shard_id))
+                session = None
+            elif session is not None and (snapshot_session is None
+                                          or snapshot_session[0] != session.session_id):
+                # the snapshot is not from this session, so replaying its events on top of the
+                # snapshot would skip or repeat some of them
+                logger.info("Found stored session for shard {}, but the snapshot is not from "
+                            "it; sending IDENTIFY instead".format(shard_id))
+                session = None
+            elif session is not None:
+                # the stored sequence can be older than the snapshot, as saves are throttled
+                session = session._replace(sequence=snapshot_session[1])
+                logger.info("Found stored session for shard {}, attempting to "
+                            "RESUME".format(shard_id))
+
+        policy = self.reconnect_policy
+        gw = None  # type: Gateway
+        resume = False
+        reason = None
+        attempt = 0
         while True:
-            # keep retrying connecting
-            if total_tries == 10:
-                raise RuntimeError(f"Gave up reconnecting shard id {shard_id}")
+            if reason is not None:
+                # spread reconnects out, so that every shard doesn't come back at once
+                if policy.should_give_up(attempt):
+                    self._set_health(shard_id, ShardHealth.FAILED)
+                    raise RuntimeError("Gave up reconnecting shard id {}".format(shard_id))
+
+                delay = policy.delay(attempt)
+                self._set_health(shard_id, ShardHealth.BACKING_OFF)
+                logger.info("Reconnecting shard {} in {:.2f} seconds".format(shard_id, delay))
+                await multio.asynclib.sleep(delay)
+                await policy.wait_for_breaker()
 
             try:
-                gw = await Gateway.from_token(self._token, self.state,
-                                              await self.get_gateway_url(),
-                                              shard_id=shard_id, shard_count=shard_count)
+                if gw is None:
+                    self._set_health(shard_id, ShardHealth.CONNECTING)
+                    gw = await Gateway.from_token(self._token, self.state,
+                                                  await self.get_gateway_url(),
+                                                  shard_id=shard_id, shard_count=shard_count,
+                                                  compress=self._compress, codec=self._codec,
+                                                  dispatch_filter=self.dispatch_filter,
+                                                  identify_scheduler=self.identify_scheduler,
+                                                  session_store=self.session_store,
+                                                  connect_timeout=policy.connect_timeout,
+                                                  session=session)
+                    # only the very first connection can resume a stored session
+                    session = None
+                    self._gateways[shard_id] = gw
+                else:
+                    self._set_health(shard_id,
+                                     ShardHealth.RESUMING if resume else ShardHealth.CONNECTING)
+                    await gw.reconnect(resume=resume, reason=reason)
             except Exception:
-                # give up
-                logger.exception("Failed to connect to the gateway...")
-                total_tries += 1
+                logger.exception("Failed to connect shard {} to the gateway".format(shard_id))
+                policy.record_failure()
+                attempt += 1
+                reason = reason or "connect_failed"
                 continue
-            else:
-                # reset total tries, we made it
-                total_tries = 0
-                self._gateways[shard_id] = gw
 
-            try:
-                try:
-                    # consume events
-                    async with multio.finalize_agen(gw.events()) as agen:
-                        async for event in agen:
-                            await self.fire_event(event[0], *event[1:], gateway=gw)
-
-                except WebsocketClosed as e:
-                    # Try and handle the close.
-                    if e.reason == "Client closed connection":
-                        # internal
-                        return
-
-                    if e.code in [1000, 4007] or gw.session_id is None:
-                        logger.info("Shard {} disconnected with code {}, "
-                                    "creating new session".format(shard_id, e.code))
-
-                        self.state._reset(gw.shard_id)
-                        await gw.reconnect(resume=False)
-                    elif e.code not in (4004, 4011):
-                        # Try and RESUME.
-                        logger.info("Shard {} disconnected with close code {}, reason {}, "
-                                    "attempting a reconnect.".format(shard_id, e.code,
-                                                                     e.reason))
-
-                        await gw.reconnect(resume=True)
-                    else:
-                        raise
-                except ReconnectWebsocket:
-                    # We've been told to reconnect, try and RESUME.
-                    await gw.reconnect(resume=True)
-            except (WebsocketClosed, WebsocketUnusable):
-                # give up and retry.
-                total_tries += 1
-                continue
+            # we made it, so the next failure starts the backoff from scratch
+            attempt = 0
+            self._set_health(shard_id, ShardHealth.CONNECTED)
 
-    async def start(self, shard_count: int):
+            try:
+                # consume events
+                events = gw.events()
+                if self.recorder is not None:
+                    events = self.recorder.wrap(gw, events)
+
+                async with multio.finalize_agen(events) as agen:
+                    async for event in agen:
+                        await self.fire_event(event[0], *event[1:], gateway=gw)
+
+            except WebsocketClosed as e:
+                # Try and handle the close.
+                if e.reason == "Client closed connection":
+                    # internal
+                    self._set_health(shard_id, ShardHealth.STOPPED)
+                    return
+
+                action = policy.classify(e.code)
+                if action is CloseAction.FATAL:
+                    logger.error("Shard {} disconnected with fatal close code {}, reason {}"
+                                 .format(shard_id, e.code, e.reason))
+                    self._set_health(shard_id, ShardHealth.FAILED)
+                    raise
+
+                if e.code != 1000:
+                    policy.record_failure()
+
+                reason = "close_{}".format(e.code)
+                if action is CloseAction.NEW_SESSION or gw.session_id is None:
+                    logger.info("Shard {} disconnected with code {}, "
+                                "creating new session".format(shard_id, e.code))
+
+                    await gw.forget_session()
+                    self.state._reset(gw.shard_id)
+                    resume = False
+                else:
+                    # Try and RESUME.
+                    logger.info("Shard {} disconnected with close code {}, reason {}, "
+                                "attempting a reconnect.".format(shard_id, e.code, e.reason))
+                    resume = True
+
+            except ReconnectWebsocket:
+                # We've been told to reconnect, try and RESUME.
+                reason = "reconnect_requested"
+                resume = True
+
+            except WebsocketUnusable:
+                policy.record_failure()
+                reason = "websocket_unusable"
+                resume = gw.session_id is not None
+
+    async def start(self, shard_count: int, *, shard_ids: typing.Iterable[int] = None):
         """
         Starts the bot.
 
         :param shard_count: The number of shards to boot.
+        :param shard_ids: The IDs of the shards to boot in this process. Defaults to every shard.
         """
+        if shard_ids is None:
+            shard_ids = range(0, shard_count)
+
         if self.bot_type & BotType.BOT:
             self.application_info = AppInfo(self, **(await self.http.get_app_info(None)))
 
-        async with multio.asynclib.task_manager() as tg:
-            self.events.task_manager = tg
+            if self.session_start_limit is None:
+                # not autosharded, but we still need to know how fast we can IDENTIFY
+                data = await self.http.get_gateway_bot()
+                self._gw_url = data["url"]
+                self._update_session_start_limit(data.get("session_start_limit"))
 
-            for shard_id in range(0, shard_count):
-                await tg.spawn(self.handle_shard(shard_id, shard_count))
+        if self.snapshot_path is not None:
+            await self.state.load_snapshot(self.snapshot_path)
 
-    async def run_async(self, *, shard_count: int = 1, autoshard: bool = True):
+        try:
+            # shards are spawned in order, and the scheduler lets them IDENTIFY in the same order
+            async with multio.asynclib.task_manager() as tg:
+                self.events.task_manager = tg
+
+                for shard_id in shard_ids:
+                    await tg.spawn(self.handle_shard(shard_id, shard_count))
+        finally:
+            # the gateways are not closed on shutdown, so the last throttled save can be stale
+            sessions = {}
+            for shard_id, gw in self._gateways.items():
+                gw.save_session()
+                if gw.session_id is not None:
+                    sessions[shard_id] = (gw.session_id, gw.sequence_num)
+
+            if self.snapshot_path is not None:
+                self.state.save_snapshot(self.snapshot_path, sessions=sessions)
+
+    async def run_async(self, *, shard_count: int = 1, autoshard: bool = True,
+                        shard_ids: typing.Iterable[int] = None):
         """
         Runs the client asynchronously.
 
         :param shard_count: The number of shards to boot.
         :param autoshard: If the bot should be autosharded.
+        :param shard_ids: The IDs of the shards to boot in this process. Defaults to every shard.
         """
         if autoshard:
             shard_count = await self.get_shard_count()
 
         self.shard_count = shard_count
-        return await self.start(shard_count)
+        return await self.start(shard_count, shard_ids=shard_ids)
 
-    def run(self, *, shard_count: int = 1, autoshard: bool = True):
+    def run(self, *, shard_count: int = 1, autoshard: bool = True,
+            shard_ids: typing.Iterable[int] = None):
         """
         Convenience method to run the bot with a multio handler.
 
         :param shard_count: The number of shards to use. Ignored if autoshard is True.
         :param autoshard: If the bot should be autosharded.
+        :param shard_ids: The IDs of the shards to boot in this process. Defaults to every shard.
         """
 
         try:
-            p = functools.partial(self.run_async, shard_count=shard_count, autoshard=autoshard)
+            p = functools.partial(self.run_async, shard_count=shard_count, autoshard=autoshard,
+                                  shard_ids=shard_ids)
             multio.run(p)
         except (KeyboardInterrupt, EOFError):
             pass
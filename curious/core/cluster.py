@@ -0,0 +1,493 @@
+"""
+Running shards across several processes.
+
+A single :class:`~.Client` runs every shard inside one event loop, so it can only ever use one
+core. A :class:`.ClusterLauncher` splits the shards of a bot between several worker processes,
+each running its own :class:`~.Client`, and supervises them:
+
+.. code-block:: python3
+
+    def make_client():
+        client = Client("token")
+        # register events, load plugins, etc
+        return client
+
+    if __name__ == "__main__":
+        ClusterLauncher(make_client, "token", workers=4).run()
+
+The launcher process runs a :class:`.Coordinator` on a unix socket. Workers use it to share one
+IDENTIFY schedule, to find out which worker owns a guild, and to collect metrics from every
+worker. Inside a worker, the connection to the coordinator is available as ``client.cluster``.
+
+.. currentmodule:: curious.core.cluster
+"""
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import typing
+
+import curio
+import multio
+from curio.network import open_unix_connection, unix_server
+
+from curious.core import client as md_client
+from curious.core.httpclient import HTTPClient
+from curious.core.identify import IdentifyScheduler
+from curious.core.metrics import to_prometheus
+from curious.exc import ClusterError
+
+logger = logging.getLogger("curious.cluster")
+
+
+def split_shards(shard_count: int, workers: int) -> typing.List[typing.List[int]]:
+    """
+    Splits shards into contiguous ranges, one per worker.
+
+    :param shard_count: The total number of shards.
+    :param workers: The number of workers to split between.
+    :return: A list of shard ID lists, one per worker. Workers with no shards are left out.
+    """
+    workers = max(1, min(workers, shard_count))
+    per_worker, extra = divmod(shard_count, workers)
+
+    ranges = []
+    start = 0
+    for worker_id in range(workers):
+        size = per_worker + (1 if worker_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+
+    return ranges
+
+
+def shard_for_guild(guild_id: int, shard_count: int) -> int:
+    """
+    :param guild_id: The ID of the guild.
+    :param shard_count: The total number of shards.
+    :return: The shard ID that the guild is sent to.
+    """
+    return (guild_id >> 22) % shard_count
+
+
+async def _write_message(stream, lock: multio.Lock, message: dict):
+    data = (json.dumps(message) + "\n").encode("utf-8")
+    async with lock:
+        await stream.write(data)
+
+
+class Coordinator(object):
+    """
+    Coordinates the workers of a cluster, over a unix socket.
+
+    Requests and responses are single lines of JSON. Every request has an ``id`` and an ``op``,
+    and is answered by a response with the same ``id``, and either a ``result`` or an ``error``.
+    """
+
+    def __init__(self, path: str, shard_count: int, *, max_concurrency: int = 1):
+        """
+        :param path: The path of the unix socket to listen on.
+        :param shard_count: The total number of shards in the cluster.
+        :param max_concurrency: The IDENTIFY concurrency of the bot.
+        """
+        #: The path of the unix socket.
+        self.path = path
+
+        #: The total number of shards in the cluster.
+        self.shard_count = shard_count
+
+        #: The :class:`~.IdentifyScheduler` shared by every worker.
+        self.identify_scheduler = IdentifyScheduler(max_concurrency)
+
+        #: A mapping of worker ID -> the shard IDs it runs.
+        self.workers = {}  # type: typing.Dict[int, typing.List[int]]
+
+        #: A mapping of worker ID -> the most recent metric snapshots it pushed.
+        self.metrics = {}  # type: typing.Dict[int, typing.List[dict]]
+
+        self._shard_owners = {}  # type: typing.Dict[int, int]
+
+    def __repr__(self):
+        return "<Coordinator path='{}' workers={}>".format(self.path, len(self.workers))
+
+    def owner_of(self, guild_id: int) -> typing.Tuple[int, typing.Union[int, None]]:
+        """
+        Finds the worker that owns a guild.
+
+        :param guild_id: The ID of the guild.
+        :return: A two-item tuple of (shard ID, worker ID). The worker ID is None if the worker \
+            running that shard has not registered.
+        """
+        shard_id = shard_for_guild(guild_id, self.shard_count)
+        return shard_id, self._shard_owners.get(shard_id)
+
+    def prometheus(self) -> str:
+        """
+        :return: The metrics of every worker, in the Prometheus text format.
+        """
+        return to_prometheus(snap for snaps in self.metrics.values() for snap in snaps)
+
+    async def serve(self):
+        """
+        Serves the coordinator, forever.
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        logger.info("Cluster coordinator listening on {}".format(self.path))
+        await unix_server(self.path, self._handle_connection)
+
+    async def _handle_connection(self, sock, address):
+        stream = sock.as_stream()
+        lock = multio.Lock()
+        # shard ID -> held IDENTIFY slot, released if the worker dies
+        held = {}
+        conn = {"worker_id": None}
+
+        try:
+            async with curio.TaskGroup() as tg:
+                while True:
+                    line = await stream.readline()
+                    if not line:
+                        break
+
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        logger.warning("Dropping malformed cluster request")
+                        continue
+
+                    await tg.spawn(self._handle_request, stream, lock, conn, held, request)
+
+                await tg.cancel_remaining()
+        finally:
+            for slot in held.values():
+                await slot.__aexit__(None, None, None)
+
+            worker_id = conn["worker_id"]
+            if worker_id is not None:
+                logger.warning("Worker {} disconnected from the coordinator".format(worker_id))
+                for shard_id in self.workers.pop(worker_id, []):
+                    if self._shard_owners.get(shard_id) == worker_id:
+                        self._shard_owners.pop(shard_id)
+
+            await stream.close()
+
+    async def _handle_request(self, stream, lock, conn: dict, held: dict, request: dict):
+        try:
+            handler = getattr(self, "_op_{}".format(request["op"]))
+        except (KeyError, AttributeError):
+            response = {"id": request.get("id"), "error": "Unknown op"}
+        else:
+            try:
+                result = await handler(conn, held, **request.get("args", {}))
+            except Exception as e:
+                logger.exception("Error handling cluster request {}".format(request["op"]))
+                response = {"id": request.get("id"), "error": repr(e)}
+            else:
+                response = {"id": request.get("id"), "result": result}
+
+        await _write_message(stream, lock, response)
+
+    # Operations.
+    async def _op_register(self, conn: dict, held: dict, *, worker_id: int, shard_ids: list):
+        conn["worker_id"] = worker_id
+        self.workers[worker_id] = shard_ids
+        for shard_id in shard_ids:
+            self._shard_owners[shard_id] = worker_id
+
+        logger.info("Worker {} registered with shards {}".format(worker_id, shard_ids))
+
+    async def _op_identify_acquire(self, conn: dict, held: dict, *, shard_id: int):
+        slot = self.identify_scheduler.slot(shard_id)
+        await slot.__aenter__()
+        held[shard_id] = slot
+
+    async def _op_identify_release(self, conn: dict, held: dict, *, shard_id: int):
+        slot = held.pop(shard_id, None)
+        if slot is not None:
+            await slot.__aexit__(None, None, None)
+
+    async def _op_guild_owner(self, conn: dict, held: dict, *, guild_id: int):
+        shard_id, worker_id = self.owner_of(guild_id)
+        return {"shard_id": shard_id, "worker_id": worker_id}
+
+    async def _op_push_metrics(self, conn: dict, held: dict, *, snapshots: list):
+        self.metrics[conn["worker_id"]] = snapshots
+
+    async def _op_metrics(self, conn: dict, held: dict):
+        return {str(worker_id): snaps for worker_id, snaps in self.metrics.items()}
+
+    async def _op_identify_stats(self, conn: dict, held: dict):
+        return self.identify_scheduler.stats()
+
+
+class ClusterClient(object):
+    """
+    The connection from a worker to the :class:`.Coordinator`.
+    """
+
+    def __init__(self, path: str, worker_id: int):
+        """
+        :param path: The path of the coordinator's unix socket.
+        :param worker_id: The ID of this worker.
+        """
+        #: The path of the coordinator's unix socket.
+        self.path = path
+
+        #: The ID of this worker.
+        self.worker_id = worker_id
+
+        self._stream = None
+        self._lock = None  # type: multio.Lock
+        self._next_id = 0
+        self._pending = {}  # type: typing.Dict[int, multio.Promise]
+
+    def __repr__(self):
+        return "<ClusterClient worker_id={}>".format(self.worker_id)
+
+    async def connect(self, *, retries: int = 10):
+        """
+        Connects to the coordinator.
+
+        :param retries: The number of times to retry, as the coordinator may still be starting.
+        """
+        for attempt in range(retries):
+            try:
+                sock = await open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await multio.asynclib.sleep(0.5)
+                continue
+            else:
+                break
+        else:
+            raise ClusterError("Could not connect to the coordinator at {}".format(self.path))
+
+        self._stream = sock.as_stream()
+        self._lock = multio.Lock()
+        await curio.spawn(self._read_loop(), daemon=True)
+
+    async def _read_loop(self):
+        while True:
+            line = await self._stream.readline()
+            if not line:
+                break
+
+            response = json.loads(line)
+            promise = self._pending.pop(response.get("id"), None)
+            if promise is not None:
+                await promise.set(response)
+
+        # the coordinator went away, so fail everything waiting on it
+        for promise in self._pending.values():
+            await promise.set({"error": "Coordinator connection lost"})
+        self._pending.clear()
+
+    async def request(self, op: str, **kwargs) -> typing.Any:
+        """
+        Sends a request to the coordinator.
+
+        :param op: The operation to perform.
+        :param kwargs: The arguments of the operation.
+        :return: The result of the operation.
+        """
+        self._next_id += 1
+        request_id = self._next_id
+        self._pending[request_id] = promise = multio.Promise()
+
+        await _write_message(self._stream, self._lock, {"id": request_id, "op": op,
+                                                        "args": kwargs})
+        response = await promise.wait()
+        if "error" in response:
+            raise ClusterError(response["error"])
+
+        return response.get("result")
+
+    async def register(self, shard_ids: typing.List[int]) -> None:
+        """
+        Registers this worker and its shards with the coordinator.
+        """
+        await self.request("register", worker_id=self.worker_id, shard_ids=list(shard_ids))
+
+    async def guild_owner(self, guild_id: int) -> typing.Union[int, None]:
+        """
+        Finds the worker that owns a guild.
+
+        :param guild_id: The ID of the guild.
+        :return: The ID of the worker, or None if that worker is not running.
+        """
+        result = await self.request("guild_owner", guild_id=guild_id)
+        return result["worker_id"]
+
+    async def push_metrics(self, client: 'md_client.Client') -> None:
+        """
+        Pushes the metrics of this worker's gateways to the coordinator.
+
+        :param client: The :class:`~.Client` of this worker.
+        """
+        snapshots = list(client.metrics_snapshot().values())
+        await self.request("push_metrics", snapshots=snapshots)
+
+    async def metrics(self) -> typing.Dict[int, typing.List[dict]]:
+        """
+        :return: A mapping of worker ID -> the metric snapshots of its shards, for every worker.
+        """
+        result = await self.request("metrics")
+        return {int(worker_id): snaps for worker_id, snaps in result.items()}
+
+    async def prometheus(self) -> str:
+        """
+        :return: The metrics of the whole cluster, in the Prometheus text format.
+        """
+        metrics = await self.metrics()
+        return to_prometheus(snap for snaps in metrics.values() for snap in snaps)
+
+
+class _RemoteIdentifySlot(object):
+    def __init__(self, cluster: ClusterClient, shard_id: int):
+        self.cluster = cluster
+        self.shard_id = shard_id
+
+    async def __aenter__(self):
+        await self.cluster.request("identify_acquire", shard_id=self.shard_id)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.cluster.request("identify_release", shard_id=self.shard_id)
+        return False
+
+
+class RemoteIdentifyScheduler(IdentifyScheduler):
+    """
+    An :class:`~.IdentifyScheduler` that gets its IDENTIFY slots from the :class:`.Coordinator`,
+    so that every worker shares the same schedule.
+    """
+
+    def __init__(self, cluster: ClusterClient):
+        super().__init__()
+        self.cluster = cluster
+
+    def slot(self, shard_id: int) -> _RemoteIdentifySlot:
+        return _RemoteIdentifySlot(self.cluster, shard_id)
+
+
+def _run_worker(client_factory: 'typing.Callable[[], md_client.Client]', worker_id: int,
+                shard_ids: typing.List[int], shard_count: int, path: str,
+                metrics_interval: float):
+    """
+    The entry point of a worker process.
+    """
+    client = client_factory()
+
+    async def push_metrics_loop(cluster: ClusterClient):
+        while True:
+            await multio.asynclib.sleep(metrics_interval)
+            try:
+                await cluster.push_metrics(client)
+            except ClusterError:
+                logger.exception("Failed to push metrics to the coordinator")
+
+    async def main():
+        cluster = ClusterClient(path, worker_id)
+        await cluster.connect()
+        await cluster.register(shard_ids)
+
+        client.cluster = cluster
+        client.identify_scheduler = RemoteIdentifyScheduler(cluster)
+        await curio.spawn(push_metrics_loop(cluster), daemon=True)
+
+        await client.run_async(shard_count=shard_count, autoshard=False, shard_ids=shard_ids)
+
+    multio.run(main)
+
+
+class ClusterLauncher(object):
+    """
+    Launches and supervises the worker processes of a cluster.
+    """
+
+    def __init__(self, client_factory: 'typing.Callable[[], md_client.Client]', token: str, *,
+                 workers: int = None, shard_count: int = None, socket_path: str = None,
+                 metrics_interval: float = 15.0, restart_delay: float = 5.0):
+        """
+        :param client_factory: A callable that creates the :class:`~.Client` of a worker. This \
+            is called inside each worker process, so it must be picklable - i.e. a module level \
+            function.
+        :param token: The bot token. This is used to look up the shard count.
+        :param workers: The number of worker processes. Defaults to the number of CPUs.
+        :param shard_count: The total number of shards. Defaults to the recommended count.
+        :param socket_path: The path of the coordinator's unix socket.
+        :param metrics_interval: The number of seconds between each metrics push from a worker.
+        :param restart_delay: The number of seconds to wait before restarting a dead worker.
+        """
+        self.client_factory = client_factory
+        self.token = token
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_count = shard_count
+        self.socket_path = socket_path or os.path.join(
+            tempfile.gettempdir(), "curious-cluster-{}.sock".format(os.getpid())
+        )
+        self.metrics_interval = metrics_interval
+        self.restart_delay = restart_delay
+
+        #: The :class:`.Coordinator` of this cluster, once it has started.
+        self.coordinator = None  # type: Coordinator
+
+    def run(self):
+        """
+        Runs the cluster until interrupted.
+        """
+        try:
+            multio.run(self.run_async)
+        except (KeyboardInterrupt, EOFError):
+            pass
+
+    async def run_async(self):
+        """
+        Runs the cluster asynchronously.
+        """
+        http = HTTPClient(self.token, bot=True)
+        data = await http.get_gateway_bot()
+        shard_count = self.shard_count or data["shards"]
+        max_concurrency = data.get("session_start_limit", {}).get("max_concurrency", 1)
+
+        assignments = split_shards(shard_count, self.workers)
+        logger.info("Starting {} shards across {} workers".format(shard_count, len(assignments)))
+
+        self.coordinator = Coordinator(self.socket_path, shard_count,
+                                       max_concurrency=max_concurrency)
+
+        async with curio.TaskGroup() as tg:
+            await tg.spawn(self.coordinator.serve)
+            for worker_id, shard_ids in enumerate(assignments):
+                await tg.spawn(self._supervise, worker_id, shard_ids, shard_count)
+
+    async def _supervise(self, worker_id: int, shard_ids: typing.List[int], shard_count: int):
+        """
+        Runs a worker process, restarting it if it dies.
+        """
+        ctx = multiprocessing.get_context("spawn")
+        while True:
+            process = ctx.Process(target=_run_worker,
+                                  args=(self.client_factory, worker_id, shard_ids, shard_count,
+                                        self.socket_path, self.metrics_interval),
+                                  name="curious-worker-{}".format(worker_id))
+            process.start()
+            logger.info("Started worker {} (pid {}) with shards {}"
+                        .format(worker_id, process.pid, shard_ids))
+
+            try:
+                await curio.run_in_thread(process.join)
+            except BaseException:
+                process.terminate()
+                raise
+
+            if process.exitcode == 0:
+                logger.info("Worker {} exited cleanly".format(worker_id))
+                return
+
+            logger.error("Worker {} died with exit code {}, restarting in {} seconds"
+                         .format(worker_id, process.exitcode, self.restart_delay))
+            await multio.asynclib.sleep(self.restart_delay)
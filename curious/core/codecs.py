@@ -0,0 +1,281 @@
+"""
+Payload codecs for the gateway.
+
+A codec is responsible for turning gateway frames into dicts, and dicts back into frames.
+Each :class:`~.Gateway` uses its own codec, which can be selected by name:
+
+.. code-block:: python3
+
+    client = Client("token", codec="orjson")
+
+.. currentmodule:: curious.core.codecs
+"""
+import json
+import re
+import time
+import typing
+
+try:
+    import earl
+except ImportError:
+    earl = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#: The type of data that a codec can decode.
+RawData = typing.Union[str, bytes, bytearray, memoryview]
+
+#: The mapping of codec name -> codec class.
+_codecs = {}
+
+# Discord serializes dispatches as ``{"t": ..., "s": ..., "op": 0, "d": ...}``.
+# These only match the very start of the payload, so they can never match a nested key.
+_HEADER_STR = re.compile(r'\s*{\s*"t"\s*:\s*"([A-Z_]+)"\s*,\s*"s"\s*:\s*(\d+)')
+_HEADER_BYTES = re.compile(_HEADER_STR.pattern.encode("ascii"))
+
+
+def register_codec(klass: 'typing.Type[Codec]') -> 'typing.Type[Codec]':
+    """
+    Registers a codec class, so that it can be looked up by name.
+
+    This can be used as a class decorator.
+
+    :param klass: The :class:`.Codec` subclass to register.
+    """
+    _codecs[klass.name] = klass
+    return klass
+
+
+class Codec(object):
+    """
+    The base class for a gateway payload codec.
+    """
+    #: The name of this codec, used for lookups.
+    name = None  # type: str
+
+    #: The gateway ``encoding`` this codec produces. Either ``json`` or ``etf``.
+    encoding = "json"
+
+    @classmethod
+    def available(cls) -> bool:
+        """
+        :return: If the library backing this codec is installed.
+        """
+        return True
+
+    def decode(self, data: RawData) -> dict:
+        """
+        Decodes a single payload.
+
+        :param data: The raw payload. Binary data is decoded without copying it into a str first.
+        :return: The decoded payload.
+        """
+        raise NotImplementedError
+
+    def encode(self, payload: dict) -> typing.Union[str, bytes]:
+        """
+        Encodes a single payload.
+
+        :param payload: The payload to encode.
+        :return: The data to send down the websocket.
+        """
+        raise NotImplementedError
+
+    def sniff(self, data: RawData) -> typing.Union[typing.Tuple[str, int], None]:
+        """
+        Reads the event name and sequence of a dispatch without decoding the whole payload.
+
+        :param data: The raw payload.
+        :return: A two-item tuple of (event name, sequence), or None if this could not be \
+            determined cheaply.
+        """
+        return None
+
+    def __repr__(self):
+        return "<{} name='{}'>".format(type(self).__name__, self.name)
+
+
+class _JSONCodecBase(Codec):
+    """
+    The base class for codecs that decode JSON.
+    """
+
+    def sniff(self, data: RawData) -> typing.Union[typing.Tuple[str, int], None]:
+        if isinstance(data, str):
+            match = _HEADER_STR.match(data)
+            if match is None:
+                return None
+
+            return match.group(1), int(match.group(2))
+
+        match = _HEADER_BYTES.match(data)
+        if match is None:
+            return None
+
+        return match.group(1).decode("ascii"), int(match.group(2))
+
+
+@register_codec
+class JSONCodec(_JSONCodecBase):
+    """
+    A codec using the standard library :mod:`json` module.
+    """
+    name = "json"
+
+    def decode(self, data: RawData) -> dict:
+        # json.loads handles bytes natively, but not memoryviews
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        return json.loads(data)
+
+    def encode(self, payload: dict) -> str:
+        return json.dumps(payload)
+
+
+@register_codec
+class UJSONCodec(_JSONCodecBase):
+    """
+    A codec using :mod:`ujson`.
+    """
+    name = "ujson"
+
+    @classmethod
+    def available(cls) -> bool:
+        return ujson is not None
+
+    def decode(self, data: RawData) -> dict:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        return ujson.loads(data)
+
+    def encode(self, payload: dict) -> str:
+        return ujson.dumps(payload)
+
+
+@register_codec
+class ORJSONCodec(_JSONCodecBase):
+    """
+    A codec using :mod:`orjson`.
+    """
+    name = "orjson"
+
+    @classmethod
+    def available(cls) -> bool:
+        return orjson is not None
+
+    def decode(self, data: RawData) -> dict:
+        # orjson reads bytes, bytearrays and memoryviews directly
+        return orjson.loads(data)
+
+    def encode(self, payload: dict) -> str:
+        # the gateway expects text frames for JSON
+        return orjson.dumps(payload).decode("utf-8")
+
+
+@register_codec
+class ETFCodec(Codec):
+    """
+    A codec using the Erlang Term Format, via :mod:`earl`.
+    """
+    name = "etf"
+    encoding = "etf"
+
+    @classmethod
+    def available(cls) -> bool:
+        return earl is not None
+
+    def decode(self, data: RawData) -> dict:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        return earl.unpack(data, encoding="utf-8", encode_binary_ext=True)
+
+    def encode(self, payload: dict) -> bytes:
+        return earl.pack(payload)
+
+
+def available_codecs() -> typing.List[str]:
+    """
+    :return: A list of the names of codecs that can be used in this environment.
+    """
+    return [name for name, klass in _codecs.items() if klass.available()]
+
+
+def get_codec(codec: typing.Union[str, Codec, None] = None) -> Codec:
+    """
+    Gets a codec.
+
+    :param codec: The name of the codec to get, or a :class:`.Codec` instance to pass through. \
+        If this is None, the default codec is returned.
+    :return: A :class:`.Codec` instance.
+    """
+    if codec is None:
+        return default_codec()
+
+    if isinstance(codec, Codec):
+        return codec
+
+    try:
+        klass = _codecs[codec]
+    except KeyError:
+        raise ValueError("Unknown codec: {}".format(codec)) from None
+
+    if not klass.available():
+        raise ValueError("Codec {} is not available - is the library installed?".format(codec))
+
+    return klass()
+
+
+def default_codec() -> Codec:
+    """
+    Gets the default codec.
+
+    This prefers ETF, then ujson, then the standard library json.
+    """
+    for name in ("etf", "ujson", "json"):
+        if _codecs[name].available():
+            return _codecs[name]()
+
+
+def benchmark(payloads: 'typing.Dict[str, dict]', *,
+              codecs: typing.List[str] = None,
+              iterations: int = 100) -> 'typing.Dict[str, typing.Dict[str, float]]':
+    """
+    Benchmarks codecs against a set of payloads.
+
+    :param payloads: A mapping of payload name -> payload to benchmark with.
+    :param codecs: The names of the codecs to benchmark. Defaults to all available codecs.
+    :param iterations: The number of times to decode each payload.
+    :return: A mapping of codec name -> payload name -> mean decode time, in seconds.
+    """
+    if codecs is None:
+        codecs = available_codecs()
+
+    results = {}
+    for name in codecs:
+        codec = get_codec(name)
+        results[name] = timings = {}
+
+        for payload_name, payload in payloads.items():
+            encoded = codec.encode(payload)
+            # the gateway hands us bytes, not str
+            if isinstance(encoded, str):
+                encoded = encoded.encode("utf-8")
+
+            before = time.perf_counter()
+            for _ in range(iterations):
+                codec.decode(encoded)
+
+            timings[payload_name] = (time.perf_counter() - before) / iterations
+
+    return results
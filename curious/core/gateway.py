@@ -7,7 +7,6 @@ import collections
 import enum
 import logging
 import sys
-import threading
 import time
 import typing
 import zlib
@@ -16,38 +15,17 @@ import curio
 import multio
 from asyncwebsockets import Websocket, WebsocketBytesMessage, WebsocketClosed, connect_websocket
 from asyncwebsockets.common import WebsocketUnusable
-from curio.thread import AWAIT, async_thread
 
-try:
-    # Prefer ETF data.
-    import earl
-    _fmt = "etf"
+from curious.core.chunker import GuildChunker
+from curious.core.codecs import Codec, get_codec
+from curious.core.identify import IdentifyScheduler
+from curious.core.metrics import GatewayMetrics
+from curious.core.sendqueue import GatewaySendQueue, Lane
+from curious.core.sessions import SavedSession, SessionStore
+from curious.dataclasses.presence import Game, Presence, Status
 
-
-    def _loader(data: bytes):
-        return earl.unpack(data, encoding="utf-8", encode_binary_ext=True)
-
-
-    def _dumper(data: dict):
-        return earl.pack(data)
-
-except ImportError:
-    try:
-        import ujson as json
-    except ImportError:
-        import json
-    finally:
-        _fmt = "json"
-
-
-    def _loader(data: str):
-        return json.loads(data)
-
-
-    def _dumper(data: dict):
-        return json.dumps(data)
-
-from curious.dataclasses.presence import Game, Status
+#: The suffix that marks the end of a complete payload when using ``zlib-stream`` compression.
+ZLIB_SUFFIX = b"\x00\x00\xff\xff"
 
 
 # Signalling exceptions.
@@ -57,12 +35,6 @@ class ReconnectWebsocket(Exception):
     """
 
 
-class ChunkGuilds(Exception):
-    """
-    Signals that we need to begin downloading all guild member chunks.
-    """
-
-
 class GatewayOp(enum.IntEnum):
     DISPATCH = 0
     HEARTBEAT = 1
@@ -79,7 +51,78 @@ class GatewayOp(enum.IntEnum):
     GUILD_SYNC = 12
 
 
+class DispatchFilter(object):
+    """
+    Filters the dispatches that a gateway processes.
+
+    Dispatches that are filtered out are dropped as early as possible - for JSON codecs, before
+    the payload is even decoded - and never reach the :class:`~.State` or any events.
+
+    The dispatches in :attr:`.REQUIRED` maintain the guild, channel, role, member and emoji
+    caches that other dispatches are built from, so they are never filtered out. Anything else
+    that is dropped (presences, for example) leaves the matching part of the cache stale.
+
+    .. code-block:: python3
+
+        # only process messages (and the dispatches that keep the caches consistent)
+        client = Client("token", dispatch_filter=DispatchFilter(allow=["MESSAGE_CREATE"]))
+
+        # process everything except presences and typing
+        client = Client("token", dispatch_filter=DispatchFilter(deny=["PRESENCE_UPDATE",
+                                                                       "TYPING_START"]))
+    """
+    #: The dispatches that are always processed, as the caches cannot be kept consistent without
+    #: them.
+    REQUIRED = frozenset({
+        "READY", "RESUMED",
+        "GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE", "GUILD_MEMBERS_CHUNK", "GUILD_SYNC",
+        "GUILD_EMOJIS_UPDATE",
+        "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+        "GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE",
+        "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE",
+        "VOICE_SERVER_UPDATE", "VOICE_STATE_UPDATE",
+    })
+
+    def __init__(self, *,
+                 allow: typing.Iterable[str] = None, deny: typing.Iterable[str] = None):
+        """
+        :param allow: The dispatch names to allow. All others are dropped.
+        :param deny: The dispatch names to drop. All others are allowed.
+        """
+        if (allow is None) == (deny is None):
+            raise ValueError("Exactly one of allow or deny must be passed")
+
+        #: The set of allowed dispatch names, if this is an allow-list.
+        self.allow = None  # type: typing.FrozenSet[str]
+        #: The set of denied dispatch names, if this is a deny-list.
+        self.deny = None  # type: typing.FrozenSet[str]
+
+        if allow is not None:
+            self.allow = frozenset(name.upper() for name in allow) | self.REQUIRED
+        else:
+            self.deny = frozenset(name.upper() for name in deny) - self.REQUIRED
+
+        #: A :class:`collections.Counter` of dispatches that have been dropped.
+        self.dropped = collections.Counter()
+
+    def __contains__(self, name: str) -> bool:
+        if self.allow is not None:
+            return name in self.allow
+
+        return name not in self.deny
+
+    def __repr__(self):
+        if self.allow is not None:
+            return "<DispatchFilter allow={}>".format(sorted(self.allow))
+
+        return "<DispatchFilter deny={}>".format(sorted(self.deny))
+
+
 class HeartbeatStats:
+    """
+    Statistics about the heartbeats of a gateway connection.
+    """
+
     def __init__(self):
         self.heartbeats = 0
         self.heartbeat_acks = 0
@@ -87,37 +130,110 @@ class HeartbeatStats:
         self.last_heartbeat = None
         self.last_ack = None
 
+        #: The number of heartbeats in a row that have not been ACKed.
+        self.missed_acks = 0
+
+        #: The round trip times of the most recent heartbeats, in seconds.
+        self.latencies = collections.deque(maxlen=16)  # type: typing.Deque[float]
+
+    def reset(self) -> None:
+        """
+        Resets the per-connection counters, for a new connection.
+        """
+        self.heartbeats = 0
+        self.heartbeat_acks = 0
+        self.last_heartbeat = None
+        self.last_ack = None
+        self.missed_acks = 0
+
+    def heartbeat_sent(self) -> None:
+        """
+        Records that a heartbeat was sent.
+        """
+        if self.last_heartbeat is not None and not self.acked:
+            self.missed_acks += 1
+
+        self.heartbeats += 1
+        self.last_heartbeat = time.monotonic()
+
+    def ack_received(self) -> None:
+        """
+        Records that a heartbeat ACK was received.
+        """
+        self.heartbeat_acks += 1
+        self.last_ack = time.monotonic()
+        self.missed_acks = 0
+
+        if self.last_heartbeat is not None:
+            self.latencies.append(self.last_ack - self.last_heartbeat)
+
+    @property
+    def acked(self) -> bool:
+        """
+        :return: If the most recent heartbeat has been ACKed.
+        """
+        if self.last_heartbeat is None:
+            return True
+
+        return self.last_ack is not None and self.last_ack >= self.last_heartbeat
+
     @property
-    def gw_time(self) -> float:
+    def gw_time(self) -> typing.Union[float, None]:
         """
-        :return: The time the most recent heartbeat and heartbeat_ack.
+        :return: The time the most recent heartbeat and heartbeat_ack, or None if either has not \
+            happened on this connection.
         """
+        if self.last_heartbeat is None or self.last_ack is None:
+            return None
+
         return self.last_ack - self.last_heartbeat
 
+    @property
+    def latency(self) -> typing.Union[float, None]:
+        """
+        :return: The mean round trip time of the most recent heartbeats, or None if no \
+            heartbeats have been ACKed yet.
+        """
+        if not self.latencies:
+            return None
+
+        return sum(self.latencies) / len(self.latencies)
 
-@async_thread(daemon=True)
-def _heartbeat_loop(gw: 'Gateway', heartbeat_interval: float):
+
+async def _heartbeat_loop(gw: 'Gateway', heartbeat_interval: float, stop: multio.Event):
     """
     Heartbeat looper that loops and sends heartbeats to the gateway.
 
+    This runs as a regular task on the event loop, so it does not need a thread per shard.
+
     :param gw: The gateway to handle.
+    :param heartbeat_interval: The number of seconds between each heartbeat.
+    :param stop: The event that is set when this loop should stop.
     """
-    # async threads!
     gw.logger.debug("Sending initial heartbeat.")
-    AWAIT(gw.send_heartbeat())
+    try:
+        await gw.send_heartbeat()
+    except (WebsocketClosed, WebsocketUnusable):
+        return
+
     while True:
-        # this is similar to the normal threaded event waiter
-        # it will time out after heartbeat_interval seconds.
         try:
-            AWAIT(curio.timeout_after(heartbeat_interval, gw._stop_heartbeating.wait()))
-        except curio.TaskTimeout:
+            await multio.asynclib.timeout_after(heartbeat_interval, stop.wait())
+        except multio.asynclib.TaskTimeout:
             pass
         else:
             break
 
+        if gw.hb_stats.missed_acks >= gw.MAX_MISSED_ACKS:
+            # the connection is a zombie, so close it with a non-1000 code to allow a RESUME
+            gw.logger.error("Missed {} heartbeat ACKs, closing connection!"
+                            .format(gw.hb_stats.missed_acks))
+            await gw.close(code=4000, reason="Failed to receive heartbeat ACKs in time")
+            break
+
         try:
-            AWAIT(gw.send_heartbeat())
-        except ReconnectWebsocket:
+            await gw.send_heartbeat()
+        except (WebsocketClosed, WebsocketUnusable):
             break
 
 
@@ -128,11 +244,36 @@ class Gateway(object):
     #: The current gateway version to connect to Discord via.
     GATEWAY_VERSION = 6
 
+    #: The number of heartbeats in a row that can go without an ACK before reconnecting.
+    MAX_MISSED_ACKS = 2
+
+    #: The minimum number of seconds between the session saves made on heartbeats.
+    #: This should stay well under the ``max_age`` of the :class:`~.SessionStore`.
+    SESSION_SAVE_INTERVAL = 120.0
+
     def __init__(self, token: str, connection_state, *,
-                 large_threshold: int = 250):
+                 large_threshold: int = 250,
+                 compress: str = None,
+                 codec: typing.Union[str, Codec] = None,
+                 dispatch_filter: DispatchFilter = None,
+                 identify_scheduler: IdentifyScheduler = None,
+                 session_store: SessionStore = None,
+                 connect_timeout: float = 5.0):
         """
         :param token: The bot token to connect with.
-        """
+        :param compress: The transport compression to use. This can either be ``"zlib-stream"``, \
+            or None to use the legacy per-payload compression.
+        :param codec: The name of the :class:`~.Codec` to use, or a codec instance. \
+            Defaults to :func:`~.default_codec`.
+        :param dispatch_filter: The :class:`.DispatchFilter` used to drop unwanted dispatches.
+        :param identify_scheduler: The :class:`~.IdentifyScheduler` shared between all shards. \
+            If this is None, this gateway paces its own IDENTIFYs.
+        :param session_store: The :class:`~.SessionStore` to persist the session to, if any.
+        :param connect_timeout: The number of seconds to wait for the websocket to connect.
+        """
+        if compress not in (None, "zlib-stream"):
+            raise ValueError("Unknown transport compression: {}".format(compress))
+
         #: The token used to identify with.
         self.token = token
 
@@ -166,19 +307,61 @@ class Gateway(object):
         #: For guilds with members above this number, offline members will not be sent.
         self.large_threshold = min(250, large_threshold)  # bound to 250
 
+        #: The :class:`~.Codec` used to encode and decode payloads.
+        self.codec = get_codec(codec)
+
         #: The data format for this gateway.
-        self.format = _fmt
+        self.format = self.codec.encoding
+
+        #: The :class:`.DispatchFilter` for this gateway, if any.
+        self.dispatch_filter = dispatch_filter
+
+        #: The transport compression for this gateway.
+        #: If this is ``"zlib-stream"``, the whole connection is one zlib stream.
+        self.compress = compress
+
+        #: The :class:`~.IdentifyScheduler` that IDENTIFYs go through.
+        self.identify_scheduler = identify_scheduler or IdentifyScheduler()
+
+        #: The :class:`~.SessionStore` this gateway persists its session to, if any.
+        self.session_store = session_store
+
+        #: If this gateway resumed a session from the :attr:`.session_store` on startup.
+        self.resumed_from_store = False
+        # the (session id, sequence) last saved, and when
+        self._saved_session = None
+        self._saved_session_at = float("-inf")
+
+        #: The number of seconds to wait for the websocket to connect.
+        self.connect_timeout = connect_timeout
+
+        #: The :class:`~.GatewaySendQueue` that paces outbound commands.
+        self.send_queue = GatewaySendQueue(self)
+
+        #: The :class:`~.GatewayMetrics` for this gateway.
+        self.metrics = GatewayMetrics(self.shard_id)
+
+        #: The :class:`~.GuildChunker` that requests the members of large guilds.
+        self.chunker = GuildChunker(self)
 
         self._prev_seq = 0
-        self._dispatches_handled = collections.Counter()
-        self._enqueued_guilds = []
         self._stop_heartbeating = multio.Event()
         self._logger = None
         self._cached_gateway_url = None  # type: str
         self._open = False
+        # set once READY or RESUMED is received; queued commands wait for this
+        self._session_ready = False
         self._close_code = None
         self._close_reason = None
 
+        # zlib-stream state, one per connection
+        self._decompressor = None
+        self._zlib_buffer = bytearray()
+
+    @property
+    def _dispatches_handled(self) -> collections.Counter:
+        return self.metrics.dispatches
+
     @property
     def logger(self):
         if self._logger:
@@ -196,27 +379,40 @@ class Gateway(object):
         """
         self.logger.info("Opening connection to {}".format(url))
         try:
-            self.websocket = await curio.timeout_after(5, connect_websocket(url))
+            self.websocket = await curio.timeout_after(self.connect_timeout,
+                                                       connect_websocket(url))
         except multio.asynclib.TaskTimeout as e:
             raise ReconnectWebsocket from e
         self.logger.info("Connected to gateway!")
         self._open = True
+        self._session_ready = False
+        self._reset_compression()
+
         return self.websocket
 
-    async def _start_heartbeating(self, heartbeat_interval: float) -> threading.Thread:
+    def _reset_compression(self) -> None:
+        """
+        Resets the transport compression state, for a new connection.
+        """
+        # the compression context only lasts as long as the connection
+        if self.compress == "zlib-stream":
+            self._decompressor = zlib.decompressobj()
+            self._zlib_buffer = bytearray()
+
+    async def _start_heartbeating(self, heartbeat_interval: float) -> curio.Task:
         """
-        Starts the heartbeat thread.
+        Starts the heartbeat task.
         :param heartbeat_interval: The number of seconds between each heartbeat.
         """
         if not self._stop_heartbeating.is_set():
-            # cancel some poor thread elsewhere
+            # stop the heartbeat task of the previous connection
             await self._stop_heartbeating.set()
-            del self._stop_heartbeating
 
         self._stop_heartbeating = multio.Event()
 
         # dont reference the task - it'll die by itself
-        task = await curio.spawn(_heartbeat_loop(self, heartbeat_interval), daemon=True)
+        task = await curio.spawn(_heartbeat_loop(self, heartbeat_interval,
+                                                 self._stop_heartbeating), daemon=True)
 
         return task
 
@@ -232,9 +428,58 @@ class Gateway(object):
             await self.websocket.close(code=code, reason=reason)
 
         self._open = False
+        self._session_ready = False
         self._close_code = code
         self._close_reason = reason
         await self._stop_heartbeating.set()
+        self.save_session()
+
+    def save_session(self, *, throttle: bool = False) -> None:
+        """
+        Saves the current session to the :attr:`.session_store`, if there is one.
+
+        Saves within :attr:`.SESSION_SAVE_INTERVAL` seconds of the last one are skipped if the
+        session and sequence have not changed, or if ``throttle`` is True.
+
+        :param throttle: If True, only save if the last save is old enough, as saving blocks \
+            the event loop for stores that write to disk.
+        """
+        if self.session_store is None or self.session_id is None:
+            return
+
+        current = (self.session_id, self.sequence_num)
+        now = time.monotonic()
+        if (throttle or current == self._saved_session) \
+                and now - self._saved_session_at < self.SESSION_SAVE_INTERVAL:
+            return
+
+        self._saved_session = current
+        self._saved_session_at = now
+        session = SavedSession(shard_id=self.shard_id, shard_count=self.shard_count,
+                               session_id=self.session_id, sequence=self.sequence_num,
+                               saved_at=time.time())
+        try:
+            self.session_store.save(session)
+        except Exception:
+            self.logger.exception("Failed to save session")
+
+    async def forget_session(self) -> None:
+        """
+        Forgets the current session, and removes it from the :attr:`.session_store`.
+        """
+        self.session_id = None
+        self.sequence_num = 0
+        self.resumed_from_store = False
+        self._saved_session = None
+        self._saved_session_at = float("-inf")
+        self.send_queue.clear()
+        await self.chunker.reset()
+
+        if self.session_store is not None:
+            try:
+                self.session_store.delete(self.shard_id)
+            except Exception:
+                self.logger.exception("Failed to delete session")
 
     async def _send(self, data: typing.Union[bytes, str]) -> None:
         """
@@ -242,18 +487,31 @@ class Gateway(object):
 
         This will actually send the data down the websocket, unlike `send` which only pretends to.
         """
-        # Check if heartbeats have drifted.
-        if self.hb_stats.heartbeat_acks + 2 < self.hb_stats.heartbeats:
-            self.logger.error("Heartbeats have drifted, closing connection!")
-            await self.close(code=1000, reason="Failed to receive heartbeat ACKs in time")
-            raise ReconnectWebsocket
-
         try:
             await self.websocket.send_message(data)
+            self.metrics.record_send(len(data))
         except WebsocketClosed as e:
             await self.close()
             raise
 
+    def _decompress_stream(self, data: bytes) -> typing.Union[bytes, None]:
+        """
+        Feeds a frame into the ``zlib-stream`` decompressor.
+
+        :param data: The raw frame data.
+        :return: The decompressed payload, or None if the payload is not yet complete.
+        """
+        self._zlib_buffer.extend(data)
+
+        # a payload can be split over multiple frames
+        # so only decompress once we have the flush suffix
+        if len(data) < 4 or data[-4:] != ZLIB_SUFFIX:
+            return None
+
+        decompressed = self._decompressor.decompress(self._zlib_buffer)
+        self._zlib_buffer.clear()
+        return decompressed
+
     def _send_dict(self, payload: dict) -> typing.Coroutine[None, None, None]:
         """
         Sends a dict to be packed down the gateway.
@@ -262,29 +520,36 @@ class Gateway(object):
 
         :param payload: The payload to send.
         """
-        data = _dumper(payload)
+        data = self.codec.encode(payload)
         return self._send(data)
 
     async def send(self, data: typing.Any) -> None:
         """
         Sends a variable type of data down the gateway.
+
+        The data is put onto the :attr:`.send_queue`, so this may return before it is sent.
         """
-        if isinstance(data, dict):
-            await self._send_dict(data)
-        else:
-            await self._send(data)
+        await self.send_queue.put(data, Lane.NORMAL)
 
     # Sending events.
     async def send_identify(self, os: str = sys.platform, browser: str = "curious",
-                            device: str = "curious", compress: bool = True) -> None:
+                            device: str = "curious", compress: bool = None) -> None:
         """
         Sends an IDENTIFY packet.
 
+        This waits for a slot from the :attr:`.identify_scheduler` first, so that shards do not
+        hit the IDENTIFY rate limit.
+
         :param os: The ``$os`` property to send when identifying. Defaults to sys.platform.
         :param browser: The ``$browser`` property to send when identifying. Defaults to ``curious``.
         :param device: The ``$device`` property to send when identifying. Defaults to ``curious``.
-        :param compress: Should the connection be compressed? Defaults to True.
+        :param compress: Should payloads be compressed? Defaults to True, unless transport \
+            compression is enabled.
         """
+        if compress is None:
+            # Discord refuses payload compression on top of transport compression
+            compress = self.compress is None
+
         payload = {
             "op": GatewayOp.IDENTIFY,
             "d": {
@@ -303,7 +568,9 @@ class Gateway(object):
             }
         }
 
-        await self._send_dict(payload)
+        async with self.identify_scheduler.slot(self.shard_id):
+            self.send_queue.bypass()
+            await self._send_dict(payload)
 
     async def send_resume(self) -> None:
         """
@@ -318,6 +585,7 @@ class Gateway(object):
             }
         }
 
+        self.send_queue.bypass()
         await self._send_dict(payload)
 
     async def send_status(self, game: Game, status: Status, *,
@@ -345,15 +613,16 @@ class Gateway(object):
 
         # Update our game() object on all guilds on this shard.
         for guild in self.state.guilds_for_shard(self.shard_id):
-            try:
-                guild.me.presence.game = game
-                guild.me.presence.status = status
-            except AttributeError:
+            me = guild.me
+            if me is None:
                 # sent before our member object exists - i.e just after READY happens
                 # we can ignore this
-                pass
+                continue
 
-        await self._send_dict(payload)
+            guild._set_presence(me.id, Presence(status=status or me.status, game=game), me)
+
+        # only the latest presence is sent, if several are queued
+        await self.send_queue.put(payload, Lane.PRESENCE)
 
     async def send_voice_state_update(self, guild_id: int, channel_id: int) -> None:
         """
@@ -373,7 +642,7 @@ class Gateway(object):
             }
         }
 
-        await self._send_dict(payload)
+        await self.send_queue.put(payload, Lane.VOICE)
 
     async def send_heartbeat(self) -> int:
         """
@@ -382,11 +651,12 @@ class Gateway(object):
         hb = self._get_heartbeat()
         self.logger.debug("Heartbeating with sequence {}".format(hb["d"]))
 
-        # increment the stats
-        self.hb_stats.heartbeats += 1
-        self.hb_stats.last_heartbeat = time.monotonic()
+        self.hb_stats.heartbeat_sent()
 
+        self.send_queue.bypass()
         await self._send_dict(hb)
+        # keep the stored sequence fresh, so a restart can resume from here
+        self.save_session(throttle=True)
         return self.hb_stats.heartbeats
 
     async def send_guild_sync(self, guilds) -> None:
@@ -400,13 +670,14 @@ class Gateway(object):
             "d": [str(g.id) for g in guilds]
         }
 
-        await self._send_dict(payload)
+        await self.send_queue.put(payload, Lane.NORMAL)
 
-    async def request_chunks(self, guilds) -> None:
+    async def request_chunks(self, guilds, *, nonce: str = None) -> None:
         """
         Requests member chunks from a guild.
 
         :param guilds: A list of guild IDs to request chunks for.
+        :param nonce: A nonce that Discord sends back with every chunk of the request.
         """
         payload = {
             "op": GatewayOp.REQUEST_MEMBERS,
@@ -416,12 +687,41 @@ class Gateway(object):
                 "limit": 0  # Request ALL!
             }
         }
+        if nonce is not None:
+            payload["d"]["nonce"] = nonce
+
+        # queued requests without a nonce are merged together into batches
+        await self.send_queue.put(payload, Lane.CHUNK)
+
+    async def query_members(self, guild_id: int, query: str, *, limit: int = 10,
+                            nonce: str = None) -> None:
+        """
+        Requests the members of a guild whose username starts with a query.
+
+        :param guild_id: The ID of the guild to search.
+        :param query: The start of the username to search for.
+        :param limit: The maximum number of members to return.
+        :param nonce: A nonce that Discord sends back with the response, so that it can be told \
+            apart from member chunks.
+        """
+        payload = {
+            "op": GatewayOp.REQUEST_MEMBERS,
+            "d": {
+                "guild_id": str(guild_id),
+                "query": query,
+                "limit": limit
+            }
+        }
+        if nonce is not None:
+            payload["d"]["nonce"] = nonce
 
-        return await self._send_dict(payload)
+        # these can't be merged with other requests, as the query differs
+        await self.send_queue.put(payload, Lane.NORMAL)
 
     @classmethod
     async def from_token(cls, token: str, state, gateway_url: str,
                          *, shard_id: int = 0, shard_count: int = 1,
+                         session: SavedSession = None,
                          **kwargs) -> 'Gateway':
         """
         Creates a new gateway connection from a token.
@@ -432,66 +732,74 @@ class Gateway(object):
         :param gateway_url: The gateway URL to connect.
         :param shard_id: The shard ID of this bot.
         :param shard_count: The number of shards to start the bot with.
+        :param session: A :class:`~.SavedSession` to RESUME instead of sending an IDENTIFY. \
+            If the session is no longer valid, this falls back to an IDENTIFY.
 
         :return: A new :class:`Gateway` that is connected to the API.
         """
         obb = cls(token, state, **kwargs)
-        obb.shard_id = shard_id
+        obb.shard_id = obb.metrics.shard_id = shard_id
         obb.shard_count = shard_count
 
-        gateway_url += "/?v={}&encoding={}".format(cls.GATEWAY_VERSION, _fmt)
+        gateway_url += "/?v={}&encoding={}".format(cls.GATEWAY_VERSION, obb.format)
+        if obb.compress is not None:
+            gateway_url += "&compress={}".format(obb.compress)
         obb._cached_gateway_url = gateway_url
 
         await obb.connect(gateway_url)
 
+        if session is not None:
+            # RESUME the stored session
+            # if discord rejects it, we get an INVALIDATE_SESSION and IDENTIFY instead
+            obb.session_id = session.session_id
+            obb.sequence_num = obb._prev_seq = session.sequence
+            obb.resumed_from_store = True
+            obb.logger.info("Sending RESUME for stored session...")
+            obb.metrics.record_resume("stored_session")
+            await obb.send_resume()
+            return obb
+
         # send IDENTIFY
         obb.logger.info("Sending IDENTIFY...")
+        obb.metrics.record_identify("startup")
         await obb.send_identify()
 
         return obb
 
-    async def reconnect(self, *, resume: bool = False) -> 'Gateway':
+    async def reconnect(self, *, resume: bool = False, reason: str = "unknown") -> 'Gateway':
         """
         Reconnects the bot to the gateway.
 
         :param resume: Should a RESUME be attempted?
+        :param reason: Why the gateway is reconnecting. This is recorded in the :attr:`.metrics`.
         """
         self.logger.info("Reconnecting to the gateway")
+        self.metrics.record_reconnect(reason)
 
         # reset our heartbeat count
-        self.hb_stats.heartbeats = 0
-        self.hb_stats.heartbeat_acks = 0
+        self.hb_stats.reset()
 
         if not self.websocket.closed:
             await self.websocket.close(code=1001, reason="Forcing a reconnect")
 
         self._open = False
+        self._session_ready = False
 
         await self.connect(self._cached_gateway_url)
 
         if resume:
             # Send the RESUME packet, instead of the IDENTIFY packet.
             self.logger.info("Sending RESUME...")
+            self.metrics.record_resume(reason)
             await self.send_resume()
         else:
             self.logger.info("Sending IDENTIFY...")
             self.sequence_num = 0
+            self.metrics.record_identify(reason)
             await self.send_identify()
 
         return self
 
-    async def _get_chunks(self) -> None:
-        """
-        Called to start chunking all guild members.
-        """
-        for guild in self._enqueued_guilds:
-            guild.start_chunking()
-            self.logger.info("Requesting {} member chunk(s) from guild {}."
-                             .format(guild._chunks_left, guild.name))
-
-        await self.request_chunks(self._enqueued_guilds)
-        self._enqueued_guilds.clear()
-
     def _get_heartbeat(self) -> dict:
         return {
             "op": GatewayOp.HEARTBEAT,
@@ -518,11 +826,16 @@ class Gateway(object):
                 raise WebsocketClosed(self._close_code, reason=self._close_reason)
 
             yield ("gateway_message_received", event)
+            self.metrics.record_frame(len(event.data) if event.data is not None else 0)
 
             # decompress the data, if needed
-            if isinstance(event, WebsocketBytesMessage) and _fmt == "json":
+            if isinstance(event, WebsocketBytesMessage) and self.compress == "zlib-stream":
+                data = self._decompress_stream(event.data)
+                if data is None:
+                    # wait for the rest of the payload
+                    continue
+            elif isinstance(event, WebsocketBytesMessage) and self.format == "json":
                 data = zlib.decompress(event.data, 15, 10490000)
-                data = data.decode("utf-8")
             else:
                 data = event.data
 
@@ -530,8 +843,18 @@ class Gateway(object):
             if not data:
                 continue
 
-            # load the event data with our loader
-            event_data = _loader(data)
+            if self.dispatch_filter is not None:
+                header = self.codec.sniff(data)
+                if header is not None and header[0] not in self.dispatch_filter:
+                    # unwanted dispatch, so don't even bother decoding it
+                    self.sequence_num = header[1]
+                    self.dispatch_filter.dropped[header[0]] += 1
+                    continue
+
+            # load the event data with our codec
+            before = time.perf_counter()
+            event_data = self.codec.decode(data)
+            self.metrics.record_payload(len(data), time.perf_counter() - before)
             yield ("gateway_event_received", event_data)
 
             op = event_data.get('op')
@@ -555,8 +878,11 @@ class Gateway(object):
 
             elif op == GatewayOp.HEARTBEAT_ACK:
                 yield "gateway_heartbeat_ack",
-                self.hb_stats.heartbeat_acks += 1
-                self.hb_stats.last_ack = time.monotonic()
+                self.hb_stats.ack_received()
+                # an ACK can arrive after a reconnect reset the stats, with no heartbeat to time
+                gw_time = self.hb_stats.gw_time
+                if gw_time is not None:
+                    self.metrics.heartbeat_rtt.observe(gw_time)
 
             elif op == GatewayOp.HEARTBEAT:
                 # Send a heartbeat back.
@@ -567,27 +893,39 @@ class Gateway(object):
                 # the data sent is if we should resume
                 # if it's non-existent, we assume it's False.
                 should_resume = data or False
+                self._session_ready = False
 
                 yield ("gateway_invalidate_session", should_resume,)
                 if should_resume is True:
                     self.logger.debug("Sending RESUME again")
+                    self.metrics.record_resume("invalid_session")
                     await self.send_resume()
                 else:
                     self.logger.warning("Received INVALIDATE_SESSION with d False, re-identifying.")
-                    self.sequence_num = 0
+                    await self.forget_session()
                     self.state._reset(self.shard_id)
+                    self.metrics.record_identify("invalid_session")
                     await self.send_identify()
 
             elif op == GatewayOp.RECONNECT:
                 # Try and reconnect to the gateway.
                 yield ("gateway_reconnect_received",)
-                self.close()
+                await self.close(code=4000, reason="Reconnect requested")
                 raise ReconnectWebsocket()
 
             elif op == GatewayOp.DISPATCH:
                 # Handle the dispatch.
                 event = event_data.get("t")
-                self._dispatches_handled[event] += 1
+                if self.dispatch_filter is not None and event not in self.dispatch_filter:
+                    # the codec couldn't sniff it, so drop it after decoding
+                    self.dispatch_filter.dropped[event] += 1
+                    continue
+
+                if event in ("READY", "RESUMED"):
+                    # the session is established, so queued commands can go out
+                    self._session_ready = True
+
+                self.metrics.record_dispatch(event)
                 yield ("gateway_dispatch_received", event, data,)
 
             else:
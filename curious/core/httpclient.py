@@ -413,9 +413,19 @@ class HTTPClient(object):
         if not self._is_bot:
             raise Forbidden(None, {"code": 20002, "message": "Only bots can use this endpoint"})
 
-        data = await self.get(Endpoints.GATEWAY_BOT, "gateway")
+        data = await self.get_gateway_bot()
         return data["url"], data["shards"]
 
+    async def get_gateway_bot(self) -> dict:
+        """
+        :return: The full gateway data for this bot, including the ``session_start_limit``.
+        """
+        if not self._is_bot:
+            raise Forbidden(None, {"code": 20002, "message": "Only bots can use this endpoint"})
+
+        data = await self.get(Endpoints.GATEWAY_BOT, "gateway")
+        return data
+
     async def get_this_user(self):
         """
         Gets the current user.
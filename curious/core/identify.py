@@ -0,0 +1,142 @@
+"""
+Scheduling for gateway IDENTIFYs.
+
+Discord only allows a bot to IDENTIFY ``max_concurrency`` shards every 5 seconds, with each shard
+placed into the bucket ``shard_id % max_concurrency``. Identifying any faster than that gets
+the connection closed, so all gateways of a client go through one :class:`.IdentifyScheduler`.
+
+.. currentmodule:: curious.core.identify
+"""
+import collections
+import logging
+import time
+import typing
+
+import multio
+
+logger = logging.getLogger("curious.identify")
+
+
+class _IdentifySlot(object):
+    """
+    An async context manager that holds an IDENTIFY slot for one shard.
+    """
+
+    def __init__(self, scheduler: 'IdentifyScheduler', shard_id: int):
+        self.scheduler = scheduler
+        self.shard_id = shard_id
+        self.bucket = scheduler.bucket_for(shard_id)
+
+    async def __aenter__(self):
+        scheduler = self.scheduler
+        lock = scheduler._locks[self.bucket]
+
+        scheduler._waiting[self.bucket] += 1
+        started = time.monotonic()
+        try:
+            await lock.acquire()
+        finally:
+            scheduler._waiting[self.bucket] -= 1
+
+        try:
+            last = scheduler._last_identify.get(self.bucket)
+            if last is not None:
+                delay = last + scheduler.interval - time.monotonic()
+                if delay > 0:
+                    logger.debug("Shard {} waiting {:.2f}s to IDENTIFY in bucket {}"
+                                 .format(self.shard_id, delay, self.bucket))
+                    await multio.asynclib.sleep(delay)
+        except BaseException:
+            await lock.release()
+            raise
+
+        scheduler.wait_times.append(time.monotonic() - started)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        scheduler = self.scheduler
+        scheduler._last_identify[self.bucket] = time.monotonic()
+        scheduler.identifies += 1
+        await scheduler._locks[self.bucket].release()
+        return False
+
+
+class IdentifyScheduler(object):
+    """
+    Paces IDENTIFYs across every shard of a client.
+
+    .. code-block:: python3
+
+        async with scheduler.slot(gateway.shard_id):
+            await gateway.send_identify()
+
+    Shards waiting on the same bucket are let through in the order they asked, one every
+    :attr:`.interval` seconds.
+    """
+    #: The number of seconds that must pass between two IDENTIFYs in the same bucket.
+    IDENTIFY_INTERVAL = 5.0
+
+    def __init__(self, max_concurrency: int = 1, *, interval: float = IDENTIFY_INTERVAL):
+        """
+        :param max_concurrency: The number of shards that can IDENTIFY at once.
+        :param interval: The number of seconds between IDENTIFYs in the same bucket.
+        """
+        #: The number of shards that can IDENTIFY at once.
+        #: This is updated from the ``session_start_limit`` when the client starts.
+        self.max_concurrency = max_concurrency
+
+        #: The number of seconds between IDENTIFYs in the same bucket.
+        self.interval = interval
+
+        #: The total number of IDENTIFYs that have gone through this scheduler.
+        self.identifies = 0
+
+        #: The most recent time spent waiting for a slot, in seconds.
+        self.wait_times = collections.deque(maxlen=128)  # type: typing.Deque[float]
+
+        self._locks = collections.defaultdict(multio.Lock)
+        self._waiting = collections.Counter()
+        self._last_identify = {}  # type: typing.Dict[int, float]
+
+    def __repr__(self):
+        return "<IdentifyScheduler max_concurrency={} queue_depth={}>".format(
+            self.max_concurrency, self.queue_depth
+        )
+
+    def bucket_for(self, shard_id: int) -> int:
+        """
+        :param shard_id: The shard ID to get the bucket of.
+        :return: The rate limit bucket that the shard IDENTIFYs in.
+        """
+        return shard_id % self.max_concurrency
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        :return: The number of shards currently waiting to IDENTIFY.
+        """
+        return sum(self._waiting.values())
+
+    def slot(self, shard_id: int) -> _IdentifySlot:
+        """
+        Gets an IDENTIFY slot for a shard.
+
+        This returns an async context manager, that waits until the shard is allowed to IDENTIFY
+        on entering. The IDENTIFY should be sent inside the block.
+
+        :param shard_id: The shard ID that is going to IDENTIFY.
+        """
+        return _IdentifySlot(self, shard_id)
+
+    def stats(self) -> dict:
+        """
+        :return: A dict of statistics about this scheduler.
+        """
+        waits = list(self.wait_times)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queue_depth,
+            "waiting": {bucket: count for bucket, count in self._waiting.items() if count},
+            "identifies": self.identifies,
+            "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": max(waits, default=0.0),
+        }
@@ -0,0 +1,363 @@
+"""
+Per-shard gateway metrics.
+
+Each :class:`~.Gateway` records into its own :class:`.GatewayMetrics`, which can be exported as a
+plain dict with :meth:`.GatewayMetrics.snapshot`, or in the Prometheus text format with
+:func:`.to_prometheus`:
+
+.. code-block:: python3
+
+    text = to_prometheus(gw.metrics for gw in client._gateways.values())
+
+.. currentmodule:: curious.core.metrics
+"""
+import bisect
+import collections
+import time
+import typing
+
+#: The default histogram buckets for latencies, in seconds.
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#: The default histogram buckets for payload decode times, in seconds.
+DECODE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+#: The default histogram buckets for guild chunking times, in seconds.
+CHUNK_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram(object):
+    """
+    A fixed bucket histogram.
+    """
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        """
+        :param buckets: The upper bounds of each bucket, in ascending order.
+        """
+        #: The upper bounds of each bucket.
+        self.buckets = tuple(buckets)
+
+        #: The number of observations in each bucket, plus one for everything above the last.
+        self.counts = [0] * (len(self.buckets) + 1)
+
+        #: The sum of every observation.
+        self.sum = 0.0
+
+        #: The number of observations.
+        self.count = 0
+
+    def __repr__(self):
+        return "<Histogram count={} mean={}>".format(self.count, self.mean)
+
+    def observe(self, value: float) -> None:
+        """
+        Records a single observation.
+
+        :param value: The value to record.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self) -> typing.Union[float, None]:
+        """
+        :return: The mean of every observation, or None if there are none.
+        """
+        if not self.count:
+            return None
+
+        return self.sum / self.count
+
+    def cumulative(self) -> typing.List[typing.Tuple[float, int]]:
+        """
+        :return: A list of (upper bound, cumulative count) pairs, ending with infinity.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+    def to_dict(self) -> dict:
+        """
+        :return: A dict representation of this histogram.
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.mean,
+            "buckets": {str(bound): count for bound, count in self.cumulative()}
+        }
+
+
+class GatewayMetrics(object):
+    """
+    Records latency and throughput metrics for a single shard.
+    """
+    #: The number of seconds that dispatch rates are calculated over.
+    RATE_WINDOW = 60
+
+    def __init__(self, shard_id: int = 0):
+        """
+        :param shard_id: The shard ID these metrics are for.
+        """
+        #: The shard ID these metrics are for.
+        self.shard_id = shard_id
+
+        #: The time these metrics started being recorded.
+        self.started_at = time.time()
+
+        #: The round trip time of heartbeats.
+        self.heartbeat_rtt = Histogram(LATENCY_BUCKETS)
+
+        #: The time taken to decode each payload.
+        self.decode_time = Histogram(DECODE_BUCKETS)
+
+        #: The time from a GUILD_CREATE to the guild having all of its members.
+        self.chunk_time = Histogram(CHUNK_BUCKETS)
+
+        #: The number of bytes received, as sent over the wire.
+        #: For text frames, this is the number of characters.
+        self.bytes_in_raw = 0
+        #: The number of bytes received, after decompression.
+        self.bytes_in = 0
+        #: The number of bytes sent.
+        self.bytes_out = 0
+
+        #: The number of frames received.
+        self.frames_in = 0
+        #: The number of payloads sent.
+        self.payloads_out = 0
+
+        #: The number of dispatches handled, per event type.
+        self.dispatches = collections.Counter()
+
+        #: The number of IDENTIFYs sent, per reason.
+        self.identifies = collections.Counter()
+        #: The number of RESUMEs sent, per reason.
+        self.resumes = collections.Counter()
+        #: The number of reconnects, per reason.
+        self.reconnects = collections.Counter()
+
+        # (second, counter) pairs for the last RATE_WINDOW seconds
+        self._rate_buckets = collections.deque(maxlen=self.RATE_WINDOW)
+        # guild id -> time the GUILD_CREATE arrived
+        self._chunk_started = {}
+
+    def __repr__(self):
+        return "<GatewayMetrics shard_id={}>".format(self.shard_id)
+
+    # Recording methods.
+    def record_frame(self, raw_size: int) -> None:
+        """
+        Records a frame received from the websocket.
+
+        :param raw_size: The size of the frame, before decompression.
+        """
+        self.frames_in += 1
+        self.bytes_in_raw += raw_size
+
+    def record_payload(self, size: int, decode_time: float) -> None:
+        """
+        Records a payload that has been decompressed and decoded.
+
+        :param size: The size of the payload, after decompression.
+        :param decode_time: The number of seconds taken to decode the payload.
+        """
+        self.bytes_in += size
+        self.decode_time.observe(decode_time)
+
+    def record_send(self, size: int) -> None:
+        """
+        Records a payload sent down the websocket.
+
+        :param size: The size of the payload.
+        """
+        self.payloads_out += 1
+        self.bytes_out += size
+
+    def record_dispatch(self, event: str) -> None:
+        """
+        Records a dispatch.
+
+        :param event: The event name of the dispatch.
+        """
+        self.dispatches[event] += 1
+
+        second = int(time.monotonic())
+        if not self._rate_buckets or self._rate_buckets[-1][0] != second:
+            self._rate_buckets.append((second, collections.Counter()))
+
+        self._rate_buckets[-1][1][event] += 1
+
+    def record_identify(self, reason: str) -> None:
+        """
+        Records an IDENTIFY.
+
+        :param reason: Why the IDENTIFY was sent.
+        """
+        self.identifies[reason] += 1
+
+    def record_resume(self, reason: str) -> None:
+        """
+        Records a RESUME.
+
+        :param reason: Why the RESUME was sent.
+        """
+        self.resumes[reason] += 1
+
+    def record_reconnect(self, reason: str) -> None:
+        """
+        Records a reconnect.
+
+        :param reason: Why the gateway reconnected.
+        """
+        self.reconnects[reason] += 1
+
+    def chunking_started(self, guild_id: int) -> None:
+        """
+        Records that a guild has been created, and is waiting on its members.
+
+        :param guild_id: The ID of the guild.
+        """
+        self._chunk_started[guild_id] = time.monotonic()
+
+    def chunking_finished(self, guild_id: int) -> None:
+        """
+        Records that a guild has received all of its members.
+
+        :param guild_id: The ID of the guild.
+        """
+        started = self._chunk_started.pop(guild_id, None)
+        if started is not None:
+            self.chunk_time.observe(time.monotonic() - started)
+
+    # Reading methods.
+    def dispatch_rates(self) -> typing.Dict[str, float]:
+        """
+        :return: The number of dispatches per second, per event type, over the last \
+            :attr:`.RATE_WINDOW` seconds.
+        """
+        cutoff = int(time.monotonic()) - self.RATE_WINDOW
+        totals = collections.Counter()
+        for second, counter in self._rate_buckets:
+            if second > cutoff:
+                totals.update(counter)
+
+        return {event: count / self.RATE_WINDOW for event, count in totals.items()}
+
+    def snapshot(self) -> dict:
+        """
+        :return: A dict of every metric.
+        """
+        return {
+            "shard_id": self.shard_id,
+            "uptime": time.time() - self.started_at,
+            "heartbeat_rtt": self.heartbeat_rtt.to_dict(),
+            "decode_time": self.decode_time.to_dict(),
+            "chunk_time": self.chunk_time.to_dict(),
+            "chunks_pending": len(self._chunk_started),
+            "bytes_in_raw": self.bytes_in_raw,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames_in": self.frames_in,
+            "payloads_out": self.payloads_out,
+            "dispatches": dict(self.dispatches),
+            "dispatch_rates": self.dispatch_rates(),
+            "identifies": dict(self.identifies),
+            "resumes": dict(self.resumes),
+            "reconnects": dict(self.reconnects),
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        :return: These metrics, in the Prometheus text format.
+        """
+        return to_prometheus([self])
+
+
+def _labels(**labels) -> str:
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append('{}="{}"'.format(key, value))
+
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_bound(bound: str) -> str:
+    if bound == "inf":
+        return "+Inf"
+
+    return bound
+
+
+def to_prometheus(metrics: 'typing.Iterable[typing.Union[GatewayMetrics, dict]]', *,
+                  prefix: str = "curious_gateway") -> str:
+    """
+    Exports the metrics of several shards in the Prometheus text format.
+
+    :param metrics: An iterable of :class:`.GatewayMetrics`, or of the dicts returned by \
+        :meth:`.GatewayMetrics.snapshot`, to export.
+    :param prefix: The prefix of every metric name.
+    :return: The exported text, ready to be served on a ``/metrics`` endpoint.
+    """
+    # snapshots can come from other processes, so everything is exported from those
+    snapshots = [m.snapshot() if isinstance(m, GatewayMetrics) else m for m in metrics]
+    lines = []
+
+    def family(name: str, kind: str, help: str):
+        lines.append("# HELP {}_{} {}".format(prefix, name, help))
+        lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+
+    def sample(name: str, value, **labels):
+        lines.append("{}_{}{} {}".format(prefix, name, _labels(**labels), value))
+
+    counters = [
+        ("bytes_in_raw_total", "bytes_in_raw", "Bytes received, before decompression."),
+        ("bytes_in_total", "bytes_in", "Bytes received, after decompression."),
+        ("bytes_out_total", "bytes_out", "Bytes sent."),
+        ("frames_in_total", "frames_in", "Websocket frames received."),
+        ("payloads_out_total", "payloads_out", "Payloads sent."),
+    ]
+    for name, key, help in counters:
+        family(name, "counter", help)
+        for snap in snapshots:
+            sample(name, snap[key], shard=snap["shard_id"])
+
+    labelled = [
+        ("dispatches_total", "dispatches", "event", "Dispatches handled."),
+        ("identifies_total", "identifies", "reason", "IDENTIFYs sent."),
+        ("resumes_total", "resumes", "reason", "RESUMEs sent."),
+        ("reconnects_total", "reconnects", "reason", "Reconnects."),
+    ]
+    for name, key, label, help in labelled:
+        family(name, "counter", help)
+        for snap in snapshots:
+            for label_value, value in sorted(snap[key].items()):
+                sample(name, value, shard=snap["shard_id"], **{label: label_value})
+
+    family("dispatch_rate", "gauge", "Dispatches per second over the last minute.")
+    for snap in snapshots:
+        for event, rate in sorted(snap["dispatch_rates"].items()):
+            sample("dispatch_rate", rate, shard=snap["shard_id"], event=event)
+
+    histograms = [
+        ("heartbeat_rtt_seconds", "heartbeat_rtt", "Heartbeat round trip time."),
+        ("decode_seconds", "decode_time", "Time taken to decode a payload."),
+        ("chunk_seconds", "chunk_time", "Time from GUILD_CREATE to all members received."),
+    ]
+    for name, key, help in histograms:
+        family(name, "histogram", help)
+        for snap in snapshots:
+            hist = snap[key]
+            for bound, count in hist["buckets"].items():
+                sample(name + "_bucket", count, shard=snap["shard_id"], le=_format_bound(bound))
+            sample(name + "_sum", hist["sum"], shard=snap["shard_id"])
+            sample(name + "_count", hist["count"], shard=snap["shard_id"])
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,209 @@
+"""
+Reconnect policies for gateway shards.
+
+A :class:`.ReconnectPolicy` decides what a shard does when its connection closes - whether it
+RESUMEs, starts a new session, or gives up - and how long it waits before trying again.
+
+.. code-block:: python3
+
+    policy = ReconnectPolicy(base_delay=2.0, max_delay=120.0)
+    client = Client("token", reconnect_policy=policy)
+
+.. currentmodule:: curious.core.reconnect
+"""
+import collections
+import enum
+import logging
+import random
+import time
+import typing
+
+import multio
+
+logger = logging.getLogger("curious.reconnect")
+
+
+class CloseAction(enum.Enum):
+    """
+    What to do after a gateway connection closes.
+    """
+    #: Reconnect and RESUME the current session.
+    RESUME = "resume"
+
+    #: Reconnect and IDENTIFY a new session.
+    NEW_SESSION = "new_session"
+
+    #: Stop the shard. Reconnecting can never succeed, e.g. because the token is invalid.
+    FATAL = "fatal"
+
+
+class ShardHealth(enum.Enum):
+    """
+    The health of a shard.
+    """
+    #: The shard is opening a new connection.
+    CONNECTING = "connecting"
+
+    #: The shard is connected.
+    CONNECTED = "connected"
+
+    #: The shard is reconnecting to RESUME its session.
+    RESUMING = "resuming"
+
+    #: The shard is waiting before reconnecting.
+    BACKING_OFF = "backing_off"
+
+    #: The shard has given up.
+    FAILED = "failed"
+
+    #: The shard was closed by the client.
+    STOPPED = "stopped"
+
+
+class CircuitBreaker(object):
+    """
+    Stops every shard from reconnecting for a while, when too many connections fail at once.
+
+    When Discord is degraded, every shard disconnects at roughly the same time. Without a breaker,
+    they would all reconnect at once, and keep failing.
+    """
+
+    def __init__(self, threshold: int = 10, window: float = 30.0, cooldown: float = 30.0, *,
+                 spread: float = 10.0):
+        """
+        :param threshold: The number of failures within the window that opens the breaker.
+        :param window: The number of seconds that failures are counted over.
+        :param cooldown: The number of seconds the breaker stays open for.
+        :param spread: The maximum random delay added for each shard after the breaker closes, \
+            so that they do not all reconnect in the same instant.
+        """
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.spread = spread
+
+        #: The number of times this breaker has opened.
+        self.trips = 0
+
+        self._failures = collections.deque()  # type: typing.Deque[float]
+        self._open_until = 0.0
+
+    def __repr__(self):
+        return "<CircuitBreaker open={} trips={}>".format(self.is_open, self.trips)
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :return: If this breaker is open, i.e. shards should not reconnect.
+        """
+        return time.monotonic() < self._open_until
+
+    def record_failure(self) -> None:
+        """
+        Records a failed or dropped connection.
+        """
+        now = time.monotonic()
+        self._failures.append(now)
+        while self._failures and self._failures[0] < now - self.window:
+            self._failures.popleft()
+
+        if len(self._failures) >= self.threshold and not self.is_open:
+            self._open_until = now + self.cooldown
+            self._failures.clear()
+            self.trips += 1
+            logger.warning("{} connection failures in {} seconds, pausing all reconnects for {} "
+                           "seconds".format(self.threshold, self.window, self.cooldown))
+
+    async def wait(self) -> None:
+        """
+        Waits until this breaker is closed.
+        """
+        if not self.is_open:
+            return
+
+        delay = self._open_until - time.monotonic() + random.uniform(0, self.spread)
+        await multio.asynclib.sleep(max(delay, 0))
+
+
+class ReconnectPolicy(object):
+    """
+    Decides how shards reconnect.
+
+    Subclasses can override :meth:`.classify` and :meth:`.delay` to change the behaviour.
+    """
+    #: Close codes that can never be recovered from.
+    FATAL_CODES = frozenset({4004, 4010, 4011, 4012})
+
+    #: Close codes that mean the session is gone, and a new one must be made.
+    NEW_SESSION_CODES = frozenset({1000, 4003, 4007})
+
+    def __init__(self, *, base_delay: float = 1.0, max_delay: float = 60.0,
+                 factor: float = 2.0, max_attempts: int = None, connect_timeout: float = 5.0,
+                 breaker: typing.Union[CircuitBreaker, None] = CircuitBreaker):
+        """
+        :param base_delay: The delay before the first retry, in seconds.
+        :param max_delay: The maximum delay between retries, in seconds.
+        :param factor: The factor the delay grows by with each failed attempt.
+        :param max_attempts: The number of failed attempts in a row before a shard gives up. \
+            If this is None, shards never give up.
+        :param connect_timeout: The number of seconds to wait for a websocket to connect.
+        :param breaker: The :class:`.CircuitBreaker` shared by every shard. If this is None, \
+            no breaker is used. Defaults to a new breaker.
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+
+        if breaker is CircuitBreaker:
+            breaker = CircuitBreaker()
+
+        #: The :class:`.CircuitBreaker` shared by every shard, if any.
+        self.breaker = breaker
+
+    def classify(self, code: int) -> CloseAction:
+        """
+        Decides what to do after a connection closes.
+
+        :param code: The close code of the connection.
+        :return: The :class:`.CloseAction` to take.
+        """
+        if code in self.FATAL_CODES:
+            return CloseAction.FATAL
+
+        if code in self.NEW_SESSION_CODES:
+            return CloseAction.NEW_SESSION
+
+        return CloseAction.RESUME
+
+    def delay(self, attempt: int) -> float:
+        """
+        Gets the delay before a reconnect attempt, using exponential backoff with full jitter.
+
+        :param attempt: The number of failed attempts in a row so far.
+        :return: The number of seconds to wait.
+        """
+        ceiling = min(self.max_delay, self.base_delay * self.factor ** attempt)
+        return random.uniform(0, ceiling)
+
+    def should_give_up(self, attempt: int) -> bool:
+        """
+        :param attempt: The number of failed attempts in a row so far.
+        :return: If the shard should stop trying to reconnect.
+        """
+        return self.max_attempts is not None and attempt >= self.max_attempts
+
+    def record_failure(self) -> None:
+        """
+        Records a failed or dropped connection with the breaker.
+        """
+        if self.breaker is not None:
+            self.breaker.record_failure()
+
+    async def wait_for_breaker(self) -> None:
+        """
+        Waits until the breaker allows reconnecting.
+        """
+        if self.breaker is not None:
+            await self.breaker.wait()
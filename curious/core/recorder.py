@@ -0,0 +1,409 @@
+"""
+Recording and replaying of gateway traffic.
+
+A :class:`.GatewayRecorder` writes every raw frame received by a client's gateways to a compact
+log file, along with when it arrived:
+
+.. code-block:: python3
+
+    client = Client("token", recorder=GatewayRecorder("traffic.rec"))
+
+A :class:`.Replayer` then feeds that log back into a real :class:`~.Client` through fake
+websockets, so that state handlers and events can be benchmarked offline:
+
+.. code-block:: python3
+
+    replayer = Replayer(client, "traffic.rec", speed=None)
+    stats = multio.run(replayer.run)
+
+.. currentmodule:: curious.core.recorder
+"""
+import collections
+import json
+import struct
+import time
+import typing
+import zlib
+
+import curio
+import multio
+from asyncwebsockets import WebsocketBytesMessage, WebsocketClosed, WebsocketTextMessage
+
+from curious.core import client as md_client
+from curious.core.codecs import get_codec
+from curious.core.gateway import Gateway, ZLIB_SUFFIX
+
+#: The magic bytes at the start of every recording.
+MAGIC = b"CURIOUSREC\x01"
+
+#: The header of every record: time offset, shard ID, kind, data length.
+_RECORD = struct.Struct("<dHBI")
+
+#: A text frame.
+KIND_TEXT = 0
+#: A binary frame.
+KIND_BYTES = 1
+#: A new connection. The data is a JSON object describing the gateway.
+KIND_CONNECT = 2
+
+#: A single record in a recording.
+Frame = collections.namedtuple("Frame", "offset shard_id kind data")
+
+
+def read_recording(path: str) -> typing.Iterator[Frame]:
+    """
+    Reads the frames from a recording.
+
+    :param path: The path of the recording.
+    :return: An iterator of :class:`.Frame`, in the order they were recorded.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a gateway recording".format(path))
+
+        while True:
+            header = f.read(_RECORD.size)
+            if not header:
+                return
+
+            if len(header) < _RECORD.size:
+                # the recorder was killed mid-write
+                return
+
+            offset, shard_id, kind, length = _RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+
+            yield Frame(offset, shard_id, kind, data)
+
+
+def iter_payloads(path: str) -> typing.Iterator[typing.Tuple[int, dict]]:
+    """
+    Decodes the payloads in a recording, without replaying them.
+
+    :param path: The path of the recording.
+    :return: An iterator of (shard ID, payload) tuples.
+    """
+    connections = {}
+    for frame in read_recording(path):
+        if frame.kind == KIND_CONNECT:
+            meta = json.loads(frame.data.decode("utf-8"))
+            decompressor = zlib.decompressobj() if meta["compress"] == "zlib-stream" else None
+            connections[frame.shard_id] = (get_codec(meta["codec"]), decompressor, bytearray())
+            continue
+
+        try:
+            codec, decompressor, buffer = connections[frame.shard_id]
+        except KeyError:
+            continue
+
+        data = frame.data
+        if frame.kind == KIND_BYTES:
+            if decompressor is not None:
+                buffer.extend(data)
+                if data[-4:] != ZLIB_SUFFIX:
+                    continue
+
+                data = decompressor.decompress(buffer)
+                buffer.clear()
+            elif codec.encoding == "json":
+                data = zlib.decompress(data, 15, 10490000)
+
+        if not data:
+            continue
+
+        yield frame.shard_id, codec.decode(data)
+
+
+class GatewayRecorder(object):
+    """
+    Records the raw frames received by gateways to a file.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the file to record to. This is overwritten.
+        """
+        #: The path of the recording.
+        self.path = path
+
+        #: The number of frames recorded.
+        self.frames = 0
+
+        #: The number of bytes of frame data recorded.
+        self.bytes = 0
+
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._started = time.monotonic()
+
+    def __repr__(self):
+        return "<GatewayRecorder path='{}' frames={}>".format(self.path, self.frames)
+
+    def _write(self, shard_id: int, kind: int, data: bytes):
+        offset = time.monotonic() - self._started
+        self._file.write(_RECORD.pack(offset, shard_id, kind, len(data)))
+        self._file.write(data)
+
+    def record_connect(self, gw: Gateway) -> None:
+        """
+        Records that a gateway has opened a new connection.
+
+        :param gw: The :class:`~.Gateway` that connected.
+        """
+        meta = {
+            "shard_count": gw.shard_count,
+            "compress": gw.compress,
+            "codec": gw.codec.name,
+        }
+        self._write(gw.shard_id, KIND_CONNECT, json.dumps(meta).encode("utf-8"))
+
+    def record_frame(self, shard_id: int, message) -> None:
+        """
+        Records a single frame.
+
+        :param shard_id: The shard that received the frame.
+        :param message: The websocket message that was received.
+        """
+        if isinstance(message, WebsocketBytesMessage):
+            kind, data = KIND_BYTES, message.data
+        else:
+            kind, data = KIND_TEXT, message.data.encode("utf-8")
+
+        self._write(shard_id, kind, data)
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def wrap(self, gw: Gateway, events: typing.AsyncGenerator[tuple, None]):
+        """
+        Wraps the events of a gateway, recording every frame as it passes through.
+
+        :param gw: The :class:`~.Gateway` the events come from.
+        :param events: The async generator returned by :meth:`.Gateway.events`.
+        """
+        self.record_connect(gw)
+
+        async with multio.finalize_agen(events) as agen:
+            async for event in agen:
+                if event[0] == "gateway_message_received":
+                    self.record_frame(gw.shard_id, event[1])
+
+                yield event
+
+        self._file.flush()
+
+    def close(self) -> None:
+        """
+        Flushes and closes the recording.
+        """
+        self._file.close()
+
+
+class FakeWebsocket(object):
+    """
+    A stand-in for a real websocket, that returns frames pushed into it.
+    """
+
+    def __init__(self):
+        #: The number of messages that have been sent down this websocket.
+        self.sent = 0
+
+        self._queue = curio.Queue()
+        self._closed = False
+        self._processing = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def push(self, message) -> None:
+        """
+        Pushes a message to be received. None marks the end of the connection.
+        """
+        await self._queue.put(message)
+
+    async def join(self) -> None:
+        """
+        Waits until every pushed message has been received and processed by the gateway.
+        """
+        await self._queue.join()
+
+    async def next_message(self):
+        if self._processing:
+            # the previous message was fully processed once the next one is asked for
+            await self._queue.task_done()
+
+        message = await self._queue.get()
+        self._processing = True
+
+        if message is None:
+            self._closed = True
+            raise WebsocketClosed(1000, reason="End of recording")
+
+        return message
+
+    async def abandon(self) -> None:
+        """
+        Marks every pushed message as processed, once the gateway has stopped reading them, so
+        that :meth:`.join` returns.
+        """
+        self._closed = True
+        while not self._queue.empty():
+            await self._queue.get()
+            await self._queue.task_done()
+
+        if self._processing:
+            self._processing = False
+            await self._queue.task_done()
+
+    async def send_message(self, data: typing.Union[str, bytes]):
+        self.sent += 1
+
+    async def close(self, *, code: int = 1000, reason: str = "No reason"):
+        self._closed = True
+
+
+#: The result of a replay.
+ReplayStats = collections.namedtuple("ReplayStats", "frames bytes elapsed shards")
+
+
+class Replayer(object):
+    """
+    Replays a recording into a :class:`~.Client`.
+
+    Frames are delivered in the order they were recorded, and each frame is parsed by its
+    gateway before the next frame is delivered, so the order of events is the same between runs.
+    """
+
+    def __init__(self, client: 'md_client.Client', path: str, *, speed: float = 1.0):
+        """
+        :param client: The :class:`~.Client` to replay into. This should not be connected.
+        :param path: The path of the recording.
+        :param speed: The replay speed, as a multiple of real time. If this is None, frames \
+            are replayed as fast as they can be processed.
+        """
+        self.client = client
+        self.path = path
+        self.speed = speed
+
+        self._websockets = {}  # type: typing.Dict[int, FakeWebsocket]
+        self._finished = {}  # type: typing.Dict[int, multio.Event]
+        # shard id -> the exception its gateway died with
+        self._errors = {}  # type: typing.Dict[int, BaseException]
+
+    def _make_gateway(self, shard_id: int, meta: dict) -> Gateway:
+        gw = Gateway(self.client._token, self.client.state,
+                     compress=meta["compress"], codec=meta["codec"],
+                     identify_scheduler=self.client.identify_scheduler)
+        gw.shard_id = gw.metrics.shard_id = shard_id
+        gw.shard_count = meta["shard_count"]
+        self.client.shard_count = max(self.client.shard_count, gw.shard_count)
+        self.client._gateways[shard_id] = gw
+        return gw
+
+    async def _consume(self, gw: Gateway, ws: FakeWebsocket, finished: multio.Event):
+        try:
+            async with multio.finalize_agen(gw.events()) as agen:
+                async for event in agen:
+                    await self.client.fire_event(event[0], *event[1:], gateway=gw)
+        except WebsocketClosed:
+            pass
+        except Exception as e:
+            # raised by run(), which would otherwise wait for this frame forever
+            self._errors[gw.shard_id] = e
+        finally:
+            await ws.abandon()
+            await finished.set()
+
+    def _check_errors(self, shard_id: int) -> None:
+        """
+        Re-raises the exception the gateway of a shard died with, if it did.
+        """
+        error = self._errors.pop(shard_id, None)
+        if error is not None:
+            raise error
+
+    async def run(self) -> ReplayStats:
+        """
+        Runs the replay.
+
+        :return: A :class:`.ReplayStats` describing the replay.
+        """
+        frames = 0
+        total_bytes = 0
+        started = time.monotonic()
+
+        async with multio.asynclib.task_manager() as tg:
+            self.client.events.task_manager = tg
+
+            for frame in read_recording(self.path):
+                if self.speed is not None:
+                    delay = started + frame.offset / self.speed - time.monotonic()
+                    if delay > 0:
+                        await multio.asynclib.sleep(delay)
+
+                if frame.kind == KIND_CONNECT:
+                    await self._connect(tg, frame.shard_id, json.loads(frame.data.decode("utf-8")))
+                    continue
+
+                ws = self._websockets.get(frame.shard_id)
+                if ws is None:
+                    # the recording started without a connect record for this shard
+                    continue
+
+                if frame.kind == KIND_BYTES:
+                    message = WebsocketBytesMessage(frame.data)
+                else:
+                    message = WebsocketTextMessage(frame.data.decode("utf-8"))
+
+                await ws.push(message)
+                await ws.join()
+                self._check_errors(frame.shard_id)
+                frames += 1
+                total_bytes += len(frame.data)
+
+            for shard_id in self._websockets:
+                await self._disconnect(shard_id)
+
+            # dispatch handlers can still be running, e.g. on a worker thread, and fire events
+            # when they finish, which the group refuses once it is joined, so wait for them first
+            while True:
+                task = await tg.next_done()
+                if task is None:
+                    break
+
+                if task.exception is not None:
+                    raise task.exception
+
+        return ReplayStats(frames=frames, bytes=total_bytes,
+                           elapsed=time.monotonic() - started,
+                           shards=sorted(self._websockets))
+
+    async def _disconnect(self, shard_id: int):
+        """
+        Ends the current connection of a shard, and waits for its gateway to finish.
+        """
+        await self._websockets[shard_id].push(None)
+        await self._finished[shard_id].wait()
+        self._check_errors(shard_id)
+
+    async def _connect(self, tg, shard_id: int, meta: dict):
+        """
+        Handles a new connection in the recording.
+        """
+        if shard_id in self._websockets:
+            # a reconnect, so finish the old connection first
+            await self._disconnect(shard_id)
+            gw = self.client._gateways[shard_id]
+        else:
+            gw = self._make_gateway(shard_id, meta)
+
+        ws = FakeWebsocket()
+        self._websockets[shard_id] = ws
+        self._finished[shard_id] = finished = multio.Event()
+        gw.websocket = ws
+        gw._open = True
+        gw._reset_compression()
+
+        await multio.asynclib.spawn(tg, self._consume, gw, ws, finished)
@@ -0,0 +1,315 @@
+"""
+Outbound rate limiting for the gateway.
+
+Discord closes any gateway connection that sends more than 120 commands in 60 seconds. Every
+:class:`~.Gateway` owns a :class:`.GatewaySendQueue` which paces commands under that limit,
+keeping a few commands in reserve for heartbeats, IDENTIFY and RESUME, which skip the queue.
+
+.. currentmodule:: curious.core.sendqueue
+"""
+import collections
+import enum
+import logging
+import time
+import typing
+
+import curio
+import multio
+from asyncwebsockets import WebsocketClosed
+from asyncwebsockets.common import WebsocketUnusable
+
+from curious.core import gateway as _gateway
+
+logger = logging.getLogger("curious.sendqueue")
+
+
+class Lane(enum.IntEnum):
+    """
+    The lanes of a :class:`.GatewaySendQueue`, in the order they are sent.
+    """
+    #: Voice state updates. These are time sensitive, as voice connections wait on them.
+    VOICE = 0
+
+    #: Anything sent with :meth:`.Gateway.send`, and guild syncs.
+    NORMAL = 1
+
+    #: Presence updates. Only the most recent one is ever sent.
+    PRESENCE = 2
+
+    #: Member chunk requests. Requests without a nonce are merged into batches of guilds.
+    CHUNK = 3
+
+
+class TokenBucket(object):
+    """
+    A rolling window rate limit.
+
+    The time of every command is kept, and a command is only allowed if fewer than ``limit``
+    commands were sent in the ``per`` seconds before it, so bursts are never allowed on either
+    side of a window boundary.
+    """
+
+    def __init__(self, limit: int = 120, per: float = 60.0, *, reserve: int = 0):
+        """
+        :param limit: The number of commands allowed in any window.
+        :param per: The length of the window, in seconds.
+        :param reserve: The number of commands per window that only :meth:`.consume` can use.
+        """
+        #: The number of commands allowed in any window.
+        self.limit = limit
+
+        #: The length of the window, in seconds.
+        self.per = per
+
+        #: The number of commands kept back for commands that bypass the queue.
+        self.reserve = reserve
+
+        # the times of the commands sent in the last window, oldest first
+        self._sent = collections.deque()  # type: typing.Deque[float]
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.per
+        while self._sent and self._sent[0] <= cutoff:
+            self._sent.popleft()
+
+    @property
+    def remaining(self) -> int:
+        """
+        :return: The number of queued commands that can be sent right now.
+        """
+        self._expire()
+        return max(0, self.limit - self.reserve - len(self._sent))
+
+    def consume(self) -> None:
+        """
+        Records a command as sent. This is used for commands that skip the queue, which can dip
+        into the reserve, and for queued commands once they have been sent.
+        """
+        self._expire()
+        self._sent.append(time.monotonic())
+
+    async def wait(self) -> None:
+        """
+        Waits until a queued command can be sent.
+
+        This does not use up the command; :meth:`.consume` must be called once it has been sent.
+        """
+        while self.remaining <= 0:
+            # wait for enough of the oldest commands to leave the window
+            excess = min(len(self._sent) - (self.limit - self.reserve), len(self._sent) - 1)
+            if excess < 0:
+                # nothing left to expire; the limit is entirely reserved
+                delay = self.per
+            else:
+                delay = self._sent[excess] + self.per - time.monotonic()
+            await multio.asynclib.sleep(max(delay, 0))
+
+
+class GatewaySendQueue(object):
+    """
+    A per-gateway queue of outbound commands.
+
+    Commands are sent one lane at a time, in the order of :class:`.Lane`, by a background task
+    that waits on the :class:`.TokenBucket`. Nothing is sent until the session is established
+    (READY or RESUMED is received); heartbeats, IDENTIFY and RESUME skip the queue.
+    """
+    #: The maximum number of guilds to put into a single member chunk request.
+    CHUNK_BATCH_SIZE = 75
+
+    #: The maximum number of commands in a single lane, before the oldest are dropped.
+    MAX_LANE_SIZE = 1000
+
+    def __init__(self, gw: '_gateway.Gateway', *, limit: int = 120, per: float = 60.0,
+                 reserve: int = 5):
+        """
+        :param gw: The :class:`~.Gateway` to send commands down.
+        :param limit: The number of commands allowed per window.
+        :param per: The length of the window, in seconds.
+        :param reserve: The number of commands per window reserved for heartbeats, IDENTIFY and \
+            RESUME.
+        """
+        self.gw = gw
+
+        #: The :class:`.TokenBucket` used to pace commands.
+        self.bucket = TokenBucket(limit, per, reserve=reserve)
+
+        #: The number of commands queued, per lane.
+        self.queued = collections.Counter()
+        #: The number of commands sent, per lane.
+        self.sent = collections.Counter()
+        #: The number of commands dropped without being sent, per lane.
+        self.dropped = collections.Counter()
+        #: The number of commands merged into another command, per lane.
+        self.coalesced = collections.Counter()
+
+        self._lanes = {lane: collections.deque() for lane in Lane if lane is not Lane.PRESENCE}
+        self._presence = None  # type: dict
+        self._chunk_guilds = collections.OrderedDict()  # type: typing.Dict[str, None]
+        self._wakeup = multio.Event()
+        self._task = None
+
+    def __repr__(self):
+        return "<GatewaySendQueue pending={} remaining={}>".format(self.pending,
+                                                                   self.bucket.remaining)
+
+    @property
+    def pending(self) -> int:
+        """
+        :return: The number of commands waiting to be sent.
+        """
+        return sum(len(lane) for lane in self._lanes.values()) \
+            + (self._presence is not None) + bool(self._chunk_guilds)
+
+    def stats(self) -> dict:
+        """
+        :return: A dict of statistics about this queue.
+        """
+        return {
+            "pending": self.pending,
+            "remaining": self.bucket.remaining,
+            "queued": {lane.name: count for lane, count in self.queued.items()},
+            "sent": {lane.name: count for lane, count in self.sent.items()},
+            "dropped": {lane.name: count for lane, count in self.dropped.items()},
+            "coalesced": {lane.name: count for lane, count in self.coalesced.items()},
+        }
+
+    async def put(self, payload: typing.Union[dict, str, bytes],
+                  lane: Lane = Lane.NORMAL) -> None:
+        """
+        Queues a command to be sent.
+
+        :param payload: The payload to send.
+        :param lane: The :class:`.Lane` to send the payload in.
+        """
+        self.queued[lane] += 1
+
+        if lane is Lane.PRESENCE:
+            if self._presence is not None:
+                self.coalesced[lane] += 1
+            self._presence = payload
+        elif lane is Lane.CHUNK and "nonce" not in payload["d"]:
+            if self._chunk_guilds:
+                self.coalesced[lane] += 1
+            for guild_id in payload["d"]["guild_id"]:
+                self._chunk_guilds[guild_id] = None
+        else:
+            queue = self._lanes[lane]
+            if len(queue) >= self.MAX_LANE_SIZE:
+                queue.popleft()
+                self.dropped[lane] += 1
+                logger.warning("Send queue lane {} is full, dropping the oldest command"
+                               .format(lane.name))
+            queue.append(payload)
+
+        await self._ensure_running()
+        await self._wakeup.set()
+
+    def bypass(self) -> None:
+        """
+        Marks that a command has been sent without going through the queue.
+        """
+        self.bucket.consume()
+
+    def clear(self) -> None:
+        """
+        Drops every pending command, except for the latest presence, which is still wanted on
+        the new session. This is used when a session is invalidated.
+        """
+        for lane, queue in self._lanes.items():
+            self.dropped[lane] += len(queue)
+            queue.clear()
+
+        if self._chunk_guilds:
+            self.dropped[Lane.CHUNK] += 1
+            self._chunk_guilds.clear()
+
+    def _pop(self) -> typing.Union[typing.Tuple[Lane, typing.Any], None]:
+        """
+        Pops the next command to send.
+        """
+        for lane in Lane:
+            if lane is Lane.PRESENCE:
+                if self._presence is not None:
+                    payload, self._presence = self._presence, None
+                    return lane, payload
+            elif lane is Lane.CHUNK and not self._lanes[lane]:
+                # requests with a nonce are sent as they are, before the merged ones
+                if self._chunk_guilds:
+                    guild_ids = []
+                    while self._chunk_guilds and len(guild_ids) < self.CHUNK_BATCH_SIZE:
+                        guild_ids.append(self._chunk_guilds.popitem(last=False)[0])
+
+                    return lane, {
+                        "op": _gateway.GatewayOp.REQUEST_MEMBERS,
+                        "d": {
+                            "guild_id": guild_ids,
+                            "query": "",
+                            "limit": 0
+                        }
+                    }
+            elif self._lanes[lane]:
+                return lane, self._lanes[lane].popleft()
+
+        return None
+
+    def _push_back(self, lane: Lane, payload):
+        """
+        Puts a command that failed to send back at the front of its lane.
+        """
+        if lane is Lane.PRESENCE:
+            if self._presence is None:
+                self._presence = payload
+        elif lane is Lane.CHUNK and "nonce" not in payload["d"]:
+            for guild_id in reversed(payload["d"]["guild_id"]):
+                self._chunk_guilds[guild_id] = None
+                self._chunk_guilds.move_to_end(guild_id, last=False)
+        else:
+            self._lanes[lane].appendleft(payload)
+
+    async def _ensure_running(self):
+        if self._task is None:
+            self._task = await curio.spawn(self._run(), daemon=True)
+
+    async def _run(self):
+        """
+        Sends queued commands forever.
+        """
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if not self.gw._session_ready:
+                # wait for the session to be established, as discord closes the connection for
+                # anything other than heartbeats, IDENTIFY and RESUME before then
+                await multio.asynclib.sleep(0.5)
+                continue
+
+            await self.bucket.wait()
+            item = self._pop()
+            if item is None:
+                continue
+
+            lane, payload = item
+            try:
+                if isinstance(payload, dict):
+                    await self.gw._send_dict(payload)
+                else:
+                    await self.gw._send(payload)
+            except (WebsocketClosed, WebsocketUnusable, _gateway.ReconnectWebsocket):
+                # the events loop deals with reconnecting, we just try again later
+                self._push_back(lane, payload)
+                continue
+            except Exception:
+                logger.exception("Failed to send command in lane {}".format(lane.name))
+                self.dropped[lane] += 1
+            else:
+                # only commands that were actually sent count towards the limit
+                self.bucket.consume()
+                self.sent[lane] += 1
+
+            nonce = payload["d"].get("nonce") if lane is Lane.CHUNK else None
+            if nonce is not None:
+                # the chunker times the request out from now, which also retries dropped ones
+                await self.gw.chunker.request_sent(nonce)
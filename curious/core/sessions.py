@@ -0,0 +1,210 @@
+"""
+Persistent storage for gateway sessions.
+
+Storing the session ID and sequence of each shard allows a restarted process to RESUME its
+sessions, instead of sending a new IDENTIFY and receiving every guild again. A RESUME only
+replays the events that were missed, so stored sessions are only resumed for shards whose guilds
+were loaded from a snapshot (see :mod:`curious.core.snapshot`); other shards IDENTIFY.
+
+.. code-block:: python3
+
+    client = Client("token", session_store=FileSessionStore("sessions.json"))
+
+.. currentmodule:: curious.core.sessions
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+import typing
+from collections import namedtuple
+
+logger = logging.getLogger("curious.sessions")
+
+#: A stored gateway session.
+SavedSession = namedtuple("SavedSession", "shard_id shard_count session_id sequence saved_at")
+
+
+class SessionStore(object):
+    """
+    The base class for a session store.
+
+    Subclasses must implement :meth:`._load`, :meth:`.save` and :meth:`.delete`.
+    """
+
+    def __init__(self, *, max_age: float = 300.0):
+        """
+        :param max_age: The maximum age of a session, in seconds, before it is considered too \
+            old to resume. If this is None, sessions never expire.
+        """
+        #: The maximum age of a stored session, in seconds.
+        self.max_age = max_age
+
+    def _load(self, shard_id: int) -> typing.Union[SavedSession, None]:
+        """
+        Loads the raw session for a shard, ignoring its age.
+        """
+        raise NotImplementedError
+
+    def load(self, shard_id: int, shard_count: int) -> typing.Union[SavedSession, None]:
+        """
+        Loads the session for a shard.
+
+        :param shard_id: The shard ID to load the session of.
+        :param shard_count: The current shard count. Sessions saved with a different count \
+            cannot be resumed.
+        :return: The :class:`.SavedSession`, or None if there is no usable session.
+        """
+        session = self._load(shard_id)
+        if session is None:
+            return None
+
+        if session.shard_count != shard_count:
+            logger.info("Discarding session for shard {} - shard count changed from {} to {}"
+                        .format(shard_id, session.shard_count, shard_count))
+            self.delete(shard_id)
+            return None
+
+        if self.max_age is not None and time.time() - session.saved_at > self.max_age:
+            logger.info("Discarding session for shard {} - it is too old".format(shard_id))
+            self.delete(shard_id)
+            return None
+
+        return session
+
+    def save(self, session: SavedSession) -> None:
+        """
+        Saves the session for a shard, replacing any existing session.
+
+        :param session: The :class:`.SavedSession` to save.
+        """
+        raise NotImplementedError
+
+    def delete(self, shard_id: int) -> None:
+        """
+        Deletes the session for a shard, if it exists.
+
+        :param shard_id: The shard ID to delete the session of.
+        """
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    A session store that keeps sessions in memory.
+
+    This does not survive a restart, but allows a client to be re-created inside the same process.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._sessions = {}  # type: typing.Dict[int, SavedSession]
+
+    def _load(self, shard_id: int) -> typing.Union[SavedSession, None]:
+        return self._sessions.get(shard_id)
+
+    def save(self, session: SavedSession) -> None:
+        self._sessions[session.shard_id] = session
+
+    def delete(self, shard_id: int) -> None:
+        self._sessions.pop(shard_id, None)
+
+
+class FileSessionStore(SessionStore):
+    """
+    A session store that keeps sessions in a JSON file.
+
+    The file is replaced atomically on every save, so a crash never leaves it half-written.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+        :param path: The path of the JSON file to store sessions in.
+        """
+        super().__init__(**kwargs)
+
+        #: The path of the JSON file.
+        self.path = path
+
+        self._sessions = self._read()
+
+    def _read(self) -> typing.Dict[int, SavedSession]:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Session file {} is corrupt, ignoring it".format(self.path))
+            return {}
+
+        return {int(shard_id): SavedSession(**session) for shard_id, session in data.items()}
+
+    def _write(self):
+        data = {str(shard_id): session._asdict() for shard_id, session in self._sessions.items()}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+
+        os.replace(tmp, self.path)
+
+    def _load(self, shard_id: int) -> typing.Union[SavedSession, None]:
+        return self._sessions.get(shard_id)
+
+    def save(self, session: SavedSession) -> None:
+        self._sessions[session.shard_id] = session
+        self._write()
+
+    def delete(self, shard_id: int) -> None:
+        if self._sessions.pop(shard_id, None) is not None:
+            self._write()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    A session store that keeps sessions in a SQLite database.
+
+    This is better suited than :class:`.FileSessionStore` to many shards, as each save only
+    writes a single row.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+        :param path: The path of the SQLite database.
+        """
+        super().__init__(**kwargs)
+
+        #: The path of the SQLite database.
+        self.path = path
+
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                               "shard_id INTEGER PRIMARY KEY, "
+                               "shard_count INTEGER NOT NULL, "
+                               "session_id TEXT NOT NULL, "
+                               "sequence INTEGER NOT NULL, "
+                               "saved_at REAL NOT NULL)")
+
+    def _load(self, shard_id: int) -> typing.Union[SavedSession, None]:
+        row = self._conn.execute("SELECT shard_id, shard_count, session_id, sequence, saved_at "
+                                 "FROM sessions WHERE shard_id = ?", (shard_id,)).fetchone()
+        if row is None:
+            return None
+
+        return SavedSession(*row)
+
+    def save(self, session: SavedSession) -> None:
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", session)
+
+    def delete(self, shard_id: int) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE shard_id = ?", (shard_id,))
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        self._conn.close()
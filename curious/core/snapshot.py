@@ -0,0 +1,395 @@
+"""
+Snapshots of the state.
+
+A snapshot stores the guilds, channels, roles, emojis, members and users of the state, and
+optionally its messages, in a single compressed file. Loading it on startup fills the cache
+straight away, instead of waiting for every guild to be received and parsed again.
+
+This pairs with a :class:`~.SessionStore`. The snapshot records the session and sequence of each
+shard when it was saved, and a shard only RESUMEs its stored session from that sequence, so the
+events it missed are replayed on top of the snapshot exactly once. If it starts a new session,
+the guilds from the snapshot are kept until their GUILD_CREATE arrives and replaces them.
+
+.. code-block:: python3
+
+    client = Client("token", session_store=FileSessionStore("sessions.json"),
+                    snapshot_path="state.snapshot")
+
+.. currentmodule:: curious.core.snapshot
+"""
+import enum
+import logging
+import marshal
+import os
+import struct
+import time
+import typing
+import zlib
+
+from curious.core import state as _state
+from curious.dataclasses.channel import Channel
+from curious.dataclasses.guild import Guild
+from curious.dataclasses.member import Member
+from curious.dataclasses.message import Message
+from curious.dataclasses.presence import Status
+from curious.dataclasses.role import Role
+from curious.dataclasses.user import BotUser, User
+from curious.dataclasses.webhook import Webhook
+from curious.exc import SnapshotError
+
+logger = logging.getLogger("curious.snapshot")
+
+#: The version of the snapshot format.
+SNAPSHOT_VERSION = 1
+
+_MAGIC = b"CURIOUS-SNAPSHOT"
+# magic, snapshot version, marshal version
+_HEADER = struct.Struct("!16sHH")
+
+
+def _plain(obj):
+    """
+    Converts dict and list subclasses and enums into the plain types marshal can store.
+    """
+    if isinstance(obj, dict):
+        return {key: _plain(value) for key, value in obj.items()}
+
+    if isinstance(obj, (list, tuple)):
+        return [_plain(value) for value in obj]
+
+    if isinstance(obj, enum.Enum):
+        return obj.value
+
+    return obj
+
+
+def _date(date) -> typing.Union[str, None]:
+    return date.isoformat() if date is not None else None
+
+
+def dump_user(user: User) -> dict:
+    """
+    :param user: The :class:`~.User` to dump.
+    :return: The user, in the same format Discord sends it.
+    """
+    data = {
+        "id": user.id,
+        "username": user.username,
+        "discriminator": user.discriminator,
+        "avatar": user.avatar_hash,
+        "bot": user.bot,
+    }
+    if isinstance(user, BotUser):
+        data.update(verified=user.verified, mfa_enabled=user.mfa_enabled, email=user.email,
+                    mobile=user.mobile, premium=user.premium)
+
+    return data
+
+
+def dump_role(role: Role) -> dict:
+    """
+    :param role: The :class:`~.Role` to dump.
+    :return: The role, in the same format Discord sends it.
+    """
+    return {
+        "id": role.id,
+        "name": role.name,
+        "color": role.colour,
+        "hoist": role.hoisted,
+        "mentionable": role.mentionable,
+        "permissions": role.permissions.bitfield,
+        "managed": role.managed,
+        "position": role.position,
+    }
+
+
+def dump_channel(channel: Channel, guild: Guild = None) -> dict:
+    """
+    :param channel: The :class:`~.Channel` to dump.
+    :param guild: The :class:`~.Guild` the channel is in, if any.
+    :return: The channel, in the same format Discord sends it. Recipients are stored by ID.
+    """
+    overwrites = []
+    for target_id, overwrite in channel._overwrites.items():
+        type_ = "role" if guild is not None and target_id in guild._roles else "member"
+        overwrites.append({"id": target_id, "type": type_, "allow": overwrite.allow.bitfield,
+                           "deny": overwrite.deny.bitfield})
+
+    data = {
+        "id": channel.id,
+        "name": channel.name,
+        "topic": channel.topic,
+        "parent_id": channel.parent_id,
+        "type": channel.type.value,
+        "nsfw": channel.nsfw,
+        "position": channel.position,
+        "last_message_id": channel._last_message_id,
+        "icon": channel.icon_hash,
+        "permission_overwrites": overwrites,
+        # the group channel constructor adds the current user back
+        "recipients": [user_id for user_id in channel._recipients
+                       if channel._bot.user is None or user_id != channel._bot.user.id],
+    }
+
+    # the constructor converts these with int(), so they are left out rather than None
+    if channel.guild_id is not None:
+        data["guild_id"] = channel.guild_id
+
+    if channel.owner_id is not None:
+        data["owner_id"] = channel.owner_id
+
+    return data
+
+
+def dump_member(member: Member) -> dict:
+    """
+    :param member: The :class:`~.Member` to dump.
+    :return: The member, in the same format Discord sends it. The user is stored by ID.
+    """
+    return {
+        "user": member.id,
+        "roles": list(member.role_ids),
+        "nick": str(member.nickname) or None,
+        "joined_at": _date(member.joined_at),
+    }
+
+
+def dump_guild(guild: Guild) -> dict:
+    """
+    :param guild: The :class:`~.Guild` to dump.
+    :return: The guild, in the same format as a GUILD_CREATE.
+    """
+    members = []
+    presences = []
+    for member in guild._members.values():
+        members.append(dump_member(member))
+
+        presence = member.presence
+        if presence is None or (presence.status is Status.OFFLINE and presence.game is None):
+            continue
+
+        game = presence.game
+        if game is not None:
+            game = {"name": game.name, "type": _plain(game.type), "url": game.url}
+
+        presences.append({"user": {"id": member.id}, "status": presence.status.value,
+                          "game": game})
+
+    # a shard that RESUMEs on top of the snapshot never gets these again
+    voice_states = []
+    for voice_state in guild._voice_states.values():
+        if voice_state.channel_id is None:
+            continue
+
+        voice_states.append({"user_id": voice_state.user_id,
+                             "channel_id": voice_state.channel_id,
+                             "self_mute": voice_state._self_mute,
+                             "mute": voice_state._server_mute,
+                             "self_deaf": voice_state._self_deaf,
+                             "deaf": voice_state._server_deaf})
+
+    return {
+        "id": guild.id,
+        "shard_id": guild.shard_id,
+        "chunked": guild._finished_chunking.is_set(),
+        "name": guild.name,
+        "icon": guild._icon_hash,
+        "splash": guild._splash_hash,
+        "owner_id": guild.owner_id,
+        "large": guild._large,
+        "features": list(guild.features or []),
+        "region": guild.region,
+        "afk_channel_id": guild.afk_channel_id,
+        "afk_timeout": guild.afk_timeout,
+        "system_channel_id": guild.system_channel_id,
+        "verification_level": guild.verification_level.value,
+        "mfa_level": guild.mfa_level.value,
+        "default_message_notifications": guild.notification_level.value,
+        "explicit_content_filter": guild.content_filter_level.value,
+        "member_count": guild.member_count,
+        "roles": [dump_role(role) for role in guild._roles.values()],
+        "emojis": [{"id": emoji.id, "name": emoji.name, "roles": list(emoji.role_ids),
+                    "require_colons": emoji.require_colons, "managed": emoji.managed,
+                    "animated": emoji.animated} for emoji in guild._emojis.values()],
+        "channels": [dump_channel(channel, guild) for channel in guild._channels.values()],
+        "members": members,
+        "presences": presences,
+        "voice_states": voice_states,
+    }
+
+
+def dump_message(message: Message) -> typing.Union[dict, None]:
+    """
+    :param message: The :class:`~.Message` to dump.
+    :return: The message, in the same format Discord sends it, or None if it has no author.
+    """
+    author = message.author
+    data = {
+        "id": message.id,
+        "channel_id": message.channel_id,
+        "content": message.content,
+        "type": message.type.value,
+        "timestamp": _date(message.created_at),
+        "edited_timestamp": _date(message.edited_at),
+        "embeds": [_plain(embed.to_dict()) for embed in message.embeds],
+        "attachments": _plain(message.attachments),
+        "mentions": _plain(message._mentions),
+        "mention_roles": _plain(message._role_mentions),
+    }
+
+    if isinstance(author, Webhook):
+        data["webhook_id"] = author.id
+        author = author.user
+    elif isinstance(author, Member):
+        author = author.user
+
+    if author is None:
+        return None
+
+    data["author"] = dump_user(author)
+    return data
+
+
+def dump_state(state: '_state.State', *, messages: bool = False,
+               sessions: typing.Mapping[int, typing.Tuple[str, int]] = None) -> dict:
+    """
+    Dumps the caches of a state into plain data.
+
+    :param state: The :class:`~.State` to dump.
+    :param messages: If the cached messages should be included.
+    :param sessions: A mapping of shard ID -> (session ID, sequence) the caches are up to date \
+        with.
+    :return: A dict that can be passed to :func:`.restore_state`.
+    """
+    users = {user_id: dump_user(user) for user_id, user in state._users.items()}
+    data = {
+        "saved_at": time.time(),
+        "user": dump_user(state._user) if state._user is not None else None,
+        "users": users,
+        "guilds": [dump_guild(guild) for guild in state._guilds.values()
+                   if not guild.unavailable],
+        "private_channels": [dump_channel(channel)
+                             for channel in state._private_channels.values()],
+        "messages": [],
+        "sessions": {shard_id: list(session) for shard_id, session in (sessions or {}).items()},
+    }
+
+    if messages:
+        for message in state.messages:
+            message_data = dump_message(message)
+            if message_data is not None:
+                data["messages"].append(message_data)
+
+    return data
+
+
+async def restore_state(state: '_state.State', data: dict) -> int:
+    """
+    Restores the caches of a state from data returned by :func:`.dump_state`.
+
+    :param state: The :class:`~.State` to restore into.
+    :param data: The dumped data.
+    :return: The number of guilds restored.
+    """
+    client = state.client
+    users = data["users"]
+
+    if state._user is None and data["user"] is not None:
+        state._user = BotUser(client, **data["user"])
+        state._users[state._user.id] = state._user
+
+    for user_data in users.values():
+        state.make_user(user_data)
+
+    for channel_data in data["private_channels"]:
+        channel_data["recipients"] = [users[user_id] for user_id in channel_data["recipients"]
+                                      if user_id in users]
+        state.make_private_channel(channel_data)
+
+    restored = 0
+    for guild_data in data["guilds"]:
+        guild_id = guild_data["id"]
+        if guild_id in state._guilds:
+            # received while the snapshot was loading, so it is newer
+            continue
+
+        for member_data in guild_data["members"]:
+            user_id = member_data["user"]
+            member_data["user"] = users.get(user_id) or {"id": user_id}
+
+        guild = Guild(client, **guild_data)
+        guild.shard_id = guild_data["shard_id"]
+        guild.system_channel_id = guild_data["system_channel_id"]
+        state._guilds[guild.id] = guild
+        state._restored_guilds.add(guild.id)
+        if guild_data["chunked"]:
+            await guild._finished_chunking.set()
+
+        restored += 1
+
+    for message_data in data["messages"]:
+        if state.find_channel(message_data["channel_id"]) is None:
+            continue
+
+        state.messages.append(state.make_message(message_data, cache=False))
+
+    # the stored sessions of these shards are resumed from these sequences
+    for shard_id, (session_id, sequence) in data.get("sessions", {}).items():
+        state._snapshot_sessions[shard_id] = (session_id, sequence)
+
+    # drop anything that only the snapshot referred to
+    for user_id in users:
+        state._check_decache_user(user_id)
+
+    logger.info("Restored {} guilds from a snapshot saved {:.0f} seconds ago"
+                .format(restored, time.time() - data["saved_at"]))
+    return restored
+
+
+def write_snapshot(path: str, data: dict) -> None:
+    """
+    Writes dumped data to a snapshot file.
+
+    The file is replaced atomically, so a crash never leaves it half-written.
+
+    :param path: The path of the snapshot file.
+    :param data: The data returned by :func:`.dump_state`.
+    """
+    body = zlib.compress(marshal.dumps(data))
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, SNAPSHOT_VERSION, marshal.version))
+        f.write(body)
+
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str) -> typing.Union[dict, None]:
+    """
+    Reads the dumped data from a snapshot file.
+
+    :param path: The path of the snapshot file.
+    :return: The dumped data, or None if the file does not exist.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+            body = f.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        magic, version, marshal_version = _HEADER.unpack(header)
+    except struct.error:
+        raise SnapshotError("{} is not a snapshot".format(path))
+
+    if magic != _MAGIC:
+        raise SnapshotError("{} is not a snapshot".format(path))
+
+    if version != SNAPSHOT_VERSION or marshal_version != marshal.version:
+        raise SnapshotError("{} was written by an incompatible version".format(path))
+
+    try:
+        return marshal.loads(zlib.decompress(body))
+    except (zlib.error, ValueError, EOFError, TypeError) as e:
+        raise SnapshotError("{} is corrupt".format(path)) from e
@@ -5,18 +5,23 @@ Defines :class:`.State`.
 """
 
 import collections
-import copy
+import functools
+import inspect
 import logging
+import threading
 import typing
 from types import MappingProxyType
 
+import curio
 import multio
 
 from curious.core import gateway
+from curious.core.cache import MemberCachePolicy, MessageCache, UserCache
+from curious.core.changes import ChangeSet
 from curious.dataclasses.channel import Channel, ChannelType
 from curious.dataclasses.emoji import Emoji
-from curious.dataclasses.guild import ContentFilterLevel, Guild, MFALevel, NotificationLevel, \
-    VerificationLevel
+from curious.dataclasses.guild import ContentFilterLevel, Guild, GuildEmojiWrapper, MFALevel, \
+    NotificationLevel, VerificationLevel
 from curious.dataclasses.member import Member
 from curious.dataclasses.message import Message
 from curious.dataclasses.permissions import Permissions
@@ -45,15 +50,33 @@ def int_or_none(val, default: typing.Any) -> typing.Union[int, None]:
 class GuildStore(collections.MutableMapping):
     """
     A store for guilds in the state.
+
+    This also keeps indexes of every guild channel and emoji by ID, and of guild IDs by shard,
+    and attaches the member store of every guild to the user cache.
     """
 
-    def __init__(self):
+    def __init__(self, users: UserCache = None):
+        #: The :class:`~.UserCache` that the member stores of guilds are attached to.
+        self.users = users
+
         #: The internal actual guilds.
         self.guilds = {}
 
         #: The order of the guilds, as specified by the READY packet.
         self.order = []
 
+        #: A mapping of channel ID -> :class:`~.Channel`, for every guild channel.
+        self.channels = {}  # type: typing.Dict[int, Channel]
+
+        #: A mapping of emoji ID -> :class:`~.Emoji`, for every guild emoji.
+        self.emojis = {}  # type: typing.Dict[int, Emoji]
+
+        #: A mapping of shard ID -> set of guild IDs on that shard.
+        self.shards = collections.defaultdict(set)  # type: typing.Dict[int, typing.Set[int]]
+
+        # guild id -> the keys it was last indexed under
+        self._indexed = {}  # type: typing.Dict[int, typing.Tuple[int, tuple, tuple]]
+
     def view(self) -> typing.Mapping[int, Guild]:
         """
         :return: A :class:`mappingproxy` of the internal guilds. 
@@ -74,15 +97,74 @@ class GuildStore(collections.MutableMapping):
 
         return MappingProxyType(o)
 
+    def index_guild(self, guild: Guild) -> None:
+        """
+        Updates the indexes for a guild, after its shard, channels or emojis have changed.
+
+        :param guild: The :class:`~.Guild` to index.
+        """
+        self.unindex_guild(guild.id)
+
+        self.shards[guild.shard_id].add(guild.id)
+        self.channels.update(guild._channels)
+        self.emojis.update(guild._emojis)
+        self._indexed[guild.id] = (guild.shard_id, tuple(guild._channels), tuple(guild._emojis))
+
+    def unindex_guild(self, guild_id: int) -> None:
+        """
+        Removes a guild from the indexes.
+
+        :param guild_id: The ID of the guild to remove.
+        """
+        try:
+            shard_id, channel_ids, emoji_ids = self._indexed.pop(guild_id)
+        except KeyError:
+            return
+
+        self.shards[shard_id].discard(guild_id)
+        for channel_id in channel_ids:
+            self.channels.pop(channel_id, None)
+
+        for emoji_id in emoji_ids:
+            self.emojis.pop(emoji_id, None)
+
+    def add_channel(self, channel: Channel) -> None:
+        """
+        Adds a new guild channel to the index.
+        """
+        self.channels[channel.id] = channel
+        try:
+            shard_id, channel_ids, emoji_ids = self._indexed[channel.guild_id]
+        except KeyError:
+            return
+
+        self._indexed[channel.guild_id] = (shard_id, channel_ids + (channel.id,), emoji_ids)
+
+    def remove_channel(self, channel: Channel) -> None:
+        """
+        Removes a deleted guild channel from the index.
+        """
+        self.channels.pop(channel.id, None)
+
     # abc methods
     def __setitem__(self, key, value) -> None:
-        return self.guilds.__setitem__(key, value)
+        old = self.guilds.get(key)
+        self.guilds.__setitem__(key, value)
+        self.index_guild(value)
+
+        if self.users is not None:
+            # attach first, so that members in both guilds are never evicted
+            value._members.attach(self.users)
+            if old is not None and old._members is not value._members:
+                old._members.detach()
 
     def __getitem__(self, key) -> Guild:
         return self.guilds.__getitem__(key)
 
     def __delitem__(self, key) -> None:
-        return self.guilds.__delitem__(key)
+        guild = self.guilds.pop(key)
+        self.unindex_guild(key)
+        guild._members.detach()
 
     def __iter__(self) -> typing.Iterator[Guild]:
         return self.guilds.__iter__()
@@ -98,7 +180,25 @@ class State(object):
     The other main purpose for this class is to parse events from the Discord websocket.
     """
 
-    def __init__(self, client, max_messages: int = 500):
+    def __init__(self, client, max_messages: int = 500, *,
+                 max_messages_per_channel: int = None,
+                 member_cache_policy: MemberCachePolicy = None,
+                 offload_threshold: int = None):
+        #: The :class:`~.MemberCachePolicy` that decides which members are cached.
+        self.member_cache_policy = member_cache_policy or MemberCachePolicy()
+
+        #: The number of members in a guild or member chunk payload at which its objects are
+        #: created in a worker thread, so that the event loop can keep heartbeating and handling
+        #: other shards. If this is None, everything is parsed on the event loop.
+        self.offload_threshold = offload_threshold
+
+        # guild id -> event set once the guild, being parsed in a thread, is stored
+        self._parsing = {}  # type: typing.Dict[int, multio.Event]
+        # guild id -> user ids to evict once the guild, parsed in a thread, is stored
+        self._parse_evictions = {}  # type: typing.Dict[int, typing.List[int]]
+        # set in worker threads while they parse, which leave the user cache to the event loop
+        self._worker = threading.local()
+
         #: The current user of this bot.
         #: This is automatically set after login.
         self._user = None  # type: BotUser
@@ -109,8 +209,11 @@ class State(object):
         #: The private channel cache.
         self._private_channels = {}
 
+        #: The current user cache.
+        self._users = UserCache(keep=self._keep_user)
+
         #: The guilds the bot can see.
-        self._guilds = GuildStore()
+        self._guilds = GuildStore(self._users)
 
         #: This user's friends.
         self._friends = {}  # type: typing.Dict[int, RelationshipUser]
@@ -118,18 +221,56 @@ class State(object):
         #: This user's blocked users.
         self._blocked = {}  # type: typing.Dict[int, RelationshipUser]
 
-        #: The current user cache.
-        self._users = {}
+        # guild ids restored from a snapshot, that are replaced when their GUILD_CREATE arrives
+        self._restored_guilds = set()  # type: typing.Set[int]
+
+        # shard id -> (session id, sequence) that the restored guilds are up to date with
+        self._snapshot_sessions = {}  # type: typing.Dict[int, typing.Tuple[str, int]]
 
-        #: The deque of messages.
+        # nonce -> (members found, event set when done), for outstanding member queries
+        self._member_queries = {}  # type: typing.Dict[str, tuple]
+
+        #: The :class:`~.MessageCache` of messages.
         #: This is bounded to prevent the message cache from growing infinitely.
-        self.messages = collections.deque(maxlen=max_messages)
+        self.messages = MessageCache(max_messages, max_per_channel=max_messages_per_channel)
 
         self.__shards_is_ready = collections.defaultdict(lambda *args, **kwargs: multio.Event())
         self.__voice_state_crap = collections.defaultdict(
             lambda *args, **kwargs: ((multio.Event(), multio.Event()), {})
         )
 
+        # dispatch name -> (handler, if the handler is an async generator)
+        self._dispatch_table = {}  # type: typing.Dict[str, typing.Tuple[typing.Callable, bool]]
+        for name in dir(type(self)):
+            if name.startswith("handle_"):
+                self.register_state_handler(name[len("handle_"):].upper(), getattr(self, name))
+
+    def register_state_handler(self, name: str, handler: typing.Callable) -> None:
+        """
+        Registers the handler for a gateway dispatch, replacing any existing handler.
+
+        The handler is called with the :class:`~.Gateway` and the dispatch data. It can either be
+        an async generator that yields ``(event name, *args)`` tuples, or a coroutine function
+        that returns a single tuple, or None to not fire any event. Coroutine handlers are
+        cheaper to call, so they should be used for dispatches that only ever fire one event.
+
+        .. code-block:: python3
+
+            async def handle_stage_instance_create(gw, event_data):
+                return "stage_instance_create", event_data
+
+            client.state.register_state_handler("STAGE_INSTANCE_CREATE",
+                                                handle_stage_instance_create)
+
+        :param name: The name of the dispatch, e.g. ``MESSAGE_CREATE``.
+        :param handler: The handler function.
+        """
+        is_agen = inspect.isasyncgenfunction(handler)
+        if not is_agen and not inspect.iscoroutinefunction(handler):
+            raise TypeError("State handlers must be coroutine or async generator functions")
+
+        self._dispatch_table[name.upper()] = (handler, is_agen)
+
     def is_ready(self, shard_id: int) -> multio.Event:
         """
         Checks if a shard is ready.
@@ -148,22 +289,6 @@ class State(object):
         for guild in self.guilds_for_shard(shard_id):
             guild._finished_chunking.clear()
 
-    def _mark_for_chunking(self, gw: 'gateway.Gateway', guild: Guild):
-        """
-        Marks a guild for chunking.
-        """
-        if all(not g.unavailable for g in self.guilds_for_shard(guild.shard_id)):
-            gw._enqueued_guilds.append(guild)
-            # we have all guilds anyway, so raise ChunkGuilds NOW
-            raise gateway.ChunkGuilds
-
-        if len(gw._enqueued_guilds) >= 74:
-            # bump it up to 75, if applicable
-            gw._enqueued_guilds.append(guild)
-            raise gateway.ChunkGuilds
-
-        gw._enqueued_guilds.append(guild)
-
     @property
     def guilds(self) -> typing.Mapping[int, Guild]:
         """
@@ -184,18 +309,18 @@ class State(object):
 
         :param shard_id: The shard ID to check.
         """
-        if any(guild.unavailable is True for guild in self.guilds.values()):
+        guilds = self.guilds_for_shard(shard_id)
+        if any(guild.unavailable is True for guild in guilds):
             return False
 
-        return all(guild._finished_chunking.is_set()
-                   for guild in self.guilds.values()
-                   if guild.shard_id == shard_id and guild.unavailable is False)
+        return all(guild._finished_chunking.is_set() for guild in guilds)
 
     def guilds_for_shard(self, shard_id: int):
         """
         Gets all the guilds for a particular shard.
         """
-        return [guild for guild in self.guilds.values() if guild.shard_id == shard_id]
+        guilds = self._guilds.guilds
+        return [guilds[guild_id] for guild_id in self._guilds.shards.get(shard_id, ())]
 
     async def _check_ready(self, gw: 'gateway.Gateway', guild: Guild):
         """
@@ -223,9 +348,10 @@ class State(object):
             return
 
         if self._user.bot:
-            # Check if we need to forcibly fire ChunkGuilds.
-            if all(g.unavailable is False for g in self.guilds_for_shard(gw.shard_id)):
-                raise gateway.ChunkGuilds
+            # every guild has streamed in, so request the rest without waiting for full batches
+            if all(g.unavailable is False and g.id not in self._restored_guilds
+                   for g in self.guilds_for_shard(gw.shard_id)):
+                await gw.chunker.flush()
 
     # get_all_* methods
     def get_all_channels(self) -> typing.Generator[Channel, None, None]:
@@ -260,56 +386,223 @@ class State(object):
         :param channel_id: The ID of the channel to find.
         :return: A :class:`~.Channel` that represents the channel, or None if no channel was found.
         """
-        # default channel_id == guild id
-        # for old guilds with a default channel
-        if channel_id in self._guilds:
-            try:
-                return self._guilds[channel_id].channels[channel_id]
-            except KeyError:
-                return None
+        try:
+            return self._guilds.channels[channel_id]
+        except KeyError:
+            return self._private_channels.get(channel_id)
 
-        if channel_id in self._private_channels:
-            return self._private_channels[channel_id]
+    def _find_message(self, message_id: int) -> Message:
+        return self.messages.get(message_id)
 
-        for guild in self._guilds.values():
-            if channel_id in guild._channels:
-                return guild._channels[channel_id]
+    def _keep_user(self, id: int) -> bool:
+        """
+        Checks if a user should be kept cached, even if no guild or private channel refers to it.
+        """
+        # don't decache ourself
+        if self._user is not None and id == self._user.id:
+            return True
 
-    def _find_message(self, message_id: int) -> Message:
-        for message in reversed(self.messages):
-            if message.id == message_id:
-                return message
+        # if its in friends/blocked, keep the RelationshipUser
+        return id in self._friends or id in self._blocked
 
     def _check_decache_user(self, id: int):
         """
         Checks if we should decache a user.
 
-        This will check if there is any guild with a reference to the user.
+        The user cache counts the members and private channel recipients that refer to each user,
+        so this does not need to search any guilds.
         """
-        # don't check if its not there
-        if id not in self._users:
+        evictions = getattr(self._worker, "evictions", None)
+        if evictions is not None:
+            # in a parsing worker thread, the user cache is only changed on the event loop
+            evictions.append(id)
             return
 
-        # don't decache ourself
-        if self._users[id] == self._user:
-            return
+        self._users.evict(id)
 
-        # if its in friends/blocked, keep the RelationshipUser
-        if id in self._friends or id in self._blocked:
-            return
+    def _cache_private_channel(self, channel: Channel):
+        """
+        Caches a private channel, adding a reference to each of its recipients.
+        """
+        old = self._private_channels.get(channel.id)
+        self._private_channels[channel.id] = channel
+        for user_id in channel._recipients:
+            self._users.incref(user_id)
 
-        # check if its in a private channel
-        for channel in self._private_channels.values():
-            if id in channel.recipients:
-                return
+        if old is not None:
+            self._uncache_private_channel(old, pop=False)
 
-        # check if it's any guilds
-        for guild in self._guilds.values():
-            if id in guild.members:
-                return
+    def _uncache_private_channel(self, channel: Channel, *, pop: bool = True):
+        """
+        Removes a private channel from the cache, dropping the reference to each of its
+        recipients.
+        """
+        if pop:
+            self._private_channels.pop(channel.id, None)
+
+        for user_id in channel._recipients:
+            self._users.decref(user_id)
+
+    def save_snapshot(self, path: str, *, messages: bool = False,
+                      sessions: typing.Mapping[int, typing.Tuple[str, int]] = None) -> None:
+        """
+        Saves the caches of this state to a snapshot file.
+
+        :param path: The path of the snapshot file.
+        :param messages: If the cached messages should be saved too.
+        :param sessions: A mapping of shard ID -> (session ID, sequence) of the current gateway \
+            sessions, which shards RESUME from when the snapshot is loaded.
+        """
+        from curious.core import snapshot
+        data = snapshot.dump_state(self, messages=messages, sessions=sessions)
+        snapshot.write_snapshot(path, data)
+
+    async def load_snapshot(self, path: str) -> int:
+        """
+        Loads the caches of this state from a snapshot file, if it exists.
+
+        This should be called before any shards connect. A snapshot that cannot be read or
+        restored is logged and ignored, so that it never stops the client from starting; it is
+        replaced when the client next saves a snapshot.
+
+        :param path: The path of the snapshot file.
+        :return: The number of guilds restored.
+        """
+        from curious.core import snapshot
+        try:
+            data = snapshot.read_snapshot(path)
+            if data is None:
+                return 0
 
-        # didn't return, so no references
-        self._users.pop(id, None)
+            return await snapshot.restore_state(self, data)
+        except Exception:
+            logger.exception("Failed to restore the snapshot at {}, ignoring it".format(path))
+            self._discard_snapshot()
+            return 0
+
+    def _discard_snapshot(self) -> None:
+        """
+        Drops whatever a failed snapshot restore left behind.
+        """
+        # without the sessions, shards IDENTIFY and never RESUME on top of partial data
+        self._snapshot_sessions.clear()
+        for guild_id in list(self._restored_guilds):
+            self._guilds.pop(guild_id, None)
+
+        self._restored_guilds.clear()
+        for user_id in list(self._users):
+            self._check_decache_user(user_id)
+
+    def user_cache_stats(self) -> dict:
+        """
+        :return: A dict of statistics about the user cache.
+        """
+        return self._users.stats()
+
+    # offloaded parsing
+    def _should_offload(self, members: list) -> bool:
+        """
+        Checks if a payload with these members should be parsed in a worker thread.
+        """
+        return self.offload_threshold is not None and len(members) >= self.offload_threshold
+
+    async def _parse_guild(self, event_data: dict) -> Guild:
+        """
+        Creates a guild from a GUILD_CREATE in a worker thread, if it is large enough.
+
+        The guild is not stored, so that nothing on the event loop can see it half-built.
+        Dispatches for the guild wait in :meth:`._wait_for_parse` until it has been stored.
+        """
+        if not self._should_offload(event_data.get("members", [])):
+            return Guild(self.client, **event_data)
+
+        guild_id = int(event_data["id"])
+        self._parsing[guild_id] = multio.Event()
+        try:
+            guild, evictions = await self._run_in_worker(
+                functools.partial(Guild, self.client, **event_data)
+            )
+        except BaseException:
+            await self._parsed(guild_id)
+            raise
+
+        self._parse_evictions[guild_id] = evictions
+        return guild
+
+    async def _run_in_worker(self, fn: typing.Callable) -> typing.Tuple[typing.Any, list]:
+        """
+        Runs a parser in a worker thread.
+
+        The worker never changes the user cache. Users it makes are cached here, on the event
+        loop, and the users it would have evicted are returned, to be evicted once the parsed
+        objects are stored.
+
+        :return: The result of the parser, and a list of user IDs to evict.
+        """
+        def _run():
+            # multio keeps its library per thread, and guilds make multio events
+            multio.init("curio")
+            worker = self._worker
+            worker.users, worker.evictions = [], []
+            try:
+                return fn(), worker.users, worker.evictions
+            finally:
+                del worker.users, worker.evictions
+
+        result, users, evictions = await curio.run_in_thread(_run)
+        for user in users:
+            if user.id not in self._users:
+                self._users[user.id] = user
+
+        return result, evictions
+
+    def _evict_users(self, user_ids: typing.Iterable[int]) -> None:
+        """
+        Evicts the users a worker thread would have evicted, if nothing refers to them now.
+        """
+        for user_id in user_ids:
+            self._check_decache_user(user_id)
+
+    async def _parsed(self, guild_id: int) -> None:
+        """
+        Wakes up dispatches waiting on a guild that was parsed in a worker thread.
+        """
+        self._evict_users(self._parse_evictions.pop(guild_id, ()))
+
+        event = self._parsing.pop(guild_id, None)
+        if event is not None:
+            await event.set()
+
+    async def _wait_for_parse(self, guild_id: int) -> None:
+        """
+        Waits until a guild being parsed in a worker thread has been stored, if it is.
+        """
+        event = self._parsing.get(guild_id)
+        if event is not None:
+            await event.wait()
+
+    async def _parse_members(self, guild: Guild, members: list) \
+            -> 'typing.Tuple[typing.Union[typing.Dict[int, Member], None], typing.List[int]]':
+        """
+        Creates the members in a chunk that are not already cached in a worker thread, if the
+        chunk is large enough.
+
+        :return: A mapping of member ID -> :class:`~.Member`, or None if the chunk is small, and a \
+            list of user IDs to evict once the members are stored.
+        """
+        if not self._should_offload(members):
+            return None, []
+
+        def _parse():
+            parsed = {}
+            for member_data in members:
+                member_id = int(member_data["user"]["id"])
+                if member_id not in guild._members:
+                    parsed[member_id] = Member(self.client, **member_data)
+
+            return parsed
+
+        return await self._run_in_worker(_parse)
 
     # make_ methods
     def make_webhook(self, event_data: dict) -> Webhook:
@@ -365,7 +658,7 @@ class State(object):
         :return: A new :class:`~.Channel`.
         """
         channel = Channel(self.client, **channel_data)
-        self._private_channels[channel.id] = channel
+        self._cache_private_channel(channel)
 
         return channel
 
@@ -381,14 +674,35 @@ class State(object):
         :return: A new :class`~.User` (hopefully).
         """
         id = int(user_data.get("id", 0))
-        if id in self._users and not override_cache:
-            return self._users[id]
+        old = self._users.get(id)
+        if old is not None and not override_cache:
+            return old
 
         user = user_klass(self.client, **user_data)
+        worker_users = getattr(self._worker, "users", None)
+        if worker_users is not None:
+            # in a parsing worker thread, the user is cached once it is back on the event loop
+            worker_users.append(user)
+            return user
+
         self._users[user.id] = user
 
+        if old is not None and (old.username, old.discriminator) != (user.username,
+                                                                     user.discriminator):
+            self._reindex_user(user.id)
+
         return user
 
+    def _reindex_user(self, user_id: int) -> None:
+        """
+        Updates the name index of every guild with a member for a user, after the user is renamed.
+        """
+        for guild in self._guilds.values():
+            if guild._name_index is not None and user_id in guild._name_index:
+                member = guild._members.get(user_id)
+                if member is not None:
+                    guild._index_member(member)
+
     def make_message(self, event_data: dict, cache: bool = True) -> Message:
         """
         Constructs a new message object.
@@ -397,12 +711,13 @@ class State(object):
         :param cache: Should this message be cached?
         :return: A new :class:`~.Message` object for the message.
         """
-        message = Message(self.client, **event_data)
+        if cache:
+            message = self.messages.get(int(event_data.get("id", 0)))
+            if message is not None:
+                # don't bother re-caching
+                return message
 
-        if message in self.messages:
-            # don't bother re-caching
-            i = self.messages.index(message)
-            return self.messages[i]
+        message = Message(self.client, **event_data)
 
         # discord won't give us the Guild id
         # so we have to search it from the channels
@@ -426,7 +741,15 @@ class State(object):
             if event_data.get("webhook_id") is not None:
                 message.author = self.make_webhook(event_data)
             else:
-                message.author = message.guild.members.get(author_id)
+                member = message.guild.members.get(author_id)
+                if member is None and "member" in event_data:
+                    # not cached, but discord sends enough to make the member
+                    member_data = dict(event_data["member"], user=event_data["author"])
+                    member = Member(self.client, **member_data)
+                    member.guild_id = message.guild_id
+                    message.guild._cache_member(member)
+
+                message.author = member
 
         for reaction_data in event_data.get("reactions", []):
             emoji = reaction_data.get("emoji", {})
@@ -442,7 +765,7 @@ class State(object):
             reaction.emoji = emoji_obb
             message.reactions.append(reaction)
 
-        if cache and message not in self.messages:
+        if cache:
             self.messages.append(message)
 
         return message
@@ -523,22 +846,42 @@ class State(object):
                         "and {} blocked users.".format(len(self._friends), len(self._blocked)))
 
         # Create all of the guilds.
+        ready_ids = set()
         for guild in event_data.get("guilds", []):
-            new_guild = Guild(self.client, **guild)
+            guild_id = int(guild["id"])
+            ready_ids.add(guild_id)
+            if self._user.bot and guild_id in self._restored_guilds:
+                # keep the guild from the snapshot, until its GUILD_CREATE replaces it
+                # this is a new session, so the shard is not ready until that arrives
+                restored = self._guilds[guild_id]
+                restored.shard_id = gw.shard_id
+                restored._finished_chunking.clear()
+                self._guilds.index_guild(restored)
+                continue
+
+            self._restored_guilds.discard(guild_id)
+            new_guild = await self._parse_guild(guild)
             new_guild.shard_id = gw.shard_id
             self._guilds[new_guild.id] = new_guild
+            await self._parsed(new_guild.id)
 
             if not self._user.bot and len(event_data.get("guilds")) <= 100:
                 # this might as well be a GUILD_CREATE, so treat it as one
-                new_guild.start_chunking()
+                await gw.chunker.add(new_guild)
                 for i in await coerce_agen(self.handle_guild_create(gw, guild)):
                     yield i
 
-                gw._dispatches_handled["GUILD_CREATE"] += 1
+                gw.metrics.record_dispatch("GUILD_CREATE")
+
+        # drop the guilds from the snapshot that we have left since
+        for guild_id in list(self._restored_guilds):
+            if guild_id not in ready_ids and (guild_id >> 22) % gw.shard_count == gw.shard_id:
+                self._restored_guilds.discard(guild_id)
+                self._guilds.pop(guild_id, None)
 
         if not self._user.bot and len(event_data.get("guilds")) <= 100:
             # Chunk now, sync later.
-            await gw.request_chunks([g for g in self.guilds.values()])
+            await gw.chunker.flush()
             logger.info("Chunking {} guilds immediately.".format(len(self.guilds)))
 
         logger.info("Ready processed for shard {}. Delaying until all guilds are chunked."
@@ -567,6 +910,20 @@ class State(object):
 
         logger.info("Successfully resumed session on shard ID {}, replayed"
                     "{} new events.".format(gw.shard_id, new_events))
+
+        if gw.resumed_from_store and not self.is_ready(gw.shard_id).is_set():
+            # we resumed a session from a previous process, so we never got a READY
+            # stored sessions are only resumed on top of a snapshot, which holds the guilds
+            gw.resumed_from_store = False
+            if self._user is None:
+                self._user = BotUser(self.client, **(await self.client.http.get_this_user()))
+                self._users[self._user.id] = self._user
+
+            logger.info("Shard {} resumed a stored session on top of a snapshot."
+                        .format(gw.shard_id))
+            await self.is_ready(gw.shard_id).set()
+            yield "ready",
+
         yield ("resumed", new_events)
 
     async def handle_user_update(self, gw: 'gateway.Gateway', event_data: dict):
@@ -579,8 +936,9 @@ class State(object):
         self._user.username = event_data.get("username", self._user.username)
         self._user.discriminator = event_data.get("discriminator", self._user.discriminator)
         self._user.avatar_hash = event_data.get("avatar", self._user.avatar_hash)
+        self._reindex_user(self._user.id)
 
-        yield "user_update",
+        return "user_update",
 
     async def handle_presence_update(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -629,22 +987,40 @@ class State(object):
             # create the member from the presence
             # we only pass the User here as we're about to update everything
             member = Member(client=self.client, user=event_data["user"])
+            member.guild_id = guild.id
+            changes = None
             old_member = None
         else:
-            old_member = member._copy()
+            changes = ChangeSet(member)
+            old_member = changes.lazy_before()
 
         # Update the member's presence
-        member.presence.status = event_data.get("status")
-        member.presence.game = event_data.get("game", {})
+        # a new presence is set, rather than changing it in place, so the old one is kept as-is
+        presence = Presence(status=event_data.get("status") or member.status,
+                            game=event_data.get("game", {}))
 
         # copy the roles if it exists
         roles = event_data.get("roles", [])
         if roles:
             # clear roles
-            member.role_ids = [int(rid) for rid in roles]
+            role_ids = [int(rid) for rid in roles]
+        else:
+            role_ids = member.role_ids
 
         # update the nickname
-        member.nickname = event_data.get("nick", member.nickname)
+        nickname = event_data.get("nick", member.nickname)
+
+        if changes is None:
+            member.role_ids = role_ids
+            member.nickname = nickname
+        else:
+            changes.record("presence")
+            if role_ids is not member.role_ids:
+                changes.set("role_ids", role_ids)
+            if nickname != member.nickname:
+                changes.set("nickname", nickname)
+
+        guild._set_presence(member.id, presence, member)
 
         user = member.user
         if not isinstance(user, RelationshipUser):
@@ -652,6 +1028,14 @@ class State(object):
             if "username" in event_data["user"]:
                 self.make_user(event_data["user"], override_cache=True)
 
+        if self.member_cache_policy.lazy:
+            # e.g. cache members coming online, and drop members going offline
+            guild._cache_member(member)
+        elif old_member is not None:
+            # store the member again, so that compact member stores keep the changes
+            guild._members[member.id] = member
+            guild._index_member(member)
+
         yield "member_update", old_member, member,
 
     async def handle_presences_replace(self, gw: 'gateway.Gateway', event_data: dict):
@@ -673,12 +1057,30 @@ class State(object):
         logger.info("Got a chunk of {} members in guild {} "
                     "on shard {}".format(len(members), guild.name or guild.id, guild.shard_id))
 
-        guild._handle_member_chunk(event_data.get("members"))
+        parsed, evictions = await self._parse_members(guild, members)
+        member_objs = guild._handle_member_chunk(members, parsed=parsed)
+        if self.member_cache_policy.lazy:
+            for member in member_objs:
+                guild._cache_member(member)
+
+        self._evict_users(evictions)
+
+        nonce = event_data.get("nonce")
+        if nonce is not None and not gw.chunker.owns_nonce(nonce):
+            # the response to a member query, which has nothing to do with chunking
+            query = self._member_queries.get(nonce)
+            if query is not None:
+                found, done = query
+                found.update((member.id, member) for member in member_objs)
+                if event_data.get("chunk_index", 0) + 1 >= event_data.get("chunk_count", 1):
+                    await done.set()
+
+            return
+
         yield "guild_chunk", guild, len(members),
+        yield "guild_members_received", guild, member_objs,
 
-        if guild._chunks_left <= 0:
-            # Set the finished chunking event.
-            await guild._finished_chunking.set()
+        if await gw.chunker.chunk_received(guild, event_data.get("chunk_count"), nonce):
             yield "guild_available", guild,
 
         # Check if we have all chunks.
@@ -708,18 +1110,17 @@ class State(object):
         presences = event_data.get("presences", [])
 
         for presence in presences:
-            u_id = presence["user"]["id"]
-            member = guild.members.get(int(u_id))
-
-            if not member:
-                continue
+            u_id = int(presence["user"]["id"])
+            member = guild.members.get(u_id)
+            guild._set_presence(u_id, Presence(**presence), member)
 
-            member.presence = Presence(**presence)
+            if member:
+                guild._members[member.id] = member
 
         logger.info("Processed a guild sync for guild {} with "
                     "{} members and {} presences.".format(guild.name, len(members), len(presences)))
 
-        yield "guild_sync", guild, len(members), len(presences),
+        return "guild_sync", guild, len(members), len(presences),
 
     async def handle_guild_create(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -728,21 +1129,25 @@ class State(object):
         id = int(event_data.get("id", 0))
         guild = self._guilds.get(id)
 
-        had_guild = True
+        had_guild = guild is not None
+        if id in self._restored_guilds:
+            # replace the guild from the snapshot, instead of merging into possibly stale data
+            self._restored_guilds.discard(id)
+            guild = None
+
         if guild:
             guild.from_guild_create(**event_data)
         else:
-            had_guild = False
-            guild = Guild(self.client, **event_data)
+            guild = await self._parse_guild(event_data)
             self._guilds[guild.id] = guild
+            await self._parsed(guild.id)
 
         guild.shard_id = gw.shard_id
-        try:
-            guild.me.presence.game = gw.game
-            guild.me.presence.status = gw.status
-        except AttributeError:
-            # unavailable guilds etc
-            pass
+        self._guilds.index_guild(guild)
+
+        me = guild.me
+        if me is not None:
+            guild._set_presence(me.id, Presence(status=gw.status or me.status, game=gw.game), me)
 
         # Dispatch the event if we're ready (i.e not streaming)
         if self.is_ready(gw.shard_id).is_set():
@@ -757,8 +1162,9 @@ class State(object):
 
                 logger.info("Joined guild {} ({}), requesting members if applicable"
                             .format(guild.name, guild.id))
-                if guild.large:
-                    await gw.request_chunks([guild])
+                if guild.large and not self._user.bot:
+                    await gw.chunker.add(guild)
+                    await gw.chunker.flush()
                 if self._user.bot:
                     await gw.send_guild_sync([guild])
 
@@ -767,9 +1173,13 @@ class State(object):
             yield "guild_streamed", guild,
 
         if self._user.bot:
-            if not guild.unavailable and guild.large:
+            if not guild.unavailable and guild.large \
+                    and self.member_cache_policy.should_chunk(guild):
                 # mark this guild as a chunking guild
-                self._mark_for_chunking(gw, guild)
+                await gw.chunker.add(guild)
+                if self.is_ready(gw.shard_id).is_set():
+                    # a guild we just joined, so there is no batch to wait for
+                    await gw.chunker.flush()
             else:
                 # set finished_chunking now
                 await guild._finished_chunking.set()
@@ -787,37 +1197,41 @@ class State(object):
         if not guild:
             return
 
-        old_guild = copy.copy(guild)
-
-        guild.unavailable = event_data.get("unavailable", False)
-        guild.name = event_data.get("name", guild.name)
-        guild.member_count = event_data.get("member_count", guild.member_count)
-        if not guild.member_count:
-            guild.member_count = len(guild._members)
-        guild._large = event_data.get("large", guild._large)
-        guild._icon_hash = event_data.get("icon", guild._icon_hash)
-        guild._splash_hash = event_data.get("splash", guild._splash_hash)
-        guild.region = event_data.get("region", guild.region)
-        guild.features = event_data.get("features", guild.features)
-
-        guild.mfa_level = MFALevel(event_data.get("mfa_level", guild.mfa_level))
-        guild.verification_level = VerificationLevel(event_data.get("verification_level",
-                                                                    guild.verification_level))
-        guild.notification_level = NotificationLevel(
+        changes = ChangeSet(guild)
+
+        changes.set("unavailable", event_data.get("unavailable", False))
+        changes.set("name", event_data.get("name", guild.name))
+        member_count = event_data.get("member_count", guild.member_count)
+        changes.set("member_count", member_count or len(guild._members))
+        changes.set("_large", event_data.get("large", guild._large))
+        changes.set("_icon_hash", event_data.get("icon", guild._icon_hash))
+        changes.set("_splash_hash", event_data.get("splash", guild._splash_hash))
+        changes.set("region", event_data.get("region", guild.region))
+        changes.set("features", event_data.get("features", guild.features))
+
+        changes.set("mfa_level", MFALevel(event_data.get("mfa_level", guild.mfa_level)))
+        changes.set("verification_level", VerificationLevel(
+            event_data.get("verification_level", guild.verification_level)
+        ))
+        changes.set("notification_level", NotificationLevel(
             event_data.get("default_message_notifications", guild.notification_level)
-        )
-        guild.content_filter_level = ContentFilterLevel(
+        ))
+        changes.set("content_filter_level", ContentFilterLevel(
             event_data.get("explicit_content_filter", guild.content_filter_level)
-        )
+        ))
 
-        guild.system_channel_id = int_or_none(event_data.get("system_channel_id"),
-                                              guild.system_channel_id)
+        changes.set("system_channel_id", int_or_none(event_data.get("system_channel_id"),
+                                                     guild.system_channel_id))
 
-        guild.afk_channel_id = int_or_none(event_data.get("afk_channel"), guild.afk_channel_id)
-        guild.afk_timeout = event_data.get("afk_timeout", guild.afk_timeout)
-        guild.owner_id = int_or_none(event_data.get("owner_id"), guild.owner_id)
+        changes.set("afk_channel_id", int_or_none(event_data.get("afk_channel"),
+                                                  guild.afk_channel_id))
+        changes.set("afk_timeout", event_data.get("afk_timeout", guild.afk_timeout))
+        changes.set("owner_id", int_or_none(event_data.get("owner_id"), guild.owner_id))
+        if "owner_id" in changes.changed:
+            # the owner has every permission
+            guild._roles_changed()
 
-        yield "guild_update", old_guild, guild,
+        return "guild_update", changes.lazy_before(), guild,
 
     async def handle_guild_delete(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -838,10 +1252,8 @@ class State(object):
             # We've left this guild - clear it from our dictionary of guilds.
             guild = self._guilds.pop(guild_id, None)
             if guild:
+                self.messages.evict_guild(guild.id)
                 yield "guild_leave", guild,
-                for member in guild._members.values():
-                    # use member.id to avoid user lookup
-                    self._check_decache_user(member.id)
 
     async def handle_guild_emojis_update(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -853,11 +1265,16 @@ class State(object):
         if not guild:
             return
 
-        old_guild = guild._copy()
-        emojis = event_data.get("emojis", [])
-        guild._handle_emojis(emojis)
+        changes = ChangeSet(guild)
+        # the event has every emoji of the guild, so fill a new dict and keep the old one for the
+        # old guild
+        emojis = {}
+        changes.set("_emojis", emojis)
+        changes.set("emojis", GuildEmojiWrapper(guild, emojis))
+        guild._handle_emojis(event_data.get("emojis", []))
+        self._guilds.index_guild(guild)
 
-        yield "guild_emojis_update", old_guild, guild,
+        return "guild_emojis_update", changes.lazy_before(), guild,
 
     async def handle_message_create(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -888,7 +1305,6 @@ class State(object):
         if not old_message:
             return
 
-        self.messages.remove(old_message)
         self.messages.append(new_message)
 
         if old_message.content != new_message.content:
@@ -907,7 +1323,7 @@ class State(object):
         if not message:
             return
 
-        yield "message_delete", message,
+        return "message_delete", message,
 
     async def handle_message_delete_bulk(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -921,18 +1337,14 @@ class State(object):
 
             messages.append(message)
 
-        yield "message_delete_bulk", messages,
+        return "message_delete_bulk", messages,
 
     def _find_emoji(self, emoji_data: dict):
         if emoji_data.get("id", None) is None:
             # str only
             return emoji_data["name"]
 
-        # try and get it from the guilds
-        for guild in self.guilds.values():
-            em = guild.emojis.get(int(emoji_data["id"]))
-            if em:
-                return em
+        return self._guilds.emojis.get(int(emoji_data["id"]))
 
     async def handle_message_reaction_add(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -990,7 +1402,7 @@ class State(object):
         else:
             author = channel.user
 
-        yield "message_reaction_add", message, author, reaction,
+        return "message_reaction_add", message, author, reaction,
 
     async def handle_message_reaction_remove_all(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1002,7 +1414,7 @@ class State(object):
 
         reactions = message.reactions.copy()
         message.reactions = []
-        yield "message_reaction_remove_all", message, reactions,
+        return "message_reaction_remove_all", message, reactions,
 
     async def handle_message_reaction_remove(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1039,7 +1451,7 @@ class State(object):
         if reaction.count == 0:
             message.reactions.remove(reaction)
 
-        yield "message_reaction_remove", message, reaction,
+        return "message_reaction_remove", message, reaction,
 
     async def handle_guild_member_add(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1054,9 +1466,9 @@ class State(object):
         member = Member(self.client, **event_data)
         member.guild_id = guild.id
 
-        guild._members[member.id] = member
+        guild._cache_member(member)
         guild.member_count += 1
-        yield "guild_member_add", member,
+        return "guild_member_add", member,
 
     async def handle_guild_member_remove(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1068,13 +1480,16 @@ class State(object):
         if not guild:
             return
 
-        member = guild._members.pop(int(event_data["user"]["id"]), None)
+        member_id = int(event_data["user"]["id"])
+        member = guild._members.pop(member_id, None)
+        guild._presences.discard(member_id)
+        guild._unindex_member(member_id)
         guild.member_count -= 1
         if not member:
             # We can't see the member, so don't fire an event for it.
             return
 
-        yield "guild_member_remove", member,
+        return "guild_member_remove", member,
 
     async def handle_guild_member_update(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1092,20 +1507,21 @@ class State(object):
         if not member:
             return
 
-        # Make a copy of the member for the old previous reference.
-        old_member = member._copy()
+        # Record the changes, for the old previous reference.
+        changes = ChangeSet(member)
         # Re-create the user object.
         # self.make_user(event_data["user"], override_cache=True)
         # self._users[member.user.id] = member.user
 
         # Overwrite roles, we want to get rid of any roles that are stale.
         if "roles" in event_data:
-            member.role_ids = [int(i) for i in event_data.get("roles", [])]
+            changes.set("role_ids", [int(i) for i in event_data.get("roles", [])])
 
+        changes.set("nickname", event_data.get("nick", member.nickname))
         guild._members[member.id] = member
-        member.nickname = event_data.get("nick", member.nickname)
+        guild._index_member(member)
 
-        yield "guild_member_update", old_member, member,
+        return "guild_member_update", changes.lazy_before(), member,
 
     async def handle_guild_ban_add(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1139,7 +1555,7 @@ class State(object):
             return
 
         user = self.make_user(event_data["user"])
-        yield "user_unban", guild, user,
+        return "user_unban", guild, user,
 
     async def handle_channel_create(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1150,16 +1566,17 @@ class State(object):
 
         channel = Channel(self.client, **event_data)
         if channel.private:
-            self._private_channels[channel.id] = channel
+            self._cache_private_channel(channel)
         else:
             channel.guild_id = guild.id
             channel._update_overwrites((event_data.get("permission_overwrites", [])))
             if channel.id not in guild._channels:
                 guild._channels[channel.id] = channel
+                self._guilds.add_channel(channel)
             else:
                 channel = guild._channels[channel.id]
 
-        yield "channel_create", channel,
+        return "channel_create", channel,
 
     async def handle_channel_update(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1171,35 +1588,40 @@ class State(object):
         if not channel:
             return
 
-        old_channel = channel._copy()
+        changes = ChangeSet(channel)
 
-        channel.name = event_data.get("name", channel.name)
-        channel.position = event_data.get("position", channel.position)
-        channel.topic = event_data.get("topic", channel.topic)
-        channel.nsfw = event_data.get("nsfw", channel.nsfw)
-        channel.icon_hash = event_data.get("icon_hash", channel.icon_hash)
-        channel.owner_id = int_or_none(event_data.get("owner_id"), channel.owner_id)
-        channel.parent_id = int_or_none(event_data.get("parent_id"), channel.parent_id)
+        changes.set("name", event_data.get("name", channel.name))
+        changes.set("position", event_data.get("position", channel.position))
+        changes.set("topic", event_data.get("topic", channel.topic))
+        changes.set("nsfw", event_data.get("nsfw", channel.nsfw))
+        changes.set("icon_hash", event_data.get("icon_hash", channel.icon_hash))
+        changes.set("owner_id", int_or_none(event_data.get("owner_id"), channel.owner_id))
+        changes.set("parent_id", int_or_none(event_data.get("parent_id"), channel.parent_id))
 
+        # this replaces the overwrites dict, so the old one is kept as-is
+        changes.record("_overwrites")
         channel._update_overwrites(event_data.get("permission_overwrites", []))
-        yield "channel_update", old_channel, channel,
+        return "channel_update", changes.lazy_before(), channel,
 
     async def handle_channel_delete(self, gw: 'gateway.Gateway', event_data: dict):
         """
         Called when a channel is deleted.
         """
-        channel_id = int(event_data.get("channel_id", 0))
+        channel_id = int(event_data.get("id", 0))
         channel = self.find_channel(channel_id)
 
         if not channel:
             return
 
         if channel.private:
-            del self._private_channels[channel.id]
+            self._uncache_private_channel(channel)
         else:
             del channel.guild._channels[channel.id]
+            self._guilds.remove_channel(channel)
+
+        self.messages.evict_channel(channel.id)
 
-        yield "channel_delete", channel,
+        return "channel_delete", channel,
 
     async def handle_guild_role_create(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1223,11 +1645,12 @@ class State(object):
             role = Role(self.client, **role_data)
             role.guild_id = guild.id
             guild._roles[role_id] = role
+            guild._roles_changed()
         else:
             # thinking
             role = guild._roles[role_id]
 
-        yield "role_create", role
+        return "role_create", role
 
     async def handle_guild_role_update(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1251,19 +1674,20 @@ class State(object):
         if not role:
             return
 
-        old_role = role._copy()
+        changes = ChangeSet(role)
 
         # Update all the fields on the role.
         event_data = event_data.get("role", {})
-        role.colour = event_data.get("color", 0)
-        role.name = event_data.get("name")
-        role.position = event_data.get("position")
-        role.hoisted = event_data.get("hoisted")
-        role.mentionable = event_data.get("mentionable")
-        role.managed = event_data.get("managed")
-        role.permissions = Permissions(event_data.get("permissions", 0))
+        changes.set("colour", event_data.get("color", 0))
+        changes.set("name", event_data.get("name"))
+        changes.set("position", event_data.get("position"))
+        changes.set("hoisted", event_data.get("hoisted"))
+        changes.set("mentionable", event_data.get("mentionable"))
+        changes.set("managed", event_data.get("managed"))
+        changes.set("permissions", Permissions(event_data.get("permissions", 0)))
+        guild._roles_changed()
 
-        yield "role_update", old_role, role,
+        return "role_update", changes.lazy_before(), role,
 
     async def handle_guild_role_delete(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1279,14 +1703,12 @@ class State(object):
         if not role:
             return
 
-        # Remove the role from all members.
-        for member in guild.members.values():
-            try:
-                member.role_ids.remove(role.id)
-            except ValueError:
-                continue
+        guild._roles_changed()
+
+        # Remove the role from all members, through the store so that compact stores repack them.
+        guild._members.remove_role(role.id)
 
-        yield "role_delete", role,
+        return "role_delete", role,
 
     async def handle_typing_start(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1303,13 +1725,13 @@ class State(object):
             member = channel.guild.members.get(user_id)
             if not member:
                 return
-            yield "guild_member_typing", channel, member,
+            return "guild_member_typing", channel, member,
         else:
             user = channel.recipients.get(user_id)
             if user is None:
                 return
 
-            yield "user_typing", channel, user,
+            return "user_typing", channel, user,
 
     # Voice bullshit
     async def handle_voice_server_update(self, gw: 'gateway.Gateway', event_data: dict):
@@ -1359,7 +1781,11 @@ class State(object):
 
         member = guild.members.get(user_id)
         if not member:
-            return
+            if not self.member_cache_policy.lazy or "member" not in event_data:
+                return
+
+            member = Member(self.client, **event_data["member"])
+            member.guild_id = guild.id
 
         channel_id = event_data.get("channel_id", 0)
         if channel_id is None:
@@ -1374,7 +1800,10 @@ class State(object):
         if new_voice_state is not None:
             guild._voice_states[new_voice_state.user_id] = new_voice_state
 
-        yield "voice_state_update", member, old_voice_state, new_voice_state,
+        if self.member_cache_policy.lazy:
+            guild._cache_member(member)
+
+        return "voice_state_update", member, old_voice_state, new_voice_state,
 
     async def handle_webhooks_update(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1409,7 +1838,7 @@ class State(object):
             if new_status.strength > guild.me.status.strength:
                 guild.me.status = new_status
 
-        yield "user_settings_update", old_settings, self._user.settings,
+        return "user_settings_update", old_settings, self._user.settings,
 
     async def handle_message_ack(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1428,7 +1857,7 @@ class State(object):
         if message is None:
             return
 
-        yield "message_ack", channel, message,
+        return "message_ack", channel, message,
 
     async def handle_relationship_add(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1450,7 +1879,7 @@ class State(object):
 
         self._users[u.id] = u
 
-        yield "relationship_add", u,
+        return "relationship_add", u,
 
     async def handle_relationship_remove(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1483,7 +1912,7 @@ class State(object):
         # maybe decache it anyway
         self._check_decache_user(u_id)
 
-        yield "relationship_remove", u,
+        return "relationship_remove", u,
 
     async def handle_channel_recipient_add(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1498,9 +1927,12 @@ class State(object):
         if channel is None:
             return
 
+        if user.id not in channel._recipients:
+            self._users.incref(user.id)
+
         channel._recipients[user.id] = user
 
-        yield "group_user_add", channel, user,
+        return "group_user_add", channel, user,
 
     async def handle_channel_recipient_remove(self, gw: 'gateway.Gateway', event_data: dict):
         """
@@ -1516,4 +1948,5 @@ class State(object):
 
         if user in channel.recipients.values():
             channel._recipients.pop(user.id, None)
-            yield "group_user_remove", channel, user,
+            self._users.decref(user.id)
+            return "group_user_remove", channel, user,
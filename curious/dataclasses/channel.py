@@ -378,9 +378,14 @@ class Channel(Dataclass):
         if self.type != ChannelType.VOICE:
             raise RuntimeError("No members for channels that aren't voice channels")
 
-        return list(
-            filter(lambda member: member.voice.channel == self, self.guild.members.values())
-        )
+        guild = self.guild
+        members = []
+        for user_id in guild._voice_states.channel_user_ids(self.id):
+            member = guild._members.get(user_id)
+            if member is not None:
+                members.append(member)
+
+        return members
 
     @property
     def overwrites(self) -> '_typing.Mapping[int, dt_permissions.Overwrite]':
@@ -409,6 +414,7 @@ class Channel(Dataclass):
 
     def _copy(self):
         obb = object.__new__(self.__class__)
+        obb.id = self.id
         obb.name = self.name
         obb.type = self.type
         obb.guild_id = self.guild_id
@@ -420,6 +426,8 @@ class Channel(Dataclass):
         obb.position = self.position
         obb._bot = self._bot
         obb.parent_id = self.parent_id
+        obb._overwrites = self._overwrites
+        obb._last_message_id = self._last_message_id
         return obb
 
     def get_history(self, before: int = None,
@@ -8,13 +8,16 @@ import collections
 import copy
 import datetime
 import enum
+import itertools
 import typing
+import uuid
 from math import ceil
 from types import MappingProxyType
 
 import curio
 import multio
 
+from curious.core.changes import ChangeSet
 from curious.core.httpclient import Endpoints
 from curious.dataclasses import channel, emoji as dt_emoji, invite as dt_invite, \
     member as dt_member, permissions as dt_permissions, role, search as dt_search, \
@@ -32,6 +35,10 @@ except ImportError:
 
 default_var = typing.TypeVar("T")
 
+# role generations are unique across every guild, so that a member never matches the generation of
+# a guild that has since been replaced (e.g. by a GUILD_CREATE or a snapshot)
+_role_generations = itertools.count()
+
 
 class MFALevel(enum.IntEnum):
     """
@@ -383,6 +390,7 @@ class GuildRoleWrapper(_WrapperBase):
         role_obb = role.Role(client=self._guild._bot,
                              **(await self._guild._bot.http.create_role(self._guild.id)))
         self._roles[role_obb.id] = role_obb
+        self._guild._roles_changed()
         role_obb.guild_id = self._guild.id
         return await role_obb.edit(**kwargs)
 
@@ -466,6 +474,7 @@ class Guild(Dataclass):
         "id", "unavailable", "name", "afk_timeout", "region",
         "mfa_level", "verification_level", "notification_level", "content_filter_level", "features",
         "shard_id", "_roles", "_members", "_channels", "_emojis", "member_count", "_voice_states",
+        "_presences", "_name_index", "_role_generation",
         "_large", "_chunks_left", "_finished_chunking", "_icon_hash", "_splash_hash",
         "owner_id", "afk_channel_id", "system_channel_id",
         "voice_client",
@@ -527,14 +536,24 @@ class Guild(Dataclass):
 
         #: The roles that this guild has.
         self._roles = {}
+        #: Changed whenever the roles or the owner of this guild change, which invalidates the
+        #: sorted roles and permissions cached on each member.
+        self._role_generation = next(_role_generations)
+        #: The :class:`~.PresenceStore` that indexes the statuses of the members of this guild.
+        self._presences = self._bot.state.member_cache_policy.new_presence_store()
+        #: The :class:`~.MemberNameIndex` of the members of this guild, once it has been searched.
+        self._name_index = None
         #: The members of this guild.
-        self._members = {}
+        #: This is a :class:`~.MemberStore` or :class:`~.CompactMemberStore`, which holds a
+        #: reference to the user of each member while the guild is cached.
+        self._members = self._bot.state.member_cache_policy.new_store(self)
         #: The channels of this guild.
         self._channels = {}
         #: The emojis that this guild has.
         self._emojis = {}
         #: The voice states that this guild has.
-        self._voice_states = {}
+        #: This is a :class:`~.VoiceStateStore`, which indexes them by channel.
+        self._voice_states = dt_vs.VoiceStateStore()
 
         #: The number of numbers this guild has.
         #: This is automatically updated.
@@ -563,6 +582,96 @@ class Guild(Dataclass):
     def _copy(self):
         return copy.copy(self)
 
+    def _roles_changed(self) -> None:
+        """
+        Invalidates the sorted roles and permissions cached on each member, after the roles or the
+        owner of this guild have changed.
+        """
+        self._role_generation = next(_role_generations)
+
+    def _is_me(self, member_id: int) -> bool:
+        """
+        :return: If the member ID is the ID of the current user.
+        """
+        user = self._bot.state._user
+        return user is not None and member_id == user.id
+
+    def _cache_member(self, member: 'dt_member.Member') -> bool:
+        """
+        Caches a member, or removes it from the cache, depending on the member cache policy.
+
+        :param member: The :class:`~.Member` to cache.
+        :return: If the member is cached.
+        """
+        if self._bot.state.member_cache_policy.should_cache(self, member):
+            self._members[member.id] = member
+            self._index_member(member)
+            return True
+
+        self._members.pop(member.id, None)
+        self._unindex_member(member.id)
+        return False
+
+    def _get_name_index(self) -> 'MemberNameIndex':
+        """
+        :return: The :class:`~.MemberNameIndex` of this guild, building it if needed.
+        """
+        if self._name_index is None:
+            from curious.core.cache import MemberNameIndex
+
+            index = MemberNameIndex()
+            index.add_all(self._members.values())
+            self._name_index = index
+
+        return self._name_index
+
+    def _index_member(self, member: 'dt_member.Member') -> None:
+        """
+        Updates the names of a member in the name index, if it has been built.
+        """
+        if self._name_index is not None:
+            self._name_index.add(member)
+
+    def _unindex_member(self, member_id: int) -> None:
+        """
+        Removes a member from the name index, if it has been built.
+        """
+        if self._name_index is not None:
+            self._name_index.discard(member_id)
+
+    def _indexed_members(self, member_ids: typing.Iterable[int]) \
+            -> 'typing.Generator[dt_member.Member, None, None]':
+        """
+        Looks up members found in the name index, skipping any that are out of date.
+        """
+        index = self._name_index
+        for member_id in member_ids:
+            member = self._members.get(member_id)
+            if member is None:
+                # e.g. evicted from an LRU cache
+                index.discard(member_id)
+                continue
+
+            if not index.matches(member):
+                # renamed without the index being told, so it is under the wrong names
+                index.add(member)
+                continue
+
+            yield member
+
+    def _set_presence(self, member_id: int, presence: Presence,
+                      member: 'dt_member.Member' = None) -> None:
+        """
+        Sets the presence of a member, updating the status index.
+
+        :param member_id: The ID of the member.
+        :param presence: The new :class:`~.Presence` of the member.
+        :param member: The :class:`~.Member`, if it is cached.
+        """
+        self._presences.set(member_id, presence)
+        if member is not None:
+            member.presence = None if self._presences.separate else presence
+
     def __repr__(self):
         return "<Guild id='{}' name='{}' members='{}'>".format(self.id, self.name,
                                                                self.member_count)
@@ -641,16 +750,41 @@ class Guild(Dataclass):
         """
         :return: The number of members with a non-Invisible presence. 
         """
-        return sum(1 for member in self._members.values() if member.status is not Status.OFFLINE)
+        return len(self._presences)
 
     # Presence methods
+    def status_count(self, status: Status) -> int:
+        """
+        Counts the members with the specified status, without looking at any members.
+
+        This includes members that are not cached. The offline count is worked out from the member
+        count.
+
+        :param status: The :class:`~.Status` to count.
+        :return: The number of members with the status.
+        """
+        status = Status(status)
+        if status is Status.OFFLINE:
+            return max(self.member_count - len(self._presences), 0)
+
+        return self._presences.count(status)
+
     def members_with_status(self,
                             status: Status) -> 'typing.Generator[dt_member.Member, None, None]':
         """
         A generator that returns the members that match the specified status.
         """
-        for member in self.members.values():
-            if member.status == status:
+        status = Status(status)
+        if status is Status.OFFLINE:
+            for member_id, member in self._members.items():
+                if member_id not in self._presences:
+                    yield member
+
+            return
+
+        for member_id in self._presences.member_ids(status):
+            member = self._members.get(member_id)
+            if member is not None:
                 yield member
 
     @property
@@ -718,23 +852,33 @@ class Guild(Dataclass):
         :return: A :class:`.Member` that matched, or None if no matches were found.
         """
         if full_name is not None:
-            sp = full_name.split("#", 1)
-            return self.search_for_member(name=sp[0], discriminator=sp[1])
+            name, sep, discriminator = full_name.rpartition("#")
+            if not sep or not (len(discriminator) == 4 and discriminator.isdigit()):
+                # no discriminator, or a nickname with a # in it
+                name, discriminator = full_name, None
+
+            return self.search_for_member(name=name, discriminator=discriminator)
 
         # coerce into a proper string
         if isinstance(discriminator, int):
             discriminator = "{:04d}".format(discriminator)
 
-        for member in self._members.values():
-            # ensure discrim matches first
-            if discriminator is not None and discriminator != member.user.discriminator:
-                continue
+        index = self._get_name_index()
+        return next(self._indexed_members(index.find(name, discriminator)), None)
 
-            if member.user.username == name:
-                return member
+    def search_members(self, prefix: str, *,
+                       limit: int = None) -> 'typing.List[dt_member.Member]':
+        """
+        Searches for cached members whose username or nickname starts with a prefix, ignoring
+        case.
 
-            if member.nickname == name:
-                return member
+        :param prefix: The start of the username or nickname.
+        :param limit: The maximum number of members to return.
+        :return: A list of :class:`~.Member` that matched, in order of name.
+        """
+        index = self._get_name_index()
+        members = self._indexed_members(index.startswith(prefix))
+        return list(itertools.islice(members, limit))
 
     @deprecated(since="0.7.0", see_instead=search_for_member, removal="0.9.0")
     def find_member(self, search_str: str) -> 'dt_member.Member':
@@ -761,6 +905,56 @@ class Guild(Dataclass):
         filtered = filter(predicate, self.members.values())
         return next(filtered, None)
 
+    async def fetch_member(self, member_id: int) -> 'dt_member.Member':
+        """
+        Gets a member of this guild, downloading it if it is not cached.
+
+        The downloaded member is cached if the member cache policy allows it.
+
+        :param member_id: The ID of the member to get.
+        :return: The :class:`~.Member` with that ID.
+        """
+        try:
+            return self._members[member_id]
+        except KeyError:
+            pass
+
+        member = await self._bot.download_guild_member(self.id, member_id)
+        self._cache_member(member)
+        return member
+
+    async def query_members(self, query: str, *, limit: int = 10,
+                            timeout: float = 10.0) -> 'typing.List[dt_member.Member]':
+        """
+        Requests the members whose username starts with a query over the gateway.
+
+        This is useful when the member cache policy does not cache every member.
+
+        :param query: The start of the username to search for.
+        :param limit: The maximum number of members to return.
+        :param timeout: The number of seconds to wait for Discord to respond.
+        :return: A list of :class:`~.Member` that matched.
+        """
+        gw = self._bot._gateways[self.shard_id]
+        found = {}
+        done = multio.Event()
+
+        # the nonce keeps the response apart from member chunks and other queries
+        nonce = uuid.uuid4().hex
+        queries = self._bot.state._member_queries
+        queries[nonce] = found, done
+        try:
+            await gw.query_members(self.id, query, limit=limit, nonce=nonce)
+            await multio.asynclib.timeout_after(timeout, done.wait())
+        except multio.asynclib.TaskTimeout:
+            pass
+        finally:
+            queries.pop(nonce, None)
+
+        folded = query.casefold()
+        return [member for member in found.values()
+                if member.user.username.casefold().startswith(folded)][:limit]
+
     # creation methods
     def start_chunking(self) -> None:
         """
@@ -779,20 +973,28 @@ class Guild(Dataclass):
         """
         await self._finished_chunking.wait()
 
-    def _handle_member_chunk(self, members: list):
+    def _handle_member_chunk(self, members: list, *,
+                             parsed: 'typing.Dict[int, dt_member.Member]' = None) \
+            -> 'typing.List[dt_member.Member]':
         """
         Handles a chunk of members.
         
         :param members: A list of member data dictionaries as returned from Discord.
+        :param parsed: A mapping of member ID -> :class:`~.Member` already created from the data, \
+            e.g. in a worker thread.
+        :return: The :class:`~.Member` objects in the chunk.
         """
         if self._chunks_left >= 1:
             # We have a new chunk, so decrement the number left.
             self._chunks_left -= 1
 
+        member_objs = []
         for member_data in members:
             id = int(member_data["user"]["id"])
             if id in self._members:
                 member_obj = self._members[id]
+            elif parsed is not None and id in parsed:
+                member_obj = parsed[id]
             else:
                 member_obj = dt_member.Member(self._bot, **member_data)
 
@@ -800,6 +1002,10 @@ class Guild(Dataclass):
             member_obj.guild_id = self.id
 
             self._members[member_obj.id] = member_obj
+            self._index_member(member_obj)
+            member_objs.append(member_obj)
+
+        return member_objs
 
     def _handle_emojis(self, emojis: typing.List[dict]):
         """
@@ -818,6 +1024,8 @@ class Guild(Dataclass):
 
         :param data: The GUILD_CREATE data to use.
         """
+        # this merges into the guild in place, so keep it out of the old guild of any update
+        ChangeSet.freeze(self)
         self.unavailable = data.get("unavailable", False)
 
         if self.unavailable:
@@ -852,17 +1060,20 @@ class Guild(Dataclass):
             role_obj.guild_id = self.id
             self._roles[role_obj.id] = role_obj
 
+        self._roles_changed()
+
         # Create all the Member objects for the server.
         self._handle_member_chunk(data.get("members", []))
 
+        # the presences are of every member that is not offline, so start again
+        self._presences.clear()
         for presence in data.get("presences", []):
             member_id = int(presence["user"]["id"])
             member_obj = self._members.get(member_id)
+            self._set_presence(member_id, Presence(**presence), member_obj)
 
-            if not member_obj:
-                continue
-
-            member_obj.presence = Presence(**presence)
+            if member_obj:
+                self._members[member_id] = member_obj
 
         # Create all of the channel objects.
         for channel_data in data.get("channels", []):
@@ -873,6 +1084,7 @@ class Guild(Dataclass):
             self._channels[channel_obj.id] = channel_obj
 
         # Create all of the voice states.
+        self._voice_states.clear()
         for vs_data in data.get("voice_states", []):
             user_id = int(vs_data.get("user_id", 0))
             member = self.members.get(user_id)
@@ -889,6 +1101,11 @@ class Guild(Dataclass):
 
             self._voice_states[voice_state.user_id] = voice_state
 
+        if self._bot.state.member_cache_policy.lazy:
+            # presences and voice states are needed to know which members to keep
+            for member in list(self._members.values()):
+                self._cache_member(member)
+
         # Create all of the emoji objects for the server.
         self._handle_emojis(data.get("emojis", []))
 
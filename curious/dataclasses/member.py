@@ -6,7 +6,6 @@ Wrappers for Member objects (Users with guilds).
 import collections
 import datetime
 import typing
-from typing import List
 
 from curious.dataclasses import guild as dt_guild, role as dt_role, user as dt_user, \
     voice_state as dt_vs
@@ -100,30 +99,29 @@ class _MemberRoleContainer(collections.Sequence):
     def __init__(self, member: 'Member'):
         self._member = member
 
-    def _sorted_roles(self) -> 'List[dt_role.Role]':
-        if not self._member.guild:
-            return []
+    def _sorted_roles(self) -> 'typing.Tuple[dt_role.Role, ...]':
+        cache = self._member._get_role_cache()
+        if cache is None:
+            return ()
 
-        roles = []
-        for id in self._member.role_ids:
-            try:
-                roles.append(self._member.guild.roles[id])
-            except (KeyError, AttributeError):
-                pass
-
-        return sorted(roles)
+        return cache[1]
 
-    # opt: the default Sequence makes us re-create the sorted role list constantly
-    # we don't wanna cache it, without introducing invalidation hell
-    # so we just put `__iter__` on `_sorted_roles`
+    # the sorted roles are cached on the member, until its roles or the guild's roles change
     def __iter__(self) -> type(iter([])):
         return iter(self._sorted_roles())
 
+    def __reversed__(self):
+        return reversed(self._sorted_roles())
+
     def __len__(self) -> int:
         return len(self._member.role_ids)
 
     def __getitem__(self, item: int):
-        return self._sorted_roles()[item]
+        roles = self._sorted_roles()
+        if isinstance(item, slice):
+            return list(roles[item])
+
+        return roles[item]
 
     @property
     def top_role(self) -> 'dt_role.Role':
@@ -134,7 +132,8 @@ class _MemberRoleContainer(collections.Sequence):
         if len(roles) <= 0:
             return self._member.guild.default_role
 
-        return self[0]
+        # roles are sorted lowest first
+        return roles[-1]
 
     async def add(self, *roles: 'dt_role.Role'):
         """
@@ -206,8 +205,8 @@ class Member(Dataclass):
     A member represents somebody who is inside a guild.
     """
 
-    __slots__ = ("_user_data", "role_ids", "joined_at", "_nickname", "guild_id", "presence",
-                 "roles")
+    __slots__ = ("_user_data", "_role_ids", "joined_at", "_nickname", "guild_id", "_presence",
+                 "_role_cache")
 
     def __init__(self, client, **kwargs):
         super().__init__(kwargs["user"]["id"], client)
@@ -216,12 +215,12 @@ class Member(Dataclass):
         self._user_data = kwargs["user"]
         self._bot.state.make_user(self._user_data)
 
+        # [guild role generation, sorted roles, guild permission bitfield or None]
+        self._role_cache = None  # type: list
+
         #: An iterable of role IDs this member has.
         self.role_ids = [int(rid) for rid in kwargs.get("roles", [])]
 
-        #: A :class:`._MemberRoleContainer` that represents the roles of this member.
-        self.roles = _MemberRoleContainer(self)
-
         #: The date the user joined the guild.
         self.joined_at = to_datetime(kwargs.get("joined_at", None))  # type: datetime.datetime
 
@@ -232,9 +231,11 @@ class Member(Dataclass):
         #: The ID of the guild that this member is in.
         self.guild_id = None  # type: int
 
-        #: The current :class:`~.Presence` of this member.
-        self.presence = Presence(status=kwargs.get("status", Status.OFFLINE),
-                                 game=kwargs.get("game", None))
+        #: The presence of this member, if it is kept on the member instead of by the guild.
+        self._presence = None  # type: Presence
+        if "status" in kwargs or "game" in kwargs:
+            self._presence = Presence(status=kwargs.get("status", Status.OFFLINE),
+                                      game=kwargs.get("game", None))
 
     @property
     def guild(self) -> 'dt_guild.Guild':
@@ -243,6 +244,15 @@ class Member(Dataclass):
         """
         return self._bot.guilds.get(self.guild_id)
 
+    @property
+    def roles(self) -> _MemberRoleContainer:
+        """
+        :return: A :class:`._MemberRoleContainer` that represents the roles of this member.
+        """
+        # made on each access, as keeping it on the member would be a reference cycle, which
+        # delays decaching the user until the cyclic GC runs
+        return _MemberRoleContainer(self)
+
     @property
     def voice(self) -> 'dt_vs.VoiceState':
         """
@@ -253,6 +263,67 @@ class Member(Dataclass):
         except (AttributeError, KeyError):
             return None
 
+    @property
+    def role_ids(self) -> typing.List[int]:
+        """
+        Represents the IDs of the roles this member has.
+
+        :getter: A list of role IDs.
+        :setter: Sets the role IDs, clearing the cached roles and permissions.
+        """
+        return self._role_ids
+
+    @role_ids.setter
+    def role_ids(self, value: typing.List[int]):
+        self._role_ids = value
+        self._role_cache = None
+
+    def _get_role_cache(self) -> typing.Union[list, None]:
+        """
+        :return: The cached sorted roles and guild permissions of this member, re-creating them if \
+            the roles of the guild have changed since. None if the guild is not cached.
+        """
+        guild = self.guild
+        if guild is None:
+            return None
+
+        cache = self._role_cache
+        if cache is not None and cache[0] == guild._role_generation:
+            return cache
+
+        roles = []
+        for id in self._role_ids:
+            role = guild._roles.get(id)
+            if role is not None:
+                roles.append(role)
+
+        # the same order as comparing the roles, without looking up the guild for each one
+        roles.sort(key=lambda role: (role.position, role.id))
+        cache = self._role_cache = [guild._role_generation, tuple(roles), None]
+        return cache
+
+    @property
+    def presence(self) -> Presence:
+        """
+        Represents a member's presence.
+
+        :getter: The current :class:`~.Presence` of this member. If it is not kept on the member, \
+            this is looked up in the :class:`~.PresenceStore` of the guild.
+        :setter: Sets the presence kept on the member, without updating the guild. Do not use.
+        """
+        if self._presence is not None:
+            return self._presence
+
+        guild = self.guild
+        if guild is None:
+            return Presence()
+
+        return guild._presences.get(self.id)
+
+    @presence.setter
+    def presence(self, value: Presence):
+        self._presence = value
+
     @property
     def nickname(self) -> Nickname:
         """
@@ -289,6 +360,7 @@ class Member(Dataclass):
         new_object._bot = self._bot
 
         new_object.id = self.id
+        new_object._user_data = self._user_data
         new_object.role_ids = self.role_ids.copy()
         new_object.joined_at = self.joined_at
         new_object.guild_id = self.guild_id
@@ -297,6 +369,26 @@ class Member(Dataclass):
 
         return new_object
 
+    @classmethod
+    def _from_compact(cls, client, member_id: int, guild_id: int, role_ids: typing.List[int],
+                      joined_at: datetime.datetime, nickname: str, presence: Presence) -> 'Member':
+        """
+        Creates a member from the fields kept by a :class:`~.CompactMemberStore`.
+        """
+        new_object = object.__new__(cls)  # type: Member
+        new_object._bot = client
+
+        new_object.id = member_id
+        # the store holds a reference to the user, so this is only used if it is not cached
+        new_object._user_data = {"id": member_id}
+        new_object.role_ids = role_ids
+        new_object.joined_at = joined_at
+        new_object.guild_id = guild_id
+        new_object.presence = presence
+        new_object.nickname = nickname
+
+        return new_object
+
     def __del__(self):
         try:
             self._bot.state._check_decache_user(self.id)
@@ -337,20 +429,28 @@ class Member(Dataclass):
         """
         :return: The current :class:`~.Status` of this member.
         """
-        return self.presence.status if self.presence else Status.OFFLINE
+        if self._presence is not None:
+            return self._presence.status
+
+        guild = self.guild
+        if guild is None:
+            return Status.OFFLINE
+
+        return guild._presences.status(self.id)
 
     @property
     def game(self) -> Game:
         """
         :return: The current :class:`~.Game` this member is playing.
         """
-        if not self.presence:
+        presence = self.presence
+        if not presence:
             return None
 
-        if self.presence.status == Status.OFFLINE:
+        if presence.status == Status.OFFLINE:
             return None
 
-        return self.presence.game
+        return presence.game
 
     @property
     def colour(self) -> int:
@@ -380,20 +480,24 @@ class Member(Dataclass):
         """
         :return: The calculated guild permissions for a member.
         """
-        if self == self.guild.owner:
-            return Permissions.all()
+        cache = self._get_role_cache()
+        if cache[2] is None:
+            guild = self.guild
+            if self.id == guild.owner_id:
+                cache[2] = Permissions.all().bitfield
+            else:
+                bitfield = 0
+                # add the default roles
+                bitfield |= guild.default_role.permissions.bitfield
+                for role in cache[1]:
+                    bitfield |= role.permissions.bitfield
 
-        bitfield = 0
-        # add the default roles
-        bitfield |= self.guild.default_role.permissions.bitfield
-        for role in self.roles:
-            bitfield |= role.permissions.bitfield
+                if Permissions(bitfield).administrator:
+                    bitfield = Permissions.all().bitfield
 
-        permissions = Permissions(bitfield)
-        if permissions.administrator:
-            return Permissions.all()
+                cache[2] = bitfield
 
-        return permissions
+        return Permissions(cache[2])
 
     # Member methods.
     async def send(self, content: str, *args, **kwargs):
@@ -89,10 +89,13 @@ class Role(Dataclass):
 
     def _copy(self):
         obb = object.__new__(self.__class__)
+        obb._bot = self._bot
 
+        obb.id = self.id
         obb.name = self.name
         obb.colour = self.colour
         obb.hoisted = self.hoisted
+        obb.mentionable = self.mentionable
         obb.permissions = self.permissions
         obb.managed = self.managed
         obb.position = self.position
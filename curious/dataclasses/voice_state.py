@@ -3,6 +3,7 @@ Wrappers for voice state objects.
 
 .. currentmodule:: curious.dataclasses.voice_state
 """
+import typing
 
 from curious.dataclasses import channel as dt_channel, guild as dt_guild, member as dt_member
 
@@ -96,3 +97,77 @@ class VoiceState(object):
         Server undeafens this member on the guild.
         """
         return await self.guild.change_voice_state(self.member, deaf=False)
+
+
+class VoiceStateStore(dict):
+    """
+    The voice state mapping of a guild, of user ID -> :class:`.VoiceState`.
+
+    The IDs of the users in each channel are indexed, so listing the members of a voice channel
+    only looks at that channel.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        # channel id -> ids of the users in it
+        self._channels = {}  # type: typing.Dict[int, typing.Set[int]]
+        self.update(*args, **kwargs)
+
+    def __repr__(self):
+        return "<VoiceStateStore states={} channels={}>".format(len(self), len(self._channels))
+
+    def channel_user_ids(self, channel_id: int) -> typing.FrozenSet[int]:
+        """
+        :param channel_id: The ID of the voice channel.
+        :return: The IDs of the users in the channel.
+        """
+        return frozenset(self._channels.get(channel_id, ()))
+
+    def _unindex(self, key, state: VoiceState):
+        if state is None:
+            return
+
+        ids = self._channels.get(state.channel_id)
+        if ids is not None:
+            ids.discard(key)
+            if not ids:
+                del self._channels[state.channel_id]
+
+    def __setitem__(self, key, value):
+        self._unindex(key, dict.get(self, key))
+        super().__setitem__(key, value)
+        self._channels.setdefault(value.channel_id, set()).add(key)
+
+    def __delitem__(self, key):
+        self._unindex(key, dict.get(self, key))
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+
+            raise KeyError(key)
+
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._unindex(key, value)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self._channels.clear()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return dict.__getitem__(self, key)
@@ -140,3 +140,15 @@ class HierarchyError(CuriousError):
     """
     Raised when you can't do something due to the hierarchy.
     """
+
+
+class ClusterError(CuriousError):
+    """
+    Raised when a request to the cluster coordinator fails.
+    """
+
+
+class SnapshotError(CuriousError):
+    """
+    Raised when a state snapshot cannot be read.
+    """
@@ -4,7 +4,6 @@ A special gateway client for Voice.
 import enum
 import json
 import logging
-import threading
 import time
 import typing
 import zlib
@@ -13,9 +12,8 @@ import curio
 import multio
 from asyncwebsockets import Websocket, WebsocketBytesMessage, WebsocketClosed, connect_websocket
 from curio.socket import gethostbyname
-from curio.thread import AWAIT, async_thread
 
-from curious.core.gateway import Gateway, ReconnectWebsocket
+from curious.core.gateway import Gateway, HeartbeatStats
 
 logger = logging.getLogger("curious.voice")
 
@@ -31,29 +29,39 @@ class VGatewayOp(enum.IntEnum):
     HELLO = 8
 
 
-@async_thread(daemon=True)
-def _heartbeat_loop(gw: 'VoiceGateway', heartbeat_interval: float):
+async def _heartbeat_loop(gw: 'VoiceGateway', heartbeat_interval: float, stop: multio.Event):
     """
     Heartbeat looper that loops and sends heartbeats to the gateway.
 
+    This runs as a regular task on the event loop, so it does not need a thread per connection.
+
     :param gw: The gateway to handle.
+    :param heartbeat_interval: The number of seconds between each heartbeat.
+    :param stop: The event that is set when this loop should stop.
     """
-    # async threads!
     logger.debug("Sending initial heartbeat.")
-    AWAIT(gw.send_heartbeat())
+    try:
+        await gw.send_heartbeat()
+    except WebsocketClosed:
+        return
+
     while True:
-        # this is similar to the normal threaded event waiter
-        # it will time out after heartbeat_interval seconds.
         try:
-            AWAIT(curio.timeout_after(heartbeat_interval, gw._stop_heartbeating.wait()))
-        except curio.TaskTimeout:
+            await multio.asynclib.timeout_after(heartbeat_interval, stop.wait())
+        except multio.asynclib.TaskTimeout:
             pass
         else:
             break
 
+        if gw.hb_stats.missed_acks >= gw.MAX_MISSED_ACKS:
+            logger.error("Missed {} voice heartbeat ACKs, closing connection!"
+                         .format(gw.hb_stats.missed_acks))
+            await gw._close()
+            break
+
         try:
-            AWAIT(gw.send_heartbeat())
-        except ReconnectWebsocket:
+            await gw.send_heartbeat()
+        except WebsocketClosed:
             break
 
 
@@ -64,6 +72,9 @@ class VoiceGateway(object):
 
     GATEWAY_VERSION = 3
 
+    #: The number of heartbeats in a row that can go without an ACK before closing.
+    MAX_MISSED_ACKS = 2
+
     def __init__(self, session_id: str, token: str, endpoint: str, user_id: str, guild_id: str):
         #: The current websocket object.
         self.websocket = None  # type: Websocket
@@ -80,9 +91,12 @@ class VoiceGateway(object):
         #: The main gateway object.
         self.main_gateway = None  # type: Gateway
 
-        #: The current threading event used to signal if we need to stop heartbeating.
+        #: The event used to signal if we need to stop heartbeating.
         self._stop_heartbeating = multio.Event()
 
+        #: The current heartbeat statistic counter for this gateway.
+        self.hb_stats = HeartbeatStats()
+
         #: Voice server stuff
         self.endpoint = endpoint
         self.port = None  # type: int
@@ -131,6 +145,7 @@ class VoiceGateway(object):
         Sends a heartbeat.
         """
         hb = self.get_heartbeat()
+        self.hb_stats.heartbeat_sent()
         return await self._send_json(hb)
 
     def _send_json(self, payload: dict):
@@ -198,20 +213,21 @@ class VoiceGateway(object):
 
         await self._send_json(payload)
 
-    async def _start_heartbeating(self, heartbeat_interval: float) -> threading.Thread:
+    async def _start_heartbeating(self, heartbeat_interval: float) -> curio.Task:
         """
-        Starts the heartbeat thread.
+        Starts the heartbeat task.
         :param heartbeat_interval: The number of seconds between each heartbeat.
         """
         if not self._stop_heartbeating.is_set():
-            # cancel some poor thread elsewhere
+            # stop the heartbeat task of the previous connection
             await self._stop_heartbeating.set()
-            del self._stop_heartbeating
 
         self._stop_heartbeating = multio.Event()
+        self.hb_stats.reset()
 
         # dont reference the task - it'll die by itself
-        task = await curio.spawn(_heartbeat_loop(self, heartbeat_interval), daemon=True)
+        task = await curio.spawn(_heartbeat_loop(self, heartbeat_interval,
+                                                 self._stop_heartbeating), daemon=True)
 
         return task
 
@@ -322,8 +338,7 @@ class VoiceGateway(object):
             pass
 
         elif op == VGatewayOp.HEARTBEAT_ACK:
-            # suppress
-            pass
+            self.hb_stats.ack_received()
 
         else:
             logger.warning("Unhandled event: {}".format(op))
@@ -0,0 +1,57 @@
+"""
+Checks that the user cache keeps the users of cached members.
+"""
+import gc
+import types
+
+import pytest
+
+from curious.core.cache import MemberCachePolicy
+from curious.core.state import State
+from curious.dataclasses.guild import Guild
+
+
+def make_client(policy: MemberCachePolicy):
+    client = types.SimpleNamespace()
+    client.state = State(client, member_cache_policy=policy)
+    client.guilds = client.state.guilds
+    return client
+
+
+def make_guild(client, member_count: int) -> Guild:
+    members = [{"user": {"id": str(id), "username": "user{}".format(id), "discriminator": "0001"},
+                "roles": [], "joined_at": "2018-01-01T00:00:00"}
+               for id in range(1, member_count + 1)]
+
+    return Guild(client, id="1", name="guild", roles=[], members=members,
+                 member_count=member_count, default_message_notifications=0)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_packed_members_keep_users(compact: bool):
+    client = make_client(MemberCachePolicy(compact=compact))
+    guild = make_guild(client, 5000)
+    gc.collect()
+
+    # the store is not attached to the user cache yet
+    users = client.state._users
+    assert all(member_id in users for member_id in guild._members)
+
+    client.state._guilds[guild.id] = guild
+    gc.collect()
+
+    assert users.evicted == 0
+    assert len(users) == 5000
+    assert all(member.user.username is not None for member in guild.members.values())
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_removed_guild_evicts_users(compact: bool):
+    client = make_client(MemberCachePolicy(compact=compact))
+    guild = make_guild(client, 100)
+    client.state._guilds[guild.id] = guild
+
+    del client.state._guilds[guild.id]
+    gc.collect()
+
+    assert len(client.state._users) == 0
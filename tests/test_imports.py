@@ -0,0 +1,24 @@
+"""
+Checks that the package and its core modules import cleanly, e.g. without circular imports.
+"""
+import importlib
+
+import pytest
+
+MODULES = [
+    "curious",
+    "curious.core.cache",
+    "curious.core.changes",
+    "curious.core.client",
+    "curious.core.gateway",
+    "curious.core.sendqueue",
+    "curious.core.sessions",
+    "curious.core.snapshot",
+    "curious.core.state",
+    "curious.commands",
+]
+
+
+@pytest.mark.parametrize("name", MODULES)
+def test_import(name: str):
+    importlib.import_module(name)
@@ -0,0 +1,73 @@
+"""
+Checks that state snapshots can be saved and restored.
+"""
+
+import curio
+
+from curious.core.state import State
+from curious.dataclasses.channel import ChannelType
+from curious.dataclasses.guild import Guild
+from curious.dataclasses.voice_state import VoiceState
+
+BOT = {"id": "100", "username": "bot", "discriminator": "0001", "bot": True}
+USER = {"id": "2", "username": "user", "discriminator": "0002"}
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.state = State(self)
+        self.guilds = self.state.guilds
+
+    @property
+    def user(self):
+        return self.state._user
+
+
+def make_state() -> State:
+    client = FakeClient()
+    state = client.state
+    state._user = state.make_user(BOT)
+
+    guild = Guild(client, id="1", name="guild", roles=[], owner_id="2",
+                  members=[{"user": USER, "roles": [], "joined_at": "2018-01-01T00:00:00"}],
+                  channels=[{"id": "10", "name": "general", "type": ChannelType.TEXT.value},
+                            {"id": "11", "name": "voice", "type": ChannelType.VOICE.value}],
+                  member_count=1, default_message_notifications=0)
+    guild.shard_id = 0
+    guild._voice_states[2] = VoiceState(client=client, user_id="2", guild_id="1",
+                                        channel_id="11", self_mute=True)
+    state._guilds[guild.id] = guild
+    state.make_private_channel({"id": "20", "type": ChannelType.PRIVATE.value,
+                                "recipients": [USER]})
+    return state
+
+
+def test_snapshot_round_trip(tmpdir):
+    path = str(tmpdir.join("state.snapshot"))
+    make_state().save_snapshot(path, sessions={0: ("session", 42)})
+
+    state = FakeClient().state
+    assert curio.run(state.load_snapshot(path)) == 1
+
+    guild = state.guilds[1]
+    assert guild._channels[10].guild_id == 1
+    assert guild._channels[10].owner_id is None
+    assert guild._voice_states[2].channel_id == 11
+    assert guild._voice_states[2]._self_mute is True
+    assert guild._voice_states.channel_user_ids(11) == {2}
+
+    channel = state._private_channels[20]
+    assert channel.guild_id is None
+    assert 2 in channel._recipients
+
+    assert state._snapshot_sessions == {0: ("session", 42)}
+
+
+def test_broken_snapshot_is_ignored(tmpdir):
+    path = tmpdir.join("state.snapshot")
+    path.write_binary(b"not a snapshot at all")
+
+    state = FakeClient().state
+    assert curio.run(state.load_snapshot(str(path))) == 0
+    assert not state.guilds
+    assert not state._snapshot_sessions